@@ -1,6 +1,7 @@
 import arcpy
 import os
 import config
+import instrumentation
 
 
 def create_folders(*folders):
@@ -45,6 +46,7 @@ def project_input_data():
     arcpy.Project_management(config._INTERSECTIONS, config.INTERSECTIONS, config.VIRGINIA_LAMBERT)
 
 
+@instrumentation.timed('stage 0')
 def setup():
     create_folders('data', 'logs')
     create_databases('input_data', 'scrap', 'intermediate')
@@ -4,8 +4,12 @@
     on the non-prime route on the LRS.
 """
 import flip_routes
+import instrumentation
+import storage
 
+@instrumentation.timed('stage 25')
 def flip_routes_by_linearId():
+    storage.require_arcpy_backend('Stage 25')
     sql = "status like '%Complete%'"  # Only run on routes that have already been matched
     flip_routes.run_flip_routes(' - Flipped (35)', sql)
 
@@ -2,8 +2,12 @@ from AutoQC import run_AutoQC
 import arcpy
 import config
 import pandas as pd
+import instrumentation
+import storage
 
+@instrumentation.timed('stage 27')
 def run_AutoQC_27():
+    storage.require_arcpy_backend('Stage 27')
     run_AutoQC('_27')
 
     print('\nResetting failed QC results')
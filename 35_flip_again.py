@@ -4,8 +4,12 @@
     on the non-prime route on the LRS.
 """
 import flip_routes
+import instrumentation
+import storage
 
+@instrumentation.timed('stage 35')
 def flip_routes_again():
+    storage.require_arcpy_backend('Stage 35')
     sql = "status = 'Complete (30)'"  # Only run on routes that have already been matched
     flip_routes.run_flip_routes(' - Flipped (35)', sql)
 
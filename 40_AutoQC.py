@@ -2,8 +2,12 @@ from AutoQC import run_AutoQC
 import arcpy
 import config
 import pandas as pd
+import instrumentation
+import storage
 
+@instrumentation.timed('stage 40')
 def run_AutoQC_40():
+    storage.require_arcpy_backend('Stage 40')
     run_AutoQC('_40')
 
     print('\nResetting failed QC results')
@@ -1,51 +1,99 @@
 """ This script will create a dictionary using RTE_NM as key and a list of
     intersections by OBJECTID as values.  The dictionary will be saved
     as a json file to be loaded in 45_identify_routes_detailed.py.  This
-    only needs to be run once unless the LRS version is updated. """
+    only needs to be run once unless the LRS version is updated.
+
+    When the LRS is updated, 8_carry_forward_unchanged_tmcs.py records which
+    routes changed (see incremental.py).  If the intersections themselves
+    haven't changed, only those routes and routes that are missing from the
+    existing dictionary are rebuilt. """
 
 import arcpy
 import config
 import json
+import os
+import incremental
 import lrs_tools
+import instrumentation
+import storage
+
+RTE_INT_DICT = 'data//rte_int_dict.json'
 
 
-# Create layers
-print('  Creating LRS layer')
-lyrLRS = arcpy.MakeFeatureLayer_management(config.MASTER_LRS, 'lrs').getOutput(0)
+def get_ints(geom, intersections):
+    arcpy.management.SelectLayerByAttribute(intersections,'CLEAR_SELECTION')
+    arcpy.SelectLayerByLocation_management(intersections, 'WITHIN_A_DISTANCE', geom, '5 METERS', 'NEW_SELECTION')
 
-print('  Creating Intersections layer')
-lyrIntersections = arcpy.MakeFeatureLayer_management(config.INTERSECTIONS, 'intersections').getOutput(0)
+    return list(intersections.getSelectionSet())
 
-print('  Creating TMC layer')
-lyrTMC = arcpy.MakeFeatureLayer_management(config.TMCs, 'tmcs').getOutput(0)
 
-print('  Get list of RTE_NMs near TMCs')
-arcpy.SelectLayerByLocation_management(lyrLRS, 'WITHIN_A_DISTANCE', lyrTMC, '10 METERS', 'NEW_SELECTION')
-rte_nms = tuple([row[0] for row in arcpy.da.SearchCursor(lyrLRS, 'RTE_NM')])
-sql = f"RTE_NM IN {rte_nms}"
+def load_existing_dict(rte_nms):
+    """ Returns (rte_int_dict, routes to rebuild).  If the LRS changes allow it,
+        the existing dictionary is kept and only the changed or missing routes are
+        rebuilt.  Otherwise every route is rebuilt """
+    changes = incremental.load_lrs_changes()
+    if not changes or changes['intersections_changed'] or not os.path.exists(RTE_INT_DICT):
+        return {}, set(rte_nms)
 
+    with open(RTE_INT_DICT, 'r') as file:
+        rte_int_dict = json.load(file)
 
-# Fixes bug where arcpy won't recognize this layer for selection unless its referenced elsewhere first
-with arcpy.da.SearchCursor(lyrIntersections, 'SHAPE@') as cur:
-    for row in cur:
-        break
+    changed_routes = set(changes['routes'])
+    for rte_nm in changed_routes:
+        rte_int_dict.pop(rte_nm, None)
 
-# Create and load route intersection dictionary
-def get_ints(geom, intersections):
-    arcpy.management.SelectLayerByAttribute(intersections,'CLEAR_SELECTION')
-    arcpy.SelectLayerByLocation_management(intersections, 'WITHIN_A_DISTANCE', geom, '5 METERS', 'NEW_SELECTION')
+    rebuild = {rte_nm for rte_nm in rte_nms if rte_nm not in rte_int_dict}
+    print(f'  Keeping {len(rte_int_dict)} routes from the existing dictionary')
+    return rte_int_dict, rebuild
 
-    return list(intersections.getSelectionSet())
 
-total = len([row for row in arcpy.da.SearchCursor(config.MASTER_LRS, 'RTE_NM', sql)])
-rte_int_dict = {}
-with arcpy.da.SearchCursor(config.MASTER_LRS, ['RTE_NM','SHAPE@'], sql) as cur:
-    for i, row in enumerate(cur):
-        rte_nm, geom = row
-        ints = get_ints(geom, lyrIntersections)
-        rte_int_dict[rte_nm] = ints
+@instrumentation.timed('stage 43')
+def create_intersection_dictionary():
+    storage.require_arcpy_backend('Stage 43')
+    # Create layers
+    print('  Creating LRS layer')
+    lyrLRS = arcpy.MakeFeatureLayer_management(config.MASTER_LRS, 'lrs').getOutput(0)
+
+    print('  Creating Intersections layer')
+    lyrIntersections = arcpy.MakeFeatureLayer_management(config.INTERSECTIONS, 'intersections').getOutput(0)
+
+    print('  Creating TMC layer')
+    lyrTMC = arcpy.MakeFeatureLayer_management(config.TMCs, 'tmcs').getOutput(0)
+
+    print('  Get list of RTE_NMs near TMCs')
+    arcpy.SelectLayerByLocation_management(lyrLRS, 'WITHIN_A_DISTANCE', lyrTMC, '10 METERS', 'NEW_SELECTION')
+    rte_nms = [row[0] for row in arcpy.da.SearchCursor(lyrLRS, 'RTE_NM')]
+
+    rte_int_dict, rebuild = load_existing_dict(rte_nms)
+    if len(rebuild) == 0:
+        print('  No routes to rebuild')
+        return
+
+    rebuild = list(rebuild)
+    if len(rebuild) == 1:
+        rebuild.append('') # To fix bug when creating valid sql statement when only one Id exists
+    sql = f"RTE_NM IN {tuple(rebuild)}"
+
+
+    # Fixes bug where arcpy won't recognize this layer for selection unless its referenced elsewhere first
+    with arcpy.da.SearchCursor(lyrIntersections, 'SHAPE@') as cur:
+        for row in cur:
+            break
+
+    # Create and load route intersection dictionary
+    total = len([row for row in arcpy.da.SearchCursor(config.MASTER_LRS, 'RTE_NM', sql)])
+    with arcpy.da.SearchCursor(config.MASTER_LRS, ['RTE_NM','SHAPE@'], sql) as cur:
+        for i, row in enumerate(cur):
+            rte_nm, geom = row
+            ints = get_ints(geom, lyrIntersections)
+            rte_int_dict[rte_nm] = ints
+
+            lrs_tools.print_progress_bar(i+1, total, 'Building rte_int_dict')
+
+    with open(RTE_INT_DICT,'w') as file:
+        json.dump(rte_int_dict, file)
 
-        lrs_tools.print_progress_bar(i+1, total, 'Building rte_int_dict')
 
-with open('data//rte_int_dict.json','w') as file:
-    json.dump(rte_int_dict, file)
\ No newline at end of file
+if __name__ == '__main__':
+    print('\nCreating intersection dictionary')
+    create_intersection_dictionary()
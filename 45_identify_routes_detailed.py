@@ -2,12 +2,19 @@ import arcpy
 import lrs_tools
 import config
 import json
-from collections import Counter
+import os
+import numpy as np
 import pandas as pd
-import logging
-import traceback
+import trace_log
 from datetime import datetime
-import geopandas as gp
+import lrs_model
+from route_votes import RouteVotes
+import incremental
+from geometry_store import GeometryStore
+from route_graph import RouteGraph, chain_routes
+from map_matching import HMMMatcher
+import instrumentation
+import storage
 
 """ All of the straight-forward TMCs have already been matched in the previous steps.
 The remainder falls into three main categories:
@@ -25,23 +32,25 @@ This script will attempt to match routes using a more detailed and time consumin
         need to be manually matched to the LRS or they may not exist in the LRS.
 """
 
-log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG) # Set the debug level here
-fileHandler = logging.FileHandler('logs\\45_identify_routes_detailed.log', mode='w')
-log.addHandler(fileHandler)
+log = trace_log.get_logger(__name__, '45_identify_routes_detailed')
+
+CHUNK_SIZE = 500  # TMCs whose sample points are searched for nearby routes together
 
 
 
 
 
 class TMC():
-    def __init__(self, tmc_id):
+    def __init__(self, tmc_id, store):
         self.tmc = str(tmc_id)
-        self.tmc_geom = [row[0] for row in arcpy.da.SearchCursor(config.TMCs, 'SHAPE@', f"tmc = '{self.tmc}'")][0]
+        self.tmc_geom = store.geometries[self.tmc]
         self.points = lrs_tools.get_points_along_line(self.tmc_geom, 30)  # Points along line every 30m used to identify nearby routes
+        self.xy = np.array([(point.firstPoint.X, point.firstPoint.Y) for point in self.points], dtype=np.float64).reshape(-1, 2)
+        # Short routes require a short search distance in order to find anything
+        self.search_distance = self.tmc_geom.getLength() / 4 if self.tmc_geom.getLength() < 18 else 9
         self.first_route = None  # The most common route for the first 3 points
         self.last_route = None  # The most common route for the last 3 points
-        self.routes = Counter()
+        self.routes = {}  # RTE_NM: votes
         self.mapped_routes = []  # Route objects that participate in this tmc that will be turned into event records
 
 
@@ -61,6 +70,8 @@ class Route():
 
     
     def locate_on_lrs(self, lyrLRS, lyrIntersections):
+        if self.begin_msr is not None and self.end_msr is not None:
+            return  # Already located by map matching
         self.begin_msr = lrs_tools.get_point_mp(self.begin_point, lyrLRS, self.rte_nm, lyrIntersections)
         self.end_msr = lrs_tools.get_point_mp(self.end_point, lyrLRS, self.rte_nm, lyrIntersections)
 
@@ -68,6 +79,51 @@ class Route():
         return f'<Route\trte_nm: {self.rte_nm}\t\t\tbegin_point: {(self.begin_point.firstPoint.X, self.begin_point.firstPoint.Y) if self.begin_point else None}\tend_point: {(self.end_point.firstPoint.X, self.end_point.firstPoint.Y) if self.end_point else None}>'
 
 
+@instrumentation.timed()
+def find_nearby_routes(tmcs, geopandas_lrs):
+    """ Finds the routes near every sample point of a chunk of TMCs with a single
+        spatial index query
+    Output:
+        votes - RouteVotes with one item per TMC, in order
+        first_routes / last_routes - the route id most common at the first 3 / last
+            2 points of each TMC, or -1 if no route was found there
+    """
+    xy = np.concatenate([tmc.xy for tmc in tmcs]) if tmcs else np.empty((0, 2))
+    point_items = np.repeat(np.arange(len(tmcs)), [len(tmc.xy) for tmc in tmcs])
+    distances = np.repeat([tmc.search_distance for tmc in tmcs], [len(tmc.xy) for tmc in tmcs])
+
+    instrumentation.count('spatial_queries')
+    votes = RouteVotes.from_points(geopandas_lrs, xy, point_items, distances, len(tmcs))
+
+    # Position of every point along its TMC
+    pt = np.arange(len(point_items)) - votes.point_starts[point_items]
+    n_points = np.diff(votes.point_starts)[point_items]
+    first_points = pt < 3  # Used to identify the first route along each TMC
+    last_points = pt > n_points - 3
+    return votes, votes.top_routes(first_points), votes.top_routes(last_points)
+
+
+def match_tmc_routes(tmc, map_matcher):
+    """ Maps a TMC to its routes with the HMM map matcher (config.MATCHING_MODE = 'hmm').
+        Returns Route objects, with measures if the matcher's LRS has M values """
+    xy = tmc.xy
+    last_point = (tmc.tmc_geom.lastPoint.X, tmc.tmc_geom.lastPoint.Y)
+    if len(xy) == 0 or np.hypot(*(xy[-1] - last_point)) > 1:
+        xy = np.vstack([xy, [last_point]])  # Make sure the TMC is matched all the way to its end
+
+    routes = []
+    for matched in map_matcher.match(xy):
+        log.debug('    %s', matched)
+        route = Route(tmc_id=tmc.tmc,
+                      rte_nm=matched.rte_nm,
+                      begin_point=arcpy.PointGeometry(arcpy.Point(*matched.begin_xy), spatial_reference=config.VIRGINIA_LAMBERT),
+                      end_point=arcpy.PointGeometry(arcpy.Point(*matched.end_xy), spatial_reference=config.VIRGINIA_LAMBERT))
+        route.begin_msr, route.end_msr = matched.begin_msr, matched.end_msr
+        routes.append(route)
+    return routes
+
+
+@instrumentation.timed('stage 45')
 def identify_routes_detailed(*test_TMCs, lyrLRS=None, lyrIntersections=None):
     """ Attempts to match TMCs to the correct RTE_NM(s) 
     
@@ -82,6 +138,7 @@ def identify_routes_detailed(*test_TMCs, lyrLRS=None, lyrIntersections=None):
                 parameter may save time, but it will be created if it does
                 not exist yet.
     """
+    storage.require_arcpy_backend('Stage 45')
         
     if not lyrLRS:
         print('  Creating MasterLRS layer')
@@ -90,10 +147,8 @@ def identify_routes_detailed(*test_TMCs, lyrLRS=None, lyrIntersections=None):
     print('  Building LRS Geometry Dictionary')
     lrs_geom_dict = {row[0]:row[1] for row in arcpy.da.SearchCursor(lyrLRS, ['RTE_NM', 'SHAPE@'])}
 
-    print('  Preparing LRS for GeoPandas')
-    lrsSHP = gp.read_file(config.LRS_SHP)
-    lrsSIndex = lrsSHP.sindex
-    geopandas_lrs = (lrsSHP, lrsSIndex)
+    print('  Loading compact LRS')
+    geopandas_lrs = lrs_model.load_lrs()
     
     if not lyrIntersections:
         print('  Creating Intersections layer')
@@ -111,10 +166,15 @@ def identify_routes_detailed(*test_TMCs, lyrLRS=None, lyrIntersections=None):
         tmcs = list(test_TMCs)
         if len(tmcs) == 1:
             tmcs.append('') # To fix bug when creating valid sql statement when only one Id exists
+        sql = f'tmc in {tuple(tmcs)}'
 
     else:
-        tmcs = [row[0] for row in arcpy.da.SearchCursor(config.TMCs, 'tmc', 'status is null')]
+        sql = 'status is null'
+        tmcs = [row[0] for row in arcpy.da.SearchCursor(config.TMCs, 'tmc', sql)]
+
 
+    print('  Loading TMC geometries')
+    store = GeometryStore.from_feature_class(config.TMCs, 'tmc', sql=sql, keep_geometry=True)  # Only the TMCs being matched
 
     try:
         with open('data\\rte_int_dict.json','r') as file:
@@ -124,129 +184,143 @@ def identify_routes_detailed(*test_TMCs, lyrLRS=None, lyrIntersections=None):
         rte_int_dict = None
     start = datetime.now()
 
-    # Identify RTE_NMs by tmc
+    route_int_cache = dict(rte_int_dict or {})
+    def route_intersections(rte_nm):
+        """ Intersections of a route, looked up once """
+        if rte_nm not in route_int_cache:
+            try:
+                route_int_cache[rte_nm] = lrs_tools.get_route_intersections(rte_nm, lyrLRS, lyrIntersections, rte_int_dict)
+            except Exception as e:
+                instrumentation.count('exceptions_swallowed')
+                log.debug('        Error finding intersections of %s: %s', rte_nm, e)
+                route_int_cache[rte_nm] = []
+        return route_int_cache[rte_nm]
+
+    map_matcher = None
+    if config.MATCHING_MODE == 'hmm':
+        print('  Using HMM map matching')
+        # The GeoPackage copy of the LRS keeps the M values, so the matcher can measure the routes itself
+        if not os.path.exists(config.COLUMNAR_DB):
+            raise ValueError(f'{config.COLUMNAR_DB} not found.  Run storage.py to copy the LRS into the GeoPackage')
+        measured_lrs = lrs_model.load_lrs(config.COLUMNAR_DB)
+        measured_lrs.require_measures()
+        map_matcher = HMMMatcher(measured_lrs, route_intersections)
+        print(f'  Measuring routes with the LRS M values in {config.COLUMNAR_DB}')
+    else:
+        print('  Measuring routes with lrs_tools.get_point_mp')
+    log.info('Measures from %s', config.COLUMNAR_DB if map_matcher else 'lrs_tools.get_point_mp')
+
+    # Identify RTE_NMs by tmc.  The sample points of a chunk of TMCs are searched together
     total = len(tmcs) - 1
     output = []
-    for i, tmc_id in enumerate(tmcs):
-        try:
-            log.debug(f'\n\nTMC: {tmc_id}')
-            tmc = TMC(tmc_id)
-
-            # Identify nearby routes for each 15m along the tmc
-            nearby_routes = []
-            first_routes = Counter() # Used to identify the first route along this TMC
-            last_routes = Counter()
-            for pt, point in enumerate(tmc.points):
-                routes = lrs_tools.find_nearby_routes_geopandas(point, geopandas_lrs, tmc.tmc_geom)
-                nearby_routes.extend(routes)
-                if pt < 3:
-                    for route in routes:
-                        first_routes[route] += 1
-                if pt > len(tmc.points) - 3:
-                    for route in routes:
-                        last_routes[route] += 1
-                        
-            tmc.routes.update(nearby_routes)
-            all_potential_routes = [route for route in tmc.routes if tmc.routes[route] > 1]
-            log.debug(f'    All Nearby Routes: {nearby_routes}')
-            log.debug(f'    {len(all_potential_routes)} potential routes found:')
-            log.debug(f'        Potential Routes: {all_potential_routes}')
-            
-
-            # Identify first route
-            tmc.first_route = lrs_tools.get_most_common(first_routes)[0][0]
-            tmc.mapped_routes.append(Route(
-                                        tmc_id=tmc_id, 
-                                        rte_nm=tmc.first_route,
-                                        begin_point=arcpy.PointGeometry(tmc.tmc_geom.firstPoint, 
-                                                                        spatial_reference=config.VIRGINIA_LAMBERT)
-                                        )
-                                    )
-            # Identify last route
-            tmc.last_route = lrs_tools.get_most_common(last_routes)[0][0]
-
-            log.debug(f'    {tmc.first_route} identified as the first route')
-            log.debug(f'    {tmc.last_route} identified as the last route')
-
-            # All potential routes must share an intersection with 2 other potential routes, except begin and end routes
-            log.debug('        Finding common intersection counts for each potential route:')
-            potential_routes = []
-            for route in all_potential_routes:
-                common_intersection_count = 0
-                for rte in all_potential_routes:
-                    if route == rte:
-                        continue
-                    common_intersection = lrs_tools.find_common_intersection(route, rte, lyrLRS, lyrIntersections, tmc, rte_int_dict)
-                    if common_intersection:
-                        common_intersection_count += 1
-                
-                log.debug(f'            {route}: {common_intersection_count} common intersections')
-                if common_intersection_count >=2:
-                    potential_routes.append(route)
-            
-
-            log.debug(f'        Potential Routes: {potential_routes}')
-            if tmc.first_route in potential_routes:
-                potential_routes.remove(tmc.first_route)
-            if tmc.last_route not in potential_routes:
-                potential_routes.append(tmc.last_route)
-
-
-            current_route = tmc.mapped_routes[0]  # The route that will be used to find the next route in the sequence
-            while True:
-                for route in potential_routes:
-                    common_intersection = lrs_tools.find_common_intersection(current_route.rte_nm, route, lyrLRS, lyrIntersections, tmc, rte_int_dict)
-                    if common_intersection:
+    for chunk_start in range(0, len(tmcs), CHUNK_SIZE):
+        chunk = []
+        for tmc_id in tmcs[chunk_start:chunk_start + CHUNK_SIZE]:
+            trace_log.set_tmc(tmc_id)
+            try:
+                log.debug('\n\nTMC: %s', tmc_id)
+                chunk.append(TMC(tmc_id, store))
+            except Exception as e:
+                instrumentation.count('exceptions_swallowed')
+                log.debug('\nError on %s', tmc_id)
+                log.debug(e)
+                log.debug('', exc_info=True)
+
+        # Identify nearby routes for each 30m along the tmcs
+        votes, first_routes, last_routes = find_nearby_routes(chunk, geopandas_lrs)
+
+        for item, tmc in enumerate(chunk):
+            tmc_id = tmc.tmc
+            trace_log.set_tmc(tmc_id)
+            try:
+                nearby_routes = votes.route_names(item)
+                first_points = np.arange(len(tmc.points)) < 3
+
+                tmc.routes = votes.counts(item)
+                all_potential_routes = [route for route in tmc.routes if tmc.routes[route] > 1]
+                log.debug('    All Nearby Routes: %s', nearby_routes)
+                log.debug('    %s potential routes found:', len(all_potential_routes))
+                log.debug('        Potential Routes: %s', all_potential_routes)
+
+                if map_matcher:
+                    tmc.mapped_routes = match_tmc_routes(tmc, map_matcher)
+                    potential_routes = [route.rte_nm for route in tmc.mapped_routes]
+                else:
+                    if first_routes[item] < 0 or last_routes[item] < 0:
+                        raise LookupError(f'No routes found near the ends of {tmc_id}')
+
+                    # Identify first route
+                    tmc.first_route = votes.names[first_routes[item]]
+                    tmc.mapped_routes.append(Route(
+                                                tmc_id=tmc_id, 
+                                                rte_nm=tmc.first_route,
+                                                begin_point=arcpy.PointGeometry(tmc.tmc_geom.firstPoint, 
+                                                                                spatial_reference=config.VIRGINIA_LAMBERT)
+                                                )
+                                            )
+                    # Identify last route
+                    tmc.last_route = votes.names[last_routes[item]]
+
+                    log.debug('    %s identified as the first route', tmc.first_route)
+                    log.debug('    %s identified as the last route', tmc.last_route)
+
+                    # All potential routes must share an intersection with 2 other potential routes, except begin and end routes
+                    graph = RouteGraph(all_potential_routes + [tmc.first_route, tmc.last_route], route_intersections)
+                    potential_routes = [route for route in all_potential_routes if graph.degree(route, all_potential_routes) >= 2]
+                    if trace_log.enabled(log):
+                        log.debug('        Common intersection counts for each potential route:')
+                        for route in all_potential_routes:
+                            log.debug('            %s: %s common intersections', route, graph.degree(route, all_potential_routes))
+                    log.debug('        Potential Routes: %s', potential_routes)
+
+                    # Chain the routes from the first route to the last route through shared intersections
+                    def resolve(route, next_route, shared):
+                        return lrs_tools.find_common_intersection(route, next_route, lyrLRS, lyrIntersections, tmc, rte_int_dict)
+
+                    chain = chain_routes(graph, tmc.first_route, tmc.last_route, set(potential_routes), resolve)
+                    if chain is None:
+                        # Leave the TMC unmatched for review rather than map it all to the first route
+                        instrumentation.count('unchained_tmcs')
+                        raise LookupError(f'No chain of routes from {tmc.first_route} to {tmc.last_route} for {tmc_id}')
+                    for rte_nm, common_intersection in chain[1:]:
                         common_intersection_geom = intersections_geom_dict[common_intersection]
-                        current_route.end_point = common_intersection_geom
-                        next_route = Route(tmc_id=tmc_id, rte_nm=route, begin_point=common_intersection_geom)
-                        
-                        tmc.mapped_routes.append(next_route)
-
-                        log.debug(f'    {next_route.rte_nm} identified as the next route')
-                        potential_routes.remove(route)
-                        log.debug(f'        Potential Routes: {potential_routes}')
-                        break
-                    
-
-                if current_route == tmc.mapped_routes[-1]:
-                    break
+                        tmc.mapped_routes[-1].end_point = common_intersection_geom
+                        tmc.mapped_routes.append(Route(tmc_id=tmc_id, rte_nm=rte_nm, begin_point=common_intersection_geom))
+                        log.debug('    %s identified as the next route', rte_nm)
 
-                current_route = tmc.mapped_routes[-1]
+                    if tmc.mapped_routes[-1].end_point == None:
+                        tmc.mapped_routes[-1].end_point = arcpy.PointGeometry(tmc.tmc_geom.lastPoint, spatial_reference=config.VIRGINIA_LAMBERT)
 
-            if tmc.mapped_routes[-1].end_point == None:
-                tmc.mapped_routes[-1].end_point = arcpy.PointGeometry(tmc.tmc_geom.lastPoint, spatial_reference=config.VIRGINIA_LAMBERT)
 
+                log.debug('\n  Nearby Routes: %s', tmc.routes)
+                log.debug('  Potential Routes: %s', potential_routes)
+                log.debug('  First Routes: %s', votes.counts(item, points=first_points))
+                log.debug('  Mapped Routes:')
+                for route in tmc.mapped_routes:
+                    route.locate_on_lrs(lyrLRS, lyrIntersections)
+                    if route.begin_msr == route.end_msr:
+                        continue
 
+                    output_event = {
+                        'tmc': tmc_id,
+                        'rte_nm': route.rte_nm,
+                        'begin_msr': route.begin_msr,
+                        'end_msr': route.end_msr,
+                        'status': 'Complete (45)'
+                    }
+                    log.debug(route)
+                    output.append(output_event)
 
 
-            log.debug(f'\n  Nearby Routes: {Counter(nearby_routes)}')
-            log.debug(f'  Potential Routes: {potential_routes}')
-            log.debug(f'  First Routes: {first_routes}')
-            log.debug(f'  Mapped Routes:')
-            for route in tmc.mapped_routes:
-                route.locate_on_lrs(lyrLRS, lyrIntersections)
-                if route.begin_msr == route.end_msr:
-                    continue
-
-                output_event = {
-                    'tmc': tmc_id,
-                    'rte_nm': route.rte_nm,
-                    'begin_msr': route.begin_msr,
-                    'end_msr': route.end_msr,
-                    'status': 'Complete (45)'
-                }
-                log.debug(route)
-                output.append(output_event)
-
-
-        except Exception as e:
-            log.debug(f'\nError on {tmc_id}')
-            log.debug(e)
-            log.debug(traceback.format_exc())
+            except Exception as e:
+                instrumentation.count('exceptions_swallowed')
+                log.debug('\nError on %s', tmc_id)
+                log.debug(e)
+                log.debug('', exc_info=True)
 
-        lrs_tools.print_progress_bar(i, total, 'Identifying RTE_NMs by tmc (detailed)')
+            lrs_tools.print_progress_bar(chunk_start + item, total, 'Identifying RTE_NMs by tmc (detailed)')
 
+    trace_log.set_tmc(None)
     print('\n')
 
     # For rte_nms that were successfully identified, find the begin_msr and end_msr values
@@ -258,6 +332,11 @@ def identify_routes_detailed(*test_TMCs, lyrLRS=None, lyrIntersections=None):
     row_count = len(list(i for i in arcpy.da.SearchCursor(config.TMCs, 'tmc', f"tmc in {tuple(completeIds)}")))
 
     df = pd.DataFrame(output)
+    carried = incremental.load_carried_events()
+    if carried is not None:
+        # Events of unchanged TMCs carried forward from the last run
+        carried['status'] = 'Complete (45)'
+        df = pd.concat([df, carried], ignore_index=True)
     df.to_csv('data//_45_output.csv', index=False)
     
     with arcpy.da.UpdateCursor(config.TMCs, ['tmc', 'status', 'rte_nm'], f"tmc in {tuple(completeIds)}") as cur:
@@ -267,7 +346,8 @@ def identify_routes_detailed(*test_TMCs, lyrLRS=None, lyrIntersections=None):
                     row[1] = 'Complete (45)'
                     cur.updateRow(row)
                 except Exception as e:
-                    log.debug(f'Error updating {row[0]} in TMCs table')
+                    instrumentation.count('exceptions_swallowed')
+                    log.debug('Error updating %s in TMCs table', row[0])
                     log.debug(e)
 
            
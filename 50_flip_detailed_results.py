@@ -1,7 +1,9 @@
 import flip_routes
 import arcpy
 import config
+import instrumentation
 
+@instrumentation.timed('stage 50')
 def flip_routes_again():
     # Make event layer from output of 45_identify_routes_detailed
     arcpy.env.overwriteOutput = True
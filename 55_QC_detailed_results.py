@@ -2,8 +2,12 @@ from AutoQC import run_AutoQC
 import arcpy
 import config
 import pandas as pd
+import instrumentation
+import storage
 
+@instrumentation.timed('stage 55')
 def run_AutoQC_55():
+    storage.require_arcpy_backend('Stage 55')
     run_AutoQC('_55', feature_class='data/scrap.gdb/_50_tmc_events')
 
     print('\nResetting failed QC results')
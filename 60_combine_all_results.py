@@ -1,11 +1,14 @@
 import arcpy
 import os
 import config
+import instrumentation
+import storage
 
 gdb_path = os.path.join(os.getcwd(), 'data/final_output.gdb')
 path_tmcs_complete = os.path.join(gdb_path, 'tmc_complete')
 path_tmcs_failed = os.path.join(gdb_path, 'tmc_failed')
 
+@instrumentation.timed('stage 60.create_output_tables')
 def create_output_tables():
     # Create output gdb
     if not os.path.exists(gdb_path):
@@ -30,7 +33,9 @@ def create_output_tables():
     arcpy.AddField_management(path_tmcs_failed, 'Comment', 'TEXT', 500)
 
 
+@instrumentation.timed('stage 60.add_complete_tmcs')
 def add_complete_tmcs():
+    storage.require_arcpy_backend('Stage 60')
     print('  Adding complete tmcs to final_output.gdb')
 
     sql = "status IN ('Complete (10)', 'Complete (10) - Flipped (35)', 'Complete (20)', 'Complete (20) - Flipped (35)', 'Complete (30)', 'Complete (30) - Flipped (35)')"
@@ -58,7 +63,9 @@ def add_complete_tmcs():
 
     
 
+@instrumentation.timed('stage 60.add_failed_tmcs')
 def add_failed_tmcs():
+    storage.require_arcpy_backend('Stage 60')
     print('  Adding failed tmcs to final_output.gdb')
     fields = ['tmc', 'rte_nm', 'begin_msr', 'end_msr']
 
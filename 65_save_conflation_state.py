@@ -0,0 +1,17 @@
+""" Saves the TMC hashes, final events, and QC results of this run so the next
+    run can carry forward unchanged TMCs (8_carry_forward_unchanged_tmcs.py)
+"""
+import incremental
+import instrumentation
+import storage
+
+
+@instrumentation.timed('stage 65')
+def save_conflation_state():
+    storage.require_arcpy_backend('Stage 65')
+    incremental.save_state()
+
+
+if __name__ == '__main__':
+    print('\nSaving conflation state')
+    save_conflation_state()
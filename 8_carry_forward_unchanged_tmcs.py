@@ -0,0 +1,20 @@
+""" Incremental mode: TMCs whose geometry and key attributes (linearId, linearTmc,
+    roadNumber, roadName) haven't changed since the last run get their previous
+    status, events, and QC results back.  Steps 10-55 only match TMCs with a null
+    status, so only new or changed TMCs are matched again.  See incremental.py
+"""
+import incremental
+import instrumentation
+import storage
+
+
+@instrumentation.timed('stage 8')
+def carry_forward_unchanged_tmcs():
+    storage.require_arcpy_backend('Stage 8')
+    count = incremental.carry_forward()
+    print(f'  Carried forward {count} TMCs')
+
+
+if __name__ == '__main__':
+    print('\nCarrying forward unchanged TMCs')
+    carry_forward_unchanged_tmcs()
@@ -1,8 +1,10 @@
 import arcpy
-import logging
+import trace_log
 import pandas as pd
 import config
 import lrs_tools
+import incremental
+import instrumentation
 
 """
 Compare the following to create a confidence score:
@@ -17,10 +19,7 @@ Compare the following to create a confidence score:
 
 """
 
-log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG) # Set the debug level here
-fileHandler = logging.FileHandler(f'logs\AutoQC.log', mode='w')
-log.addHandler(fileHandler)
+log = trace_log.get_logger(__name__, 'AutoQC')
 
 def hausdorff_distance(geom1, geom2, normalized):
     distances = []
@@ -54,6 +53,7 @@ def is_similar_shape(geom1, geom2, normalized=False):
         return False, hausdorff
 
 
+@instrumentation.timed()
 def is_similar_shape_MSE(testGeom, sourceGeom):
     distances = []
     for part in testGeom:
@@ -73,6 +73,7 @@ def get_bearing(begin, end):
     return round(begin.angleAndDistanceTo(end, 'PLANAR')[0])
 
 
+@instrumentation.timed()
 def compare_bearing(XDGeom, geom2, part):
     XDGeom_Begin = arcpy.PointGeometry(XDGeom.firstPoint)
     XDGeom_End = arcpy.PointGeometry(XDGeom.lastPoint)
@@ -128,6 +129,7 @@ def add_confidence_field(conflationLayer, scores):
     
 
 
+@instrumentation.timed()
 def get_confidence_score(tmc, TMCGeom, conflationGeom):
     """
     
@@ -188,44 +190,45 @@ def get_confidence_score(tmc, TMCGeom, conflationGeom):
 
 
 
-    log.debug(f'      Length Comparison:')
-    log.debug(f'        totalLengthDifference: {totalLengthDifference}m ({TMCLen}m [TMC] - {conflationLen}m [Conflation])')
-    log.debug(f'        totalLengthRatio: {totalLengthRatio}')
-    log.debug(f'        isSimilarLength: {isSimilarLength}')
+    log.debug('      Length Comparison:')
+    log.debug('        totalLengthDifference: %sm (%sm [TMC] - %sm [Conflation])', totalLengthDifference, TMCLen, conflationLen)
+    log.debug('        totalLengthRatio: %s', totalLengthRatio)
+    log.debug('        isSimilarLength: %s', isSimilarLength)
 
-    log.debug(f'\n      Shape Comparison:')
-    log.debug(f'        isSimilarShape: {isSimilarShape} (MSE: {MSE}m)')
+    log.debug('\n      Shape Comparison:')
+    log.debug('        isSimilarShape: %s (MSE: %sm)', isSimilarShape, MSE)
 
-    log.debug(f'\n      Location Comparison:')
-    log.debug(f'        TMC Centroid: {XDCentroid.firstPoint.X}, {XDCentroid.firstPoint.Y}')
-    log.debug(f'        Conflation Centroid: {conflationCentroid.firstPoint.X}, {conflationCentroid.firstPoint.Y}')    
-    log.debug(f'        centroidDifference: {centroidDifference}m')
+    log.debug('\n      Location Comparison:')
+    log.debug('        TMC Centroid: %s, %s', XDCentroid.firstPoint.X, XDCentroid.firstPoint.Y)
+    log.debug('        Conflation Centroid: %s, %s', conflationCentroid.firstPoint.X, conflationCentroid.firstPoint.Y)    
+    log.debug('        centroidDifference: %sm', centroidDifference)
 
-    log.debug(f'\n      Bearing Comparison:')
-    log.debug(f'        segmentBearing_Total: {segmentBearing_Total} (TMC: {XDBearing_Total}, Conflation: {ConflationBearing_Total})')
-    log.debug(f'        segmentBearing_FirstHalf: {segmentBearing_FirstHalf} (TMC: {XDBearing_First}, Conflation: {ConflationBearing_First})')
-    log.debug(f'        segmentBearing_SecondHalf: {segmentBearing_SecondHalf} (TMC: {XDBearing_Second}, Conflation: {ConflationBearing_Second})')
-    log.debug(f'        isSimilarBearing: {isSimilarBearing}')
+    log.debug('\n      Bearing Comparison:')
+    log.debug('        segmentBearing_Total: %s (TMC: %s, Conflation: %s)', segmentBearing_Total, XDBearing_Total, ConflationBearing_Total)
+    log.debug('        segmentBearing_FirstHalf: %s (TMC: %s, Conflation: %s)', segmentBearing_FirstHalf, XDBearing_First, ConflationBearing_First)
+    log.debug('        segmentBearing_SecondHalf: %s (TMC: %s, Conflation: %s)', segmentBearing_SecondHalf, XDBearing_Second, ConflationBearing_Second)
+    log.debug('        isSimilarBearing: %s', isSimilarBearing)
 
-    log.debug(f'\n      Subtraction List: {subtraction}')
-    log.debug(f'  Confidence Score: {finalScore}')
+    log.debug('\n      Subtraction List: %s', subtraction)
+    log.debug('  Confidence Score: %s', finalScore)
 
     return isSimilarLength, isSimilarShape, centroidDifference, isSimilarBearing, finalScore
 
 
-def run_AutoQC(conflationName, feature_class=None):
+@instrumentation.timed()
+def run_AutoQC(conflationName, feature_class=None, sql=None):
+    """ sql - optional where clause to only check some TMCs (eg golden_check.py) """
     if not feature_class:
         feature_class = config.TMCs
     
-    fileHandler = logging.FileHandler(f'logs\{conflationName}_AutoQC.log', mode='w')
-    log.addHandler(fileHandler)
+    trace_log.get_logger(__name__, f'{conflationName}_AutoQC')
 
     conflation = r'memory\conflation'
 
     arcpy.env.overwriteOutput = True
 
     print('  Making event layer')
-    arcpy.TableToTable_conversion(feature_class, 'memory', 'tbl_tmc')
+    arcpy.TableToTable_conversion(feature_class, 'memory', 'tbl_tmc', sql)
     arcpy.MakeRouteEventLayer_lr(config.OVERLAP_LRS, 'RTE_NM', 'memory/tbl_tmc', "rte_nm; Line; begin_msr; end_msr", 'tbl_tmc_events')
     arcpy.FeatureClassToFeatureClass_conversion('tbl_tmc_events', 'data/scrap.gdb','tmc_events')
     inputConflation = 'data/scrap.gdb/tmc_events'
@@ -245,10 +248,18 @@ def run_AutoQC(conflationName, feature_class=None):
     
     print('  Building ConflationGeomDict')
     ConflationGeomDict = {row[0]: row[1] for row in arcpy.da.SearchCursor(conflation, ['tmc','SHAPE@'])}
+
+    # Results for TMCs carried forward from the last run (see incremental.py)
+    carried_scores = incremental.load_carried_scores()
  
     output = []
     for i, tmc in enumerate(tmcs):
-        log.debug(f'\n\n=== Processing {tmc} ===')
+        if tmc in carried_scores:
+            output.append(carried_scores[tmc])
+            continue
+
+        trace_log.set_tmc(tmc)
+        log.debug('\n\n=== Processing %s ===', tmc)
 
         # Get geometries
         TMCGeom = TMCGeomDict[tmc]
@@ -268,6 +279,7 @@ def run_AutoQC(conflationName, feature_class=None):
         output.append(record)
         lrs_tools.print_progress_bar(i+1, len(tmcs), 'Comparing conflation geometry to source geometry')
 
+    trace_log.set_tmc(None)
     outputCSV = f'data//{conflationName}_AutoQC.csv'
     print(f'  Saving output CSV to {outputCSV}')    
     df = pd.DataFrame(output)
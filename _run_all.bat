@@ -13,6 +13,7 @@
 "C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 50_flip_detailed_results.py
 "C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 55_QC_detailed_results.py
 "C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 60_combine_all_results.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 65_save_conflation_state.py
 
 
 pause
\ No newline at end of file
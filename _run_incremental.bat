@@ -0,0 +1,20 @@
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 0_initial_setup.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 7_download_tmcs_wGDAL.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 8_carry_forward_unchanged_tmcs.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 10_identify_routes_by_linearId_simple.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 20_identify_routes_by_linearTmc_simple.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 25_flip_routes_by_linearId_and_linearTMC.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 27_AutoQC.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 30_map_route_numbers_to_lrs_routes.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 31_identify_routes_by_number_name.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 35_flip_again.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 40_AutoQC.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 43_create_intersection_dictionary.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 45_identify_routes_detailed.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 50_flip_detailed_results.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 55_QC_detailed_results.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 60_combine_all_results.py
+"C:\ArcGIS_Python\arcgispro-py3-fourquet\python.exe" 65_save_conflation_state.py
+
+
+pause
\ No newline at end of file
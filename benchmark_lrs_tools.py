@@ -0,0 +1,246 @@
+""" Micro-benchmarks for the hot functions in lrs_tools.py and AutoQC.py.
+
+    Fixture geometries come from a small synthetic network (see
+    synthetic_data.py), so every run measures the same inputs.  Each case is
+    called repeatedly, cycling through its fixtures, and the latency of every
+    call is recorded.  The results (min, median, p90, p99, mean in
+    microseconds) are compared to a stored baseline.  A case regresses when its
+    median is more than threshold (default 25%) slower than the baseline median.
+
+    Usage:
+        python benchmark_lrs_tools.py                    - compare to the baseline
+        python benchmark_lrs_tools.py --update-baseline  - save this run as the baseline
+        python benchmark_lrs_tools.py --cases get_line_mp,get_most_common --calls 500
+
+    Exit codes:
+        0 - every case was timed and none regressed
+        1 - at least one case regressed
+        2 - the check couldn't be made: nothing was timed (eg arcpy isn't
+            installed), there is no baseline, or a timed case isn't in the
+            baseline
+
+    Baselines depend on the machine, so they aren't kept in the repo.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import numpy as np
+import shapely
+from shapely.ops import substring
+
+import config
+import lrs_model
+import projection
+import tmc_geometry
+from benchmark_pipeline import prepare_workspace
+
+BASELINE = os.path.abspath('benchmark_lrs_tools_baseline.json')
+WORK_DIR = os.path.join('data', 'benchmark_lrs_tools')
+FIXTURE_COUNT = 50
+EXIT_REGRESSION = 1
+EXIT_NOT_CHECKED = 2
+
+
+def arcpy_polyline(xy, arcpy):
+    return arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in xy]), config.VIRGINIA_LAMBERT)
+
+
+def build_fixtures(network, fixture_count=FIXTURE_COUNT):
+    """ Returns the fixtures shared by all cases: TMC and conflation geometries,
+        mid-points, matched routes, route pairs that share an intersection, and
+        the LRS layers """
+    import arcpy
+
+    tmcs = network['tmcs']
+    truth = network['truth']
+    single = truth.groupby('tmc').filter(lambda events: len(events) == 1)
+    master_routes = set(network['master_lrs']['RTE_NM'])
+    single = single.loc[single['rte_nm'].isin(master_routes)]
+    rng = np.random.default_rng(0)
+    chosen = single.iloc[rng.choice(len(single), size=min(fixture_count, len(single)), replace=False)]
+
+    xy, offsets = tmc_geometry.parse_coordinates(tmcs['coordinates'])
+    xy = projection.project_xy(xy, config.WGS84_WKID, config.VIRGINIA_LAMBERT_WKID)
+    rows = {tmc: i for i, tmc in enumerate(tmcs['tmc'])}
+    route_lines = dict(zip(network['master_lrs']['RTE_NM'], shapely.force_2d(network['master_lrs'].geometry.values)))
+
+    fixtures = SimpleNamespace(tmc_geoms=[], conflation_geoms=[], mid_points=[], rte_nms=[], route_pairs=[])
+    for event in chosen.itertuples():
+        row = rows[event.tmc]
+        tmc_xy = xy[offsets[row]:offsets[row + 1]]
+        route = route_lines[event.rte_nm]
+        # The matching stretch of the LRS route stands in for the conflation geometry
+        start, end = sorted(shapely.line_locate_point(route, shapely.points(tmc_xy[[0, -1]])))
+        conflation = substring(route, start, end)
+
+        geom = arcpy_polyline(tmc_xy, arcpy)
+        fixtures.tmc_geoms.append(geom)
+        fixtures.conflation_geoms.append(arcpy_polyline(np.asarray(conflation.coords), arcpy))
+        fixtures.mid_points.append(geom.positionAlongLine(0.5, True))
+        fixtures.rte_nms.append(event.rte_nm)
+
+    # Route pairs that share an intersection, and the route intersection dictionary
+    intersections = network['intersections']
+    lines = np.array(list(route_lines.values()))
+    names = np.array(list(route_lines.keys()))
+    point_index, route_index = shapely.STRtree(lines).query(intersections.geometry.values, predicate='dwithin', distance=5)
+    rte_int_dict = {}
+    for point, route in zip(point_index, route_index):
+        rte_int_dict.setdefault(names[route], []).append(int(intersections['INTERSECTION_ID'].iloc[point]))
+    by_point = {}
+    for point, route in zip(point_index, route_index):
+        by_point.setdefault(point, []).append(names[route])
+    for point, routes in by_point.items():
+        for pair in itertools.combinations(sorted(routes), 2):
+            fixtures.route_pairs.append(pair)
+    fixtures.rte_int_dict = rte_int_dict
+    fixtures.route_pairs = fixtures.route_pairs[:fixture_count]
+
+    fixtures.geopandas_lrs = lrs_model.load_lrs(cache=False)
+    fixtures.lyrLRS = arcpy.MakeFeatureLayer_management(config.MASTER_LRS, 'benchmark_lrs').getOutput(0)
+    fixtures.lyrIntersections = arcpy.MakeFeatureLayer_management(config.INTERSECTIONS, 'benchmark_intersections').getOutput(0)
+    return fixtures
+
+
+def cases(fixtures):
+    """ Returns {name: (function, list of argument tuples)} """
+    import AutoQC
+    import lrs_tools
+
+    tmc_stubs = [SimpleNamespace(tmc_geom=geom) for geom in fixtures.tmc_geoms]
+    counters = [Counter(np.random.default_rng(i).integers(0, 12, size=15).astype(str)) for i in range(FIXTURE_COUNT)]
+
+    return {
+        'find_nearby_routes_geopandas': (lrs_tools.find_nearby_routes_geopandas,
+            [(point, fixtures.geopandas_lrs) for point in fixtures.mid_points]),
+        'get_points_along_line': (lrs_tools.get_points_along_line,
+            [(geom, 30) for geom in fixtures.tmc_geoms]),
+        'get_line_mp': (lrs_tools.get_line_mp,
+            [(geom, config.MASTER_LRS, rte_nm) for geom, rte_nm in zip(fixtures.tmc_geoms, fixtures.rte_nms)]),
+        'get_point_mp': (lrs_tools.get_point_mp,
+            [(point, fixtures.lyrLRS, rte_nm, fixtures.lyrIntersections) for point, rte_nm in zip(fixtures.mid_points, fixtures.rte_nms)]),
+        'move_to_closest_int': (lrs_tools.move_to_closest_int,
+            [(point, fixtures.lyrIntersections) for point in fixtures.mid_points]),
+        'find_common_intersection': (lrs_tools.find_common_intersection,
+            [(a, b, fixtures.lyrLRS, fixtures.lyrIntersections, stub, fixtures.rte_int_dict) for (a, b), stub in zip(fixtures.route_pairs, itertools.cycle(tmc_stubs))]),
+        'get_most_common': (lrs_tools.get_most_common,
+            [(counter,) for counter in counters]),
+        'get_confidence_score': (AutoQC.get_confidence_score,
+            [('tmc', geom, conflation) for geom, conflation in zip(fixtures.tmc_geoms, fixtures.conflation_geoms)]),
+        'is_similar_shape_MSE': (AutoQC.is_similar_shape_MSE,
+            [(conflation, geom) for geom, conflation in zip(fixtures.tmc_geoms, fixtures.conflation_geoms)]),
+        'compare_bearing': (AutoQC.compare_bearing,
+            [(geom, conflation, 'Total') for geom, conflation in zip(fixtures.tmc_geoms, fixtures.conflation_geoms)])
+    }
+
+
+def time_case(function, arguments, calls=200, warmup=5):
+    """ Calls function calls times, cycling through arguments.  Returns latency
+        statistics in microseconds """
+    arguments = itertools.cycle(arguments)
+    for _ in range(warmup):
+        function(*next(arguments))
+
+    latencies = np.empty(calls)
+    for i in range(calls):
+        args = next(arguments)
+        start = time.perf_counter_ns()
+        function(*args)
+        latencies[i] = (time.perf_counter_ns() - start) / 1000
+
+    return {
+        'calls': calls,
+        'min_us': round(float(latencies.min()), 1),
+        'median_us': round(float(np.median(latencies)), 1),
+        'p90_us': round(float(np.percentile(latencies, 90)), 1),
+        'p99_us': round(float(np.percentile(latencies, 99)), 1),
+        'mean_us': round(float(latencies.mean()), 1)
+    }
+
+
+def compare_to_baseline(results, baseline, threshold=0.25):
+    """ Returns (names of the cases whose median is more than threshold slower
+        than the baseline median, names of the cases missing from the baseline) """
+    regressions = []
+    missing = []
+    for name, stats in results.items():
+        if name not in baseline:
+            stats['change'] = None
+            missing.append(name)
+            continue
+        change = stats['median_us'] / baseline[name]['median_us'] - 1
+        stats['change'] = round(change, 3)
+        if change > threshold:
+            regressions.append(name)
+    return regressions, missing
+
+
+def run_benchmarks(names=None, calls=200):
+    cwd = os.getcwd()
+    try:
+        network = prepare_workspace(WORK_DIR, scale=1, seed=0)
+        try:
+            fixtures = build_fixtures(network)
+            benchmark_cases = cases(fixtures)
+        except ImportError as e:
+            print(f'  Skipping all cases: {e}')
+            return {}
+
+        results = {}
+        for name, (function, arguments) in benchmark_cases.items():
+            if names and name not in names:
+                continue
+            print(f'  Timing {name}')
+            results[name] = time_case(function, arguments, calls)
+        return results
+    finally:
+        os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for lrs_tools and AutoQC')
+    parser.add_argument('--cases', help='comma separated case names.  Defaults to all')
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown of the median, eg 0.25 for 25%%')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    print('\nBenchmarking lrs_tools')
+    results = run_benchmarks(args.cases.split(',') if args.cases else None, args.calls)
+
+    if not results:
+        print('  Nothing was timed' + ('.  The baseline was not changed' if args.update_baseline else ''))
+        sys.exit(EXIT_NOT_CHECKED)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'  Saved baseline to {args.baseline}')
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print(f'  No baseline found at {args.baseline}.  Run with --update-baseline to create one')
+        sys.exit(EXIT_NOT_CHECKED)
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+
+    regressions, missing = compare_to_baseline(results, baseline, args.threshold)
+    print()
+    for name, stats in results.items():
+        change = f'{stats["change"]:+.0%}' if stats.get('change') is not None else 'n/a'
+        print(f'  {name:30s} median {stats["median_us"]:>10.1f}us  p90 {stats["p90_us"]:>10.1f}us  vs baseline {change}')
+
+    if regressions:
+        print(f'\n  Regressions beyond {args.threshold:.0%}: {", ".join(regressions)}')
+        sys.exit(EXIT_REGRESSION)
+    if missing:
+        print(f'\n  Not in the baseline: {", ".join(missing)}.  Run with --update-baseline to add them')
+        sys.exit(EXIT_NOT_CHECKED)
@@ -0,0 +1,219 @@
+""" End-to-end benchmark of the pipeline on a synthetic network.
+
+    A synthetic network (see synthetic_data.py) is written to a scratch folder,
+    config.py is pointed at it, and each stage is run in order the same way the
+    _run_all.bat files run them.  For every stage the benchmark records:
+        seconds - wall time
+        tmcs_per_second - all TMCs in the network divided by seconds
+        peak_mb - the peak resident memory of the process while the stage ran,
+            sampled by a background thread.  Allocations aren't traced, so the
+            timings are the same as in a real run
+        complete - the number of TMCs with a Complete status afterwards
+
+    Stages that can't be imported (eg arcpy isn't installed) are reported as
+    skipped rather than failing the run.
+
+    Usage:
+        python benchmark_pipeline.py [--scale 1] [--seed 0] [--stages 7,10,20] [--output results.csv]
+"""
+
+import argparse
+import importlib.util
+import os
+import shutil
+import sys
+import threading
+import time
+
+import pandas as pd
+
+import config
+import storage
+import synthetic_data
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+WORK_DIR = os.path.join('data', 'benchmark')
+
+# (stage, script, function(s) to run)
+STAGES = [
+    ('7', '7_download_tmcs_wGDAL.py', 'create_tmc_feature_class'),
+    ('10', '10_identify_routes_by_linearId_simple.py', 'identify_routes_by_linearId_simple'),
+    ('20', '20_identify_routes_by_linearTmc_simple.py', 'identify_routes_by_linearTmc_simple'),
+    ('25', '25_flip_routes_by_linearId_and_linearTMC.py', 'flip_routes_by_linearId'),
+    ('27', '27_AutoQC.py', 'run_AutoQC_27'),
+    ('30', '30_map_route_numbers_to_lrs_routes.py', 'map_route_numbers_to_lrs_routes'),
+    ('31', '31_identify_routes_by_number_name.py', 'identify_routes_by_number_name'),
+    ('35', '35_flip_again.py', 'flip_routes_again'),
+    ('40', '40_AutoQC.py', 'run_AutoQC_40'),
+    ('43', '43_create_intersection_dictionary.py', 'create_intersection_dictionary'),
+    ('45', '45_identify_routes_detailed.py', 'identify_routes_detailed'),
+    ('50', '50_flip_detailed_results.py', 'flip_routes_again'),
+    ('55', '55_QC_detailed_results.py', 'run_AutoQC_55'),
+    ('60', '60_combine_all_results.py', ('create_output_tables', 'add_complete_tmcs', 'add_failed_tmcs'))
+]
+
+
+def prepare_workspace(work_dir=WORK_DIR, scale=1, seed=0):
+    """ Writes a fresh synthetic network to work_dir/data and points config.py
+        at it.  Returns the network """
+    work_dir = os.path.abspath(work_dir)
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(os.path.join(work_dir, 'logs'))
+
+    print(f'  Generating synthetic network (scale {scale})')
+    network = synthetic_data.generate_network(primaries=4 * scale, secondaries=8 * scale, size=20000 * scale ** 0.5, seed=seed)
+    synthetic_data.write_network(network, data_dir)
+    shutil.copy(os.path.join(data_dir, 'LRS_RTE_ERRORS__REVERSED_MP.json'), work_dir)  # flip_routes.py reads it from the working folder
+
+    config.MASTER_LRS = os.path.join(data_dir, 'input_data.gdb', 'master_lrs')
+    config.OVERLAP_LRS = os.path.join(data_dir, 'input_data.gdb', 'overlap_lrs')
+    config.INTERSECTIONS = os.path.join(data_dir, 'input_data.gdb', 'intersections')
+    config.LRS_SHP = os.path.join(data_dir, 'lrs.shp')
+    config.TMCs = os.path.join(data_dir, 'input_data.gdb', 'TMCs')
+    config.ROUTE_NUMBER_INDEX = os.path.join(data_dir, 'route_nbr_index.pickle')
+    config.COLUMNAR_DB = os.path.join(data_dir, 'conflation.gpkg')
+
+    os.chdir(work_dir)
+    return network
+
+
+def load_stage(script):
+    """ Imports a numbered script as a module """
+    spec = importlib.util.spec_from_file_location(f'stage_{os.path.splitext(script)[0]}', os.path.join(REPO_DIR, script))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def count_complete():
+    try:
+        status = storage.get_storage().read_table('TMCs', ['status'])['status']
+        return int(status.fillna('').str.startswith('Complete').sum())
+    except Exception:
+        return None
+
+
+def current_rss():
+    """ Returns the resident memory of this process in bytes, or None if it
+        can't be read """
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            from ctypes import wintypes
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                           [(name, ctypes.c_size_t) for name in ('PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                                                                 'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage',
+                                                                 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            process = ctypes.windll.kernel32.GetCurrentProcess()
+            if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+                return None
+            return counters.WorkingSetSize
+
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, AttributeError, ValueError):
+        return None
+
+
+class PeakMemory():
+    """ Samples the process's resident memory every interval seconds in a
+        background thread and keeps the peak """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+
+    def sample(self):
+        while True:
+            rss = current_rss()
+            if rss is not None:
+                self.peak = rss if self.peak is None else max(self.peak, rss)
+            if self.stopped.wait(self.interval):
+                break
+
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_stage(stage, script, function, tmc_df):
+    try:
+        module = load_stage(script)
+    except ImportError as e:
+        return {'stage': stage, 'status': f'skipped ({e})'}
+
+    functions = function if isinstance(function, tuple) else (function,)
+    args = (tmc_df, 'data') if stage == '7' else ()
+
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        try:
+            for name in functions:
+                getattr(module, name)(*args)
+            status = 'ok'
+        except Exception as e:
+            status = f'error ({type(e).__name__}: {e})'
+        seconds = time.perf_counter() - start
+
+    return {
+        'stage': stage,
+        'status': status,
+        'seconds': round(seconds, 3),
+        'tmcs_per_second': round(len(tmc_df) / seconds, 1) if seconds > 0 else None,
+        'peak_mb': round(memory.peak / 2 ** 20, 1) if memory.peak is not None else None,
+        'complete': count_complete()
+    }
+
+
+def run_benchmark(scale=1, seed=0, stages=None, work_dir=WORK_DIR):
+    """ Runs the pipeline on a synthetic network and returns a DataFrame of
+        timings, one row per stage """
+    cwd = os.getcwd()
+    try:
+        network = prepare_workspace(work_dir, scale, seed)
+        tmc_df = network['tmcs']
+        print(f'  {len(network["master_lrs"])} master routes, {len(network["intersections"])} intersections, {len(tmc_df)} TMCs')
+
+        results = []
+        for stage, script, function in STAGES:
+            if stages and stage not in stages:
+                continue
+            print(f'\nStage {stage}')
+            result = run_stage(stage, script, function, tmc_df)
+            result['tmcs'] = len(tmc_df)
+            results.append(result)
+    finally:
+        os.chdir(cwd)
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on a synthetic network')
+    parser.add_argument('--scale', type=int, default=1, help='network size multiplier (about 500 TMCs per unit)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', help='comma separated stages to run, eg 7,10,20.  Defaults to all')
+    parser.add_argument('--output', help='CSV file for the results')
+    args = parser.parse_args()
+
+    print('\nBenchmarking pipeline')
+    results = run_benchmark(args.scale, args.seed, args.stages.split(',') if args.stages else None)
+    print('\n')
+    print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
@@ -1,5 +1,9 @@
 import os
-import arcpy
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None  # Only the columnar storage backend can be used without arcpy
 
 ###############
 # Source Data #
@@ -25,10 +29,34 @@ _INTERSECTIONS = r'C:\Users\daniel.fourquet\Documents\ArcGIS\LRS.gdb\SDE_VDOT_IN
 #          #################################################
 
 # Geographic spatial reference
-WGS84 = arcpy.SpatialReference(4326)
+WGS84_WKID = 4326
+WGS84 = arcpy.SpatialReference(WGS84_WKID) if arcpy else None
 
 # Projected spatial reference
-VIRGINIA_LAMBERT = arcpy.SpatialReference(3969)
+VIRGINIA_LAMBERT_WKID = 3969
+VIRGINIA_LAMBERT = arcpy.SpatialReference(VIRGINIA_LAMBERT_WKID) if arcpy else None
+
+# Storage backend (see storage.py)
+#   'arcpy' - the file geodatabases below, through arcpy
+#   'columnar' - a GeoPackage read and written with GDAL and SQLite.  Doesn't need arcpy
+STORAGE_BACKEND = os.environ.get('TMC_LRS_STORAGE', 'arcpy')
+
+# Logging (see trace_log.py)
+#   LOG_LEVEL - the level of every log file.  TMC_LRS_LOG_LEVELS overrides single
+#       logs, eg '45_identify_routes_detailed=DEBUG,lrs_tools=INFO'
+#   LOG_SAMPLE - the fraction of TMCs whose DEBUG records are written
+#   LOG_TMCS - TMCs whose DEBUG records are always written, eg '110+04506,110-04505'
+#   LOG_FORMAT - 'text' (logs/*.log) or 'binary' (logs/*.trace, see trace_log.py expand)
+LOG_LEVEL = os.environ.get('TMC_LRS_LOG_LEVEL', 'DEBUG')
+LOG_LEVELS = dict(item.split('=') for item in os.environ.get('TMC_LRS_LOG_LEVELS', '').split(',') if item)
+LOG_SAMPLE = float(os.environ.get('TMC_LRS_LOG_SAMPLE', 1))
+LOG_TMCS = set(filter(None, os.environ.get('TMC_LRS_LOG_TMCS', '').split(',')))
+LOG_FORMAT = os.environ.get('TMC_LRS_LOG_FORMAT', 'text')
+
+# Step 45 matching (see map_matching.py)
+#   'chain' - the most common first and last routes, chained through shared intersections
+#   'hmm' - hidden Markov model map matching of the TMC's sample points
+MATCHING_MODE = os.environ.get('TMC_LRS_MATCHING', 'chain')
 
 
 
@@ -38,11 +66,16 @@ VIRGINIA_LAMBERT = arcpy.SpatialReference(3969)
 #            ###############################################
 # These are the data that were created by 0_initial_setup.py
 
-MASTER_LRS = os.path.join(os.getcwd(), 'data\\input_data.gdb\\master_lrs')
-OVERLAP_LRS = os.path.join(os.getcwd(), 'data\\input_data.gdb\\overlap_lrs')
-INTERSECTIONS = os.path.join(os.getcwd(), 'data\\input_data.gdb\\intersections')
-LRS_SHP = os.path.join(os.getcwd(), 'data\\lrs.shp')
-TMCs = os.path.join(os.getcwd(), 'data\\input_data.gdb\\TMCs')
+MASTER_LRS = os.path.join(os.getcwd(), 'data', 'input_data.gdb', 'master_lrs')
+OVERLAP_LRS = os.path.join(os.getcwd(), 'data', 'input_data.gdb', 'overlap_lrs')
+INTERSECTIONS = os.path.join(os.getcwd(), 'data', 'input_data.gdb', 'intersections')
+LRS_SHP = os.path.join(os.getcwd(), 'data', 'lrs.shp')
+TMCs = os.path.join(os.getcwd(), 'data', 'input_data.gdb', 'TMCs')
 # TMCs = os.path.join(os.getcwd(), 'data\\input_data.gdb\\testTMCs2')
+ROUTE_NUMBER_INDEX = os.path.join(os.getcwd(), 'data', 'route_nbr_index.pickle')
+
+# Used by the columnar storage backend.  Layers are named master_lrs, overlap_lrs,
+# intersections, and TMCs, the same as in input_data.gdb
+COLUMNAR_DB = os.path.join(os.getcwd(), 'data', 'conflation.gpkg')
 
 ############################################################
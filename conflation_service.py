@@ -0,0 +1,249 @@
+""" A local HTTP service that answers "where does this TMC land on the LRS".
+
+    The LRS, its spatial index, and the route intersections are loaded once and
+    kept in memory, so each request only pays for the matching itself (see
+    map_matching.py).  Start it with:
+        python conflation_service.py [--port 8045] [--workers 4] [--queue-size 64]
+
+    Requests:
+        GET /health - {"status": "ok", "routes": <number of LRS routes>, "queued": <requests waiting>}
+        POST /match - a TMC, or {"tmcs": [TMC, ...]} for a batch.  A TMC is one of:
+            {"id": "mine", "coordinates": [[x, y], ...]} - Virginia Lambert
+            {"id": "mine", "coordinates": [[lon, lat], ...], "wgs84": true}
+            {"tmc": "110+04506"} - a TMC from the TMCs layer (see storage.py)
+        Each TMC is answered with:
+            {"id": ..., "events": [{"rte_nm", "begin_msr", "end_msr", "confidence"}, ...]}
+        or {"id": ..., "error": "..."} if it couldn't be matched
+
+    Requests are put on a bounded queue and answered by a fixed number of
+    worker threads.  When the queue is full the service answers 503 right away
+    instead of piling up work.
+
+    Nothing is loaded at import.  ConflationEngine takes the LRS (and optionally
+    the intersections and TMCs) as arguments, so the service can be started on
+    synthetic data (see synthetic_data.py and tests/test_conflation_service.py)
+    without arcpy or the network.  The LRS must have M values.  GDAL drops them
+    from the LRS shapefile, so the service refuses to start without the
+    GeoPackage.
+"""
+
+import argparse
+import json
+import queue
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import config
+import instrumentation
+import trace_log
+from map_matching import HMMMatcher, sample_points
+
+log = trace_log.get_logger(__name__, 'conflation_service')
+
+
+class ConflationEngine():
+    def __init__(self, lrs, route_intersections=None, tmc_store=None, **matcher_options):
+        """
+        inputs:
+            lrs - a CompactLRS, ideally with M values (see lrs_model.from_geopackage)
+            route_intersections - optional function returning the intersection
+                OBJECTIDs of a RTE_NM (eg from rte_int_dict)
+            tmc_store - optional GeometryStore of TMCs, for {"tmc": ...} requests
+            matcher_options - passed to HMMMatcher (eg sigma)
+        """
+        lrs.require_measures()  # Otherwise every answer would have null measures
+        self.lrs = lrs
+        self.tmc_store = tmc_store
+        self.matcher = HMMMatcher(lrs, route_intersections, **matcher_options)
+        lrs.tree  # Build the spatial index now rather than on the first request
+
+
+    def geometry(self, request):
+        """ Returns the Virginia Lambert vertices of a requested TMC """
+        if 'tmc' in request:
+            if self.tmc_store is None or request['tmc'] not in self.tmc_store.index:
+                raise KeyError(f'Unknown TMC {request["tmc"]}')
+            return self.tmc_store.vertices(self.tmc_store.index[request['tmc']])
+
+        xy = np.asarray(request['coordinates'], dtype=np.float64).reshape(-1, 2)
+        if request.get('wgs84'):
+            import projection
+            xy = projection.project_xy(xy)
+        return xy
+
+
+    @instrumentation.timed()
+    def match(self, request):
+        """ Matches one TMC request.  Returns its answer """
+        tmc_id = request.get('id', request.get('tmc'))
+        trace_log.set_tmc(tmc_id)
+        try:
+            events = []
+            for matched in self.matcher.match(sample_points(self.geometry(request))):
+                events.append({
+                    'rte_nm': matched.rte_nm,
+                    'begin_msr': matched.begin_msr,
+                    'end_msr': matched.end_msr,
+                    'confidence': self.matcher.confidence(matched)
+                })
+            log.debug('%s: %s', tmc_id, events)
+            return {'id': tmc_id, 'events': events}
+        except Exception as e:
+            instrumentation.count('exceptions_swallowed')
+            log.debug('Error matching %s', tmc_id, exc_info=True)
+            return {'id': tmc_id, 'error': f'{type(e).__name__}: {e}'}
+        finally:
+            trace_log.set_tmc(None)
+
+
+    def match_many(self, requests):
+        return [self.match(request) for request in requests]
+
+
+class Job():
+    def __init__(self, requests):
+        self.requests = requests
+        self.results = None
+        self.done = threading.Event()
+
+
+class ConflationService(ThreadingHTTPServer):
+    """ The HTTP server, its bounded job queue, and the workers that run jobs """
+    daemon_threads = True
+
+    def __init__(self, engine, address=('127.0.0.1', 8045), workers=4, queue_size=64, timeout=60):
+        super().__init__(address, ConflationHandler)
+        self.engine = engine
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.timeout = timeout
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                job.results = self.engine.match_many(job.requests)
+            finally:
+                job.done.set()
+
+
+    def submit(self, requests):
+        """ Queues requests and waits for their answers.  Raises queue.Full if
+            the queue is full and TimeoutError if they take too long """
+        job = Job(requests)
+        self.jobs.put_nowait(job)
+        if not job.done.wait(self.timeout):
+            raise TimeoutError('Timed out waiting for a worker')
+        return job.results
+
+
+    def server_close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        super().server_close()
+
+
+class ConflationHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_json(404, {'error': f'Unknown path {self.path}'})
+        self.send_json(200, {'status': 'ok', 'routes': len(self.server.engine.lrs.names), 'queued': self.server.jobs.qsize()})
+
+
+    def do_POST(self):
+        if self.path != '/match':
+            return self.send_json(404, {'error': f'Unknown path {self.path}'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError as e:
+            return self.send_json(400, {'error': f'Invalid JSON: {e}'})
+
+        batch = isinstance(body, dict) and 'tmcs' in body
+        requests = body['tmcs'] if batch else [body]
+        if not isinstance(requests, list) or not all(isinstance(request, dict) for request in requests):
+            return self.send_json(400, {'error': 'Expected a TMC object or {"tmcs": [...]}'})
+
+        try:
+            results = self.server.submit(requests)
+        except queue.Full:
+            return self.send_json(503, {'error': 'Too many requests queued.  Try again shortly'})
+        except TimeoutError as e:
+            return self.send_json(504, {'error': str(e)})
+        self.send_json(200, {'tmcs': results} if batch else results[0])
+
+
+    def log_message(self, format, *args):
+        log.info(format, *args)
+
+
+def load_engine(lrs_path=None, rte_int_dict_path='data//rte_int_dict.json', tmcs=True):
+    """ Loads the LRS, the route intersections, and (optionally) the TMCs the
+        same way the pipeline does """
+    import os
+    import lrs_model
+    import storage
+
+    lrs_path = lrs_path or config.COLUMNAR_DB  # The LRS shapefile has no M values once read with GDAL
+    if not os.path.exists(lrs_path):
+        raise ValueError(f'{lrs_path} not found.  Run storage.py to copy the LRS into the GeoPackage')
+    print(f'  Loading LRS from {lrs_path}')
+    lrs = lrs_model.load_lrs(lrs_path)
+    lrs.require_measures()
+
+    route_intersections = None
+    if os.path.exists(rte_int_dict_path):
+        print('  Loading route intersections')
+        with open(rte_int_dict_path, 'r') as file:
+            rte_int_dict = json.load(file)
+        route_intersections = lambda rte_nm: rte_int_dict.get(rte_nm, [])
+
+    tmc_store = None
+    if tmcs:
+        try:
+            print('  Loading TMC geometries')
+            tmc_store = storage.get_storage().read_geometry_store('TMCs', 'tmc')
+        except Exception as e:
+            print(f'  Continuing without TMCs ({e})')
+    return ConflationEngine(lrs, route_intersections, tmc_store)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local TMC to LRS conflation service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8045)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=64, help='requests that can wait for a worker before new ones get 503')
+    parser.add_argument('--lrs', help='LRS GeoPackage with M values.  Defaults to config.COLUMNAR_DB')
+    parser.add_argument('--no-tmcs', action='store_true', help="don't load the TMCs layer")
+    args = parser.parse_args()
+
+    print('\nStarting conflation service')
+    try:
+        engine = load_engine(args.lrs, tmcs=not args.no_tmcs)
+    except ValueError as e:
+        sys.exit(f'  {e}')
+    server = ConflationService(engine, (args.host, args.port), args.workers, args.queue_size)
+    print(f'  Listening on http://{args.host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
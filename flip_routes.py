@@ -1,5 +1,5 @@
 import arcpy, pandas as pd
-import logging
+import trace_log
 import json
 import config
 
@@ -21,10 +21,7 @@ except Exception as e:
     print(e)
 
 
-log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG) # Set the debug level here
-fileHandler = logging.FileHandler(r'logs/flipRoutes.log', mode='w')
-log.addHandler(fileHandler)
+log = trace_log.get_logger(__name__, 'flipRoutes')
 
 def add_to_event_table(objectId, id, needsFlip, rte_nm, begin_mp, end_mp):
     event = {
@@ -57,11 +54,11 @@ def get_msr(inputPolyline, lrs, rte_nm):
         try:
             RouteGeom = lrs[rte_nm]
         except:
-            log.debug(f'  Route "{rte_nm}" not found')
+            log.debug('  Route "%s" not found', rte_nm)
             return None, None
 
         if not RouteGeom:
-            log.debug(f'  Route "{rte_nm}" not found')
+            log.debug('  Route "%s" not found', rte_nm)
             return None, None
 
         
@@ -119,8 +116,6 @@ def run_flip_routes(step_name, sql=None, feature_class=None):
 
     outputEvents = {}
 
-    fileHandler = logging.FileHandler(f'logs/flipRoutes.log', mode='w')
-    log.addHandler(fileHandler)
 
     # Create a dictionary of opposite direction routes
     print('  Creating opposite direction route dict')
@@ -147,11 +142,12 @@ def run_flip_routes(step_name, sql=None, feature_class=None):
     # For each record in input layer, if the begin_mp > end_mp, move to the opposite route.  Otherwise, keep the same
     with arcpy.da.SearchCursor(feature_class, ['tmc', 'rte_nm', 'begin_msr', 'end_msr', 'SHAPE@', 'OID@'], sql) as cur:
         for id, rte_nm, begin_mp, end_mp, geom, objectId in cur:
-            log.debug(f'\nProcessing {id}')
+            trace_log.set_tmc(id)
+            log.debug('\nProcessing %s', id)
             try:
                 needsFlip = False
                 if rte_nm not in oppRteDict.keys():
-                    log.debug(f"  '{rte_nm}' does not have an opposite route and doesn't need to be flipped")
+                    log.debug("  '%s' does not have an opposite route and doesn't need to be flipped", rte_nm)
                     add_to_event_table(objectId, id, needsFlip, rte_nm, begin_mp, end_mp)
                     countNotFlipped += 1
 
@@ -159,29 +155,29 @@ def run_flip_routes(step_name, sql=None, feature_class=None):
 
                 if rte_nm.startswith('S-VA') and (begin_mp < end_mp or begin_mp == end_mp) and (rte_nm[7:9] == 'PR'):
                     if rte_nm in LRS_RTE_ERRORS__REVERSED_MP:
-                        log.debug(f"  rte_nm '{rte_nm}' is digitized backwards and needs to be flipped")
+                        log.debug("  rte_nm '%s' is digitized backwards and needs to be flipped", rte_nm)
                         needsFlip = True
                     else:
                         add_to_event_table(objectId, id, needsFlip, rte_nm, begin_mp, end_mp)
                         countNotFlipped += 1
-                        log.debug(f"  rte_nm '{rte_nm}' is a PR with ascending MP and does not need to be flipped")
+                        log.debug("  rte_nm '%s' is a PR with ascending MP and does not need to be flipped", rte_nm)
 
                         continue
 
                 if rte_nm.startswith('S-VA') and (begin_mp > end_mp or begin_mp == end_mp) and (rte_nm[7:9] == 'NP'):
                     if rte_nm in LRS_RTE_ERRORS__REVERSED_MP:
-                        log.debug(f"  rte_nm '{rte_nm}' is digitized backwards and needs to be flipped")
+                        log.debug("  rte_nm '%s' is digitized backwards and needs to be flipped", rte_nm)
                         needsFlip = True
                     else:
                         add_to_event_table(objectId, id, needsFlip, rte_nm, begin_mp, end_mp)
                         countNotFlipped += 1
-                        log.debug(f"  rte_nm '{rte_nm}' is a NP with descending MP and does not need to be flipped")
+                        log.debug("  rte_nm '%s' is a NP with descending MP and does not need to be flipped", rte_nm)
 
                         continue
 
 
                 if rte_nm in LRS_RTE_ERRORS__REVERSED_MP and needsFlip == False:
-                    log.debug(f"  rte_nm '{rte_nm}' is digitized backwards and does not needs to be flipped")
+                    log.debug("  rte_nm '%s' is digitized backwards and does not needs to be flipped", rte_nm)
                     add_to_event_table(objectId, id, needsFlip, rte_nm, begin_mp, end_mp)
                     countNotFlipped += 1
 
@@ -190,55 +186,56 @@ def run_flip_routes(step_name, sql=None, feature_class=None):
                 if 'RMP' in rte_nm:
                     add_to_event_table(objectId, id, needsFlip, rte_nm, begin_mp, end_mp)
                     countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' is a ramp and does not need to be flipped")
+                    log.debug("  rte_nm '%s' is a ramp and does not need to be flipped", rte_nm)
 
                     continue
 
                 if rte_nm.startswith('R-VA') and ('PA' in rte_nm):
                     add_to_event_table(objectId, id, needsFlip, rte_nm, begin_mp, end_mp)
                     countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' is a PA route and does not need to be flipped")
+                    log.debug("  rte_nm '%s' is a PA route and does not need to be flipped", rte_nm)
 
                     continue
 
                 if rte_nm.startswith('R-VA') and (begin_mp < end_mp or begin_mp == end_mp) and ('NB' in rte_nm or 'EB' in rte_nm):
                     add_to_event_table(objectId, id, needsFlip, rte_nm, begin_mp, end_mp)
                     countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' does not need to be flipped")
+                    log.debug("  rte_nm '%s' does not need to be flipped", rte_nm)
 
                     continue
 
                 if rte_nm.startswith('R-VA') and (begin_mp > end_mp or begin_mp == end_mp) and ('SB' in rte_nm or 'WB' in rte_nm):
                     add_to_event_table(objectId, id, needsFlip, rte_nm, begin_mp, end_mp)
                     countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' does not need to be flipped")
+                    log.debug("  rte_nm '%s' does not need to be flipped", rte_nm)
 
                     continue
 
 
-                log.debug(f"  rte_nm '{rte_nm}' needs to be flipped - begin_msr = {begin_mp}  end_msr = {end_mp}")
+                log.debug("  rte_nm '%s' needs to be flipped - begin_msr = %s  end_msr = %s", rte_nm, begin_mp, end_mp)
                 needsFlip = True
                 new_rte_nm = oppRteDict[rte_nm]
-                log.debug(f"    New rte_nm: '{new_rte_nm}'")
+                log.debug("    New rte_nm: '%s'", new_rte_nm)
                 new_begin_mp, new_end_mp = get_msr(geom, LRSGeomDict, new_rte_nm)
-                log.debug(f"    New begin and end msr: {new_begin_mp}, {new_end_mp}")
+                log.debug('    New begin and end msr: %s, %s', new_begin_mp, new_end_mp)
                 add_to_event_table(objectId, id, needsFlip, new_rte_nm, new_begin_mp, new_end_mp)
                 countFlipped += 1
 
             except Exception as e:
                 log.debug(e)
-                log.debug(f'  Error processing {id}')
+                log.debug('  Error processing %s', id)
                 add_to_event_table(objectId, id, needsFlip, rte_nm, begin_mp, end_mp)
                 countError += 1
                 errorList.append(id)
+    trace_log.set_tmc(None)
 
     totalSegments = sum([countNotFlipped, countFlipped, countError])
-    log.debug(f'Flip Complete\n-------------')
-    log.debug(f'    Total Segments: {totalSegments}')
-    log.debug(f'        Not Flipped: {countNotFlipped}, {round(countNotFlipped/totalSegments*100)}%')
-    log.debug(f'        Flipped: {countFlipped}, {round(countFlipped/totalSegments*100)}%')
-    log.debug(f'        Errors: {countError}, {round(countError/totalSegments*100)}%')
-    log.debug(f'        Error List: {errorList}')
+    log.debug('Flip Complete\n-------------')
+    log.debug('    Total Segments: %s', totalSegments)
+    log.debug('        Not Flipped: %s, %s%%', countNotFlipped, round(countNotFlipped / totalSegments * 100))
+    log.debug('        Flipped: %s, %s%%', countFlipped, round(countFlipped / totalSegments * 100))
+    log.debug('        Errors: %s, %s%%', countError, round(countError / totalSegments * 100))
+    log.debug('        Error List: %s', errorList)
 
     print('Updating status and LRS values')
     with arcpy.da.UpdateCursor(feature_class, ['OID@', 'rte_nm', 'begin_msr', 'end_msr', 'status']) as cur:
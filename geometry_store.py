@@ -0,0 +1,244 @@
+""" An in-memory store of line geometries, loaded with a single search cursor.
+
+    Every feature's vertices are kept in one float array, with an offsets array
+    marking where each feature begins and ends:
+
+        xy[offsets[i]:offsets[i + 1]] are the vertices of feature i
+
+    part_starts marks the first vertex of each part, so multipart lines (eg
+    dissolved linearIds with gaps) are measured the same way arcpy measures
+    them - the gap between parts doesn't count toward the length.
+
+    Features are looked up by key (eg tmc) with store.index, or by any other
+    loaded field (eg linearId or linearTmc) with store.rows_for.  Endpoints,
+    mid-points, and quarter-points are computed for every feature at once the
+    first time they are asked for and then cached.
+
+    merge_groups builds a new store with one line per group (eg per linearId) by
+    putting the group's TMCs in roadOrder and joining their vertices.  This
+    replaces dissolving the TMC layer into intermediate.gdb.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class GeometryStore():
+    def __init__(self, keys, xy, offsets, part_starts=None, attributes=None, geometries=None):
+        self.keys = list(keys)
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if part_starts is None:
+            part_starts = np.zeros(len(self.xy), dtype=bool)
+            part_starts[self.offsets[:-1][np.diff(self.offsets) > 0]] = True
+        self.part_starts = np.asarray(part_starts, dtype=bool)
+        self.attributes = attributes if attributes is not None else pd.DataFrame(index=range(len(self.keys)))
+        self.geometries = geometries  # Optional {key: arcpy geometry}
+        self._cumulative = None
+        self._points = {}
+        self._groups = {}
+
+
+    @classmethod
+    def from_feature_class(cls, feature_class, key_field='tmc', fields=(), sql=None, keep_geometry=False):
+        """ Loads every feature of feature_class in a single search cursor
+        inputs:
+            key_field - the field used to look up features
+            fields - other fields to load into store.attributes
+            sql - optional where clause
+            keep_geometry - also keep the arcpy geometries, for steps that still
+                need arcpy geometry methods
+        """
+        import arcpy
+
+        keys = []
+        values = []
+        xy = []
+        part_starts = []
+        offsets = [0]
+        geometries = {} if keep_geometry else None
+
+        with arcpy.da.SearchCursor(feature_class, [key_field] + list(fields) + ['SHAPE@'], sql) as cur:
+            for row in cur:
+                key, geom = row[0], row[-1]
+                keys.append(key)
+                values.append(row[1:-1])
+                if keep_geometry:
+                    geometries[key] = geom
+
+                if geom:
+                    for part in geom:
+                        first = True
+                        for point in part:
+                            if point is None:
+                                continue
+                            xy.append((point.X, point.Y))
+                            part_starts.append(first)
+                            first = False
+                offsets.append(len(xy))
+
+        attributes = pd.DataFrame(values, columns=list(fields))
+        return cls(keys, np.array(xy, dtype=np.float64).reshape(-1, 2), offsets, np.array(part_starts, dtype=bool), attributes, geometries)
+
+
+    @classmethod
+    def from_geometries(cls, keys, geometries, attributes=None):
+        """ Builds a store from an array of shapely (Multi)LineStrings, eg the
+            geometry column of a GeoDataFrame """
+        import shapely
+
+        geometries = np.asarray(geometries, dtype=object)
+        parts, part_owner = shapely.get_parts(geometries, return_index=True)
+        xy, vertex_part = shapely.get_coordinates(parts, return_index=True)
+
+        part_starts = np.zeros(len(xy), dtype=bool)
+        part_starts[np.searchsorted(vertex_part, np.arange(len(parts)))[np.bincount(vertex_part, minlength=len(parts)) > 0]] = True
+
+        vertex_owner = part_owner[vertex_part]
+        offsets = np.zeros(len(geometries) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(vertex_owner, minlength=len(geometries)), out=offsets[1:])
+
+        return cls(keys, xy, offsets, part_starts, attributes)
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def rows_for(self, field, value):
+        """ Returns the row numbers of all features where field == value """
+        if field not in self._groups:
+            self._groups[field] = self.attributes.groupby(field, sort=False).indices
+        return self._groups[field].get(value, np.array([], dtype=np.int64))
+
+
+    def vertices(self, row):
+        """ Returns the vertices of one feature """
+        return self.xy[self.offsets[row]:self.offsets[row + 1]]
+
+
+    @property
+    def cumulative(self):
+        """ The distance along its feature at each vertex, accumulated over the
+            whole array (distance at vertex 0 of feature i is lengths up to i) """
+        if self._cumulative is None:
+            segments = np.zeros(len(self.xy))
+            if len(self.xy) > 1:
+                segments[1:] = np.hypot(*(self.xy[1:] - self.xy[:-1]).T)
+            segments[self.part_starts] = 0
+            self._cumulative = np.cumsum(segments)
+        return self._cumulative
+
+
+    @property
+    def lengths(self):
+        """ The planar length of every feature """
+        cumulative = self.cumulative
+        lengths = np.zeros(len(self.keys))
+        valid = np.diff(self.offsets) > 0
+        lengths[valid] = cumulative[self.offsets[1:][valid] - 1] - cumulative[self.offsets[:-1][valid]]
+        return lengths
+
+
+    def points_at(self, fraction):
+        """ Returns an (n, 2) array of the point at fraction (0-1) of the length of
+            every feature.  Features without vertices get nan """
+        fraction = round(float(fraction), 6)
+        if fraction in self._points:
+            return self._points[fraction]
+
+        points = np.full((len(self.keys), 2), np.nan)
+        counts = np.diff(self.offsets)
+        valid = counts > 0
+        starts = self.offsets[:-1][valid]
+        ends = self.offsets[1:][valid] - 1
+
+        if fraction <= 0:
+            points[valid] = self.xy[starts]
+        elif fraction >= 1:
+            points[valid] = self.xy[ends]
+        else:
+            cumulative = self.cumulative
+            targets = cumulative[starts] + fraction * (cumulative[ends] - cumulative[starts])
+            j = np.searchsorted(cumulative, targets, side='left')
+            j = np.clip(j, np.minimum(starts + 1, ends), ends)
+            i = np.maximum(j - 1, starts)  # Single vertex features use the vertex itself
+            segment = cumulative[j] - cumulative[i]
+            ratio = np.divide(targets - cumulative[i], segment, out=np.ones_like(segment), where=segment > 0)
+            points[valid] = self.xy[i] + ratio[:, None] * (self.xy[j] - self.xy[i])
+
+        self._points[fraction] = points
+        return points
+
+
+    def first_points(self):
+        return self.points_at(0)
+
+
+    def last_points(self):
+        return self.points_at(1)
+
+
+    def mid_points(self):
+        return self.points_at(0.5)
+
+
+def merge_groups(store, field, order_field='roadOrder', values=None, mask=None, tolerance=1.0):
+    """ Merges the features of store into one line per value of field
+    inputs:
+        store - a GeometryStore with field and order_field loaded
+        field - the grouping field, eg linearId or linearTmc
+        order_field - features are joined in this order within each group
+        values - optional collection of group values to keep
+        mask - optional boolean array of features to keep
+        tolerance - a feature that starts further than this from the end of
+            the previous feature starts a new part (a gap)
+    output:
+        A GeometryStore keyed by group value.  Its attributes include the number
+        of TMCs in each group and the number of gaps found
+    """
+    groups = store.attributes[field].to_numpy()
+    keep = np.diff(store.offsets) > 0
+    if mask is not None:
+        keep &= np.asarray(mask, dtype=bool)
+    if values is not None:
+        keep &= pd.Series(groups).isin(set(values)).to_numpy()
+
+    rows = np.flatnonzero(keep)
+    order = pd.to_numeric(store.attributes[order_field], errors='coerce').to_numpy()[rows]
+    group_codes = pd.factorize(groups[rows])[0]
+    rows = rows[np.lexsort((order, group_codes))]
+    group_codes = pd.factorize(groups[rows])[0]  # Codes in sorted order
+
+    # Gather every vertex of every kept feature, in merge order
+    starts = store.offsets[rows]
+    counts = store.offsets[rows + 1] - starts
+    feature_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(counts, out=feature_offsets[1:])
+    vertex_index = np.repeat(starts - feature_offsets[:-1], counts) + np.arange(feature_offsets[-1])
+
+    xy = store.xy[vertex_index]
+    part_starts = store.part_starts[vertex_index].copy()
+
+    # A feature continues the previous feature's part unless it is the first in its
+    # group or it starts away from where the previous feature ended
+    first_in_group = np.ones(len(rows), dtype=bool)
+    first_in_group[1:] = group_codes[1:] != group_codes[:-1]
+    gap_distance = np.zeros(len(rows))
+    if len(rows) > 1:
+        previous_ends = xy[feature_offsets[1:-1] - 1]
+        gap_distance[1:] = np.hypot(*(xy[feature_offsets[1:-1]] - previous_ends).T)
+    gaps = ~first_in_group & (gap_distance > tolerance)
+    part_starts[feature_offsets[:-1]] = first_in_group | gaps
+
+    group_starts = np.flatnonzero(first_in_group)
+    offsets = np.append(feature_offsets[group_starts], feature_offsets[-1])
+    keys = groups[rows][group_starts]
+    attributes = pd.DataFrame({
+        field: keys,
+        'tmc_count': np.diff(np.append(group_starts, len(rows))),
+        'gaps': np.add.reduceat(gaps.astype(np.int64), group_starts) if len(rows) else np.array([], dtype=np.int64)
+    })
+
+    return GeometryStore(keys, xy, offsets, part_starts, attributes)
@@ -0,0 +1,256 @@
+""" Accuracy and speed regression checks against golden results.
+
+    Two checks are available:
+
+        autoqc - reruns AutoQC on a sample of the TMCs in a golden AutoQC file
+            (test_AutoQC.csv by default) and compares every result column.  This
+            needs arcpy and the TMC layer the golden file was made from
+        matching - runs the pipeline on a synthetic network (see
+            benchmark_pipeline.py).  This needs arcpy, since the matching
+            stages and stage 60 do.  Its accuracy (match_rate, correct_rate) is
+            measured against the network's expected events.  Drift is measured
+            against the events of an earlier run saved with --save-golden, so
+            TMCs the pipeline has never matched don't count as drift
+
+    Both report the wall time next to the differences, so a speedup can be
+    judged along with any change in results.  Numbers are compared with
+    tolerances.  True/False columns and route names must match exactly.
+
+    Usage:
+        python golden_check.py autoqc [--golden test_AutoQC.csv] [--sample 500]
+        python golden_check.py matching [--scale 1] [--golden events.csv] [--save-golden [events.csv]]
+    Exits with 1 if the results drifted from the golden file, and with 2 if
+    the matching check had nothing to check (stage 60 didn't run, eg without
+    arcpy).  The matching check only reports accuracy until a golden run has
+    been saved.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import storage
+
+GOLDEN_AUTOQC = 'test_AutoQC.csv'
+GOLDEN_MATCHING = 'golden_matching_events.csv'
+PASSING_CONFIDENCE = 70  # The cutoff used by 27_AutoQC.py, 40_AutoQC.py, and 55_QC_detailed_results.py
+AUTOQC_TOLERANCES = {'centroidDifference': 1.0, 'confidence': 0.0}
+MEASURE_TOLERANCE = 0.005  # Miles
+EVENT_FIELDS = ['tmc', 'rte_nm', 'begin_msr', 'end_msr']
+EXIT_DRIFTED = 1
+EXIT_NOT_CHECKED = 2
+
+
+def compare_columns(golden, result, key, tolerances=None):
+    """ Compares two tables on key.  Numeric columns in tolerances may differ
+        by up to their tolerance.  Every other shared column must match
+        exactly.  Missing values only match missing values.  Returns
+        (merged table with a drifted flag per column, list of drifted columns) """
+    tolerances = tolerances or {}
+    columns = [col for col in golden.columns if col in result.columns and col != key]
+    merged = golden.merge(result, on=key, how='outer', suffixes=('_golden', ''), indicator=True)
+
+    drifted_columns = []
+    for col in columns:
+        old, new = merged[f'{col}_golden'], merged[col]
+        both_missing = old.isna() & new.isna()
+        if col in tolerances:
+            same = (pd.to_numeric(old, errors='coerce') - pd.to_numeric(new, errors='coerce')).abs() <= tolerances[col]
+        else:
+            same = old.astype(str).str.lower() == new.astype(str).str.lower()
+        merged[f'{col}_drifted'] = ~(same | both_missing)
+        if merged[f'{col}_drifted'].any():
+            drifted_columns.append(col)
+
+    return merged, drifted_columns
+
+
+def pass_rate(confidence):
+    confidence = pd.to_numeric(confidence, errors='coerce')
+    return float((confidence >= PASSING_CONFIDENCE).mean()) if len(confidence) else 0.0
+
+
+def check_autoqc(golden_path=GOLDEN_AUTOQC, sample=500, seed=0, feature_class=None):
+    """ Reruns AutoQC on a sample of the golden TMCs and compares the results.
+        Returns a report dictionary """
+    from AutoQC import run_AutoQC
+
+    golden = pd.read_csv(golden_path)
+    if sample and sample < len(golden):
+        golden = golden.sample(sample, random_state=seed)
+    tmcs = golden['tmc'].tolist()
+    if len(tmcs) == 1:
+        tmcs.append('') # To fix bug when creating valid sql statement when only one Id exists
+
+    start = time.perf_counter()
+    run_AutoQC('_golden', feature_class, f'tmc IN {tuple(tmcs)}')
+    seconds = time.perf_counter() - start
+
+    result = pd.read_csv('data//_golden_AutoQC.csv')
+    merged, drifted_columns = compare_columns(golden, result, 'tmc', AUTOQC_TOLERANCES)
+    drifted = merged.filter(like='_drifted').any(axis=1) | (merged['_merge'] != 'both')
+
+    return {
+        'check': 'autoqc',
+        'tmcs': len(golden),
+        'seconds': round(seconds, 3),
+        'tmcs_per_second': round(len(golden) / seconds, 1) if seconds > 0 else None,
+        'drifted_tmcs': int(drifted.sum()),
+        'drifted_columns': drifted_columns,
+        'missing_tmcs': int((merged['_merge'] == 'left_only').sum()),
+        'golden_pass_rate': round(pass_rate(merged['confidence_golden']), 4),
+        'pass_rate': round(pass_rate(merged['confidence']), 4),
+        'drifted_sample': merged.loc[drifted, 'tmc'].head(20).tolist()
+    }
+
+
+def read_final_events():
+    """ Returns the events of every completed TMC, the same way
+        60_combine_all_results.py collects them """
+    tmcs = storage.get_storage().read_table('TMCs', EVENT_FIELDS + ['status'])
+    complete = tmcs.loc[tmcs['status'].fillna('').str.startswith('Complete')]
+    single = complete.loc[~complete['status'].str.startswith('Complete (45)'), EVENT_FIELDS]
+
+    detailed = complete.loc[complete['status'].str.startswith('Complete (45)'), 'tmc']
+    if len(detailed) and os.path.exists('data//_45_output.csv'):
+        events = pd.read_csv('data//_45_output.csv')
+        single = pd.concat([single, events.loc[events['tmc'].isin(set(detailed)), EVENT_FIELDS]], ignore_index=True)
+    return single
+
+
+def compare_events(golden, result, tolerance=MEASURE_TOLERANCE):
+    """ Compares events TMC by TMC.  A TMC matches when it has the same routes
+        as the golden events, with begin and end measures within tolerance.
+        Returns a DataFrame with one row per TMC in either table """
+    def by_tmc(events):
+        events = events.sort_values(['tmc', 'rte_nm'])
+        return events.groupby('tmc').agg(list)
+
+    golden, result = by_tmc(golden), by_tmc(result)
+    merged = golden.join(result, how='outer', lsuffix='_golden')
+
+    def matches(row):
+        if not isinstance(row['rte_nm'], list) or not isinstance(row['rte_nm_golden'], list):
+            return False
+        if row['rte_nm'] != row['rte_nm_golden']:
+            return False
+        measures = np.array(row['begin_msr'] + row['end_msr'], dtype=float)
+        golden_measures = np.array(row['begin_msr_golden'] + row['end_msr_golden'], dtype=float)
+        return bool(np.all(np.abs(measures - golden_measures) <= tolerance))
+
+    merged['matched'] = merged['rte_nm'].map(lambda value: isinstance(value, list))
+    merged['correct'] = merged.apply(matches, axis=1)
+    merged['expected'] = merged['rte_nm_golden'].map(lambda value: isinstance(value, list))
+    return merged.reset_index()
+
+
+def check_matching(scale=1, seed=0, golden_path=GOLDEN_MATCHING, save_golden=None):
+    """ Runs the pipeline on a synthetic network.  Measures the accuracy of the
+        final events against the expected events, and their drift from the
+        golden run, if golden_path exists.  Returns a report dictionary.  If
+        stage 60 didn't run there are no final events, and the report only
+        says why under not_checked """
+    from benchmark_pipeline import run_benchmark, WORK_DIR
+
+    timings = run_benchmark(scale, seed, work_dir=WORK_DIR)
+    seconds = timings['seconds'].sum() if 'seconds' in timings else 0.0
+    skipped_stages = timings.loc[timings['status'].str.startswith('skipped'), 'stage'].tolist()
+
+    stage_60 = timings.loc[timings['stage'] == '60', 'status'].tolist()
+    if stage_60 != ['ok']:
+        status = stage_60[0] if stage_60 else 'was not run'
+        return {
+            'check': 'matching',
+            'seconds': round(float(seconds), 3),
+            'skipped_stages': skipped_stages,
+            'not_checked': f'Stage 60 {status}, so there are no final events to check'
+        }
+
+    cwd = os.getcwd()
+    os.chdir(WORK_DIR)
+    try:
+        result = read_final_events()
+    finally:
+        os.chdir(cwd)
+
+    truth = pd.read_csv(os.path.join(WORK_DIR, 'data', 'truth.csv'))
+    accuracy = compare_events(truth, result)
+    expected = accuracy.loc[accuracy['expected']]
+    report = {
+        'check': 'matching',
+        'tmcs': int(len(expected)),
+        'seconds': round(float(seconds), 3),
+        'tmcs_per_second': round(len(expected) / seconds, 1) if seconds > 0 else None,
+        'skipped_stages': skipped_stages,
+        'match_rate': round(float(expected['matched'].mean()), 4) if len(expected) else 0.0,
+        'correct_rate': round(float(expected['correct'].mean()), 4) if len(expected) else 0.0,
+        'unexpected_tmcs': int((~accuracy['expected']).sum()),
+        'golden': None,
+        'drifted_tmcs': None,
+        'drifted_sample': []
+    }
+
+    # Read the golden run before it may be replaced by this one
+    if golden_path and os.path.exists(golden_path):
+        drift = compare_events(pd.read_csv(golden_path), result)
+        report['golden'] = golden_path
+        report['drifted_tmcs'] = int((~drift['correct']).sum())
+        report['drifted_sample'] = drift.loc[~drift['correct'], 'tmc'].head(20).tolist()
+    if save_golden:
+        result.to_csv(save_golden, index=False)
+    return report
+
+
+def compare_reports(previous, report):
+    """ Returns the change in wall time and in each rate since an earlier report """
+    changes = {}
+    if previous.get('seconds') and report.get('seconds'):
+        changes['speedup'] = round(previous['seconds'] / report['seconds'], 2)
+    for key in ('match_rate', 'correct_rate', 'pass_rate'):
+        if key in previous and key in report:
+            changes[f'{key}_change'] = round(report[key] - previous[key], 4)
+    return changes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare results to golden files')
+    parser.add_argument('check', choices=['autoqc', 'matching'])
+    parser.add_argument('--golden', help=f'golden file.  Defaults to {GOLDEN_AUTOQC} (autoqc) or {GOLDEN_MATCHING} (matching)')
+    parser.add_argument('--sample', type=int, default=500, help='autoqc: the number of golden TMCs to check (0 for all)')
+    parser.add_argument('--scale', type=int, default=1, help='matching: synthetic network size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-golden', nargs='?', const=GOLDEN_MATCHING, help=f'matching: save this run\'s events as the golden file (default {GOLDEN_MATCHING})')
+    parser.add_argument('--report', help='JSON file for the report')
+    parser.add_argument('--compare-report', help='a report from an earlier run.  Adds the change in time and rates')
+    args = parser.parse_args()
+
+    print(f'\nChecking {args.check} against golden results')
+    if args.check == 'autoqc':
+        report = check_autoqc(args.golden or GOLDEN_AUTOQC, args.sample, args.seed)
+    else:
+        report = check_matching(args.scale, args.seed, args.golden or GOLDEN_MATCHING, args.save_golden)
+
+    if args.compare_report:
+        with open(args.compare_report) as file:
+            previous = json.load(file)
+        report.update(compare_reports(previous, report))
+
+    print()
+    for key, value in report.items():
+        print(f'  {key}: {value}')
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if report.get('not_checked'):
+        print('\n  Nothing was checked.  The matching check needs arcpy')
+        sys.exit(EXIT_NOT_CHECKED)
+    if report.get('drifted_tmcs') is None:
+        print('\n  No golden run to check for drift.  Save one with --save-golden')
+    elif report['drifted_tmcs']:
+        sys.exit(EXIT_DRIFTED)
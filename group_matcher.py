@@ -0,0 +1,290 @@
+""" Batched route matching for groups of TMCs (steps 10, 20, and 31).
+
+    Every step that matches a whole group to a single route works the same way:
+
+        1 - Probe each group at a few points along its line (eg begin, mid, end)
+        2 - Every LRS feature near a probe point is a vote for its route
+        3 - Go through a chain of categories (eg routes with the TMC's road
+            number, then routes with its road name, then any other route).  The
+            first category with a single most common route, with enough votes,
+            gives the match
+
+    A GroupMatcher does this for every group of a step at once.  Votes are
+    tallied with route_votes.RouteVotes and the categories are boolean masks
+    over the (group, route) tallies, so there is no per-group loop except for
+    the fuzzy road name matching.
+
+    Groups come from load_groups():
+        'linearId' / 'linearTmc' - the positive direction TMCs merged in roadOrder
+        'tmc' - single TMCs
+
+    write_matches() then locates the TMCs of the matched groups on their routes
+    and writes their statuses through the storage backend (see storage.py).
+
+    Categories are (name, candidates, reducers):
+        candidates(matcher, item, route, previous) - returns a mask of the
+            (group, route) tallies to consider.  previous is the list of
+            candidate masks of the earlier categories
+        reducers - narrow down ties, eg PrimeDirection keeps the prime direction
+            route when both directions of a route are tied
+"""
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import storage
+import trace_log
+from geometry_store import merge_groups
+from route_votes import RouteVotes
+
+THREE_POINTS = (0, 0.5, 1)
+FIVE_POINTS = (0, 0.25, 0.5, 0.75, 1)
+
+
+def is_prime_direction(rte_nm):
+    return isinstance(rte_nm, str) and (rte_nm[7:9] == 'PR' or rte_nm[14:16] in ('NB', 'EB'))
+
+
+def is_state_route(rte_nm):
+    return isinstance(rte_nm, str) and rte_nm.startswith('R-VA')
+
+
+def nearby_routes(matcher, item, route, previous):
+    """ Every route found near the probe points """
+    return np.ones(len(route), dtype=bool)
+
+
+def other_routes(matcher, item, route, previous):
+    """ The routes that weren't candidates of any earlier category """
+    mask = np.ones(len(route), dtype=bool)
+    for candidates in previous:
+        mask &= ~candidates
+    return mask
+
+
+class RouteNumbers():
+    """ Routes that carry the group's road number.
+        road_numbers - {group key: road number}
+        number_index - {road number: RTE_NMs}, see route_index.py """
+    def __init__(self, road_numbers, number_index):
+        self.road_numbers = road_numbers
+        self.number_index = number_index
+
+
+    def __call__(self, matcher, item, route, previous):
+        lrs, n_routes = matcher.lrs, len(matcher.lrs.names)
+        numbers = [self.road_numbers.get(key) for key in matcher.keys]
+        number_codes, unique_numbers = pd.factorize(pd.Series(numbers, dtype=object))
+
+        allowed = [code * n_routes + route_id
+                   for code, number in enumerate(unique_numbers)
+                   for route_id in lrs.route_ids(self.number_index.get(number) or ())]
+        keys = number_codes[item].astype(np.int64) * n_routes + route
+        return (number_codes[item] >= 0) & np.isin(keys, np.array(allowed, dtype=np.int64))
+
+
+class RouteNames():
+    """ Routes whose RTE_NM closely matches the group's road name.  If more than
+        one does, only the PR routes are kept.
+        road_names - {group key: road name}
+        name_index - a route_index.RouteNameIndex """
+    def __init__(self, road_names, name_index):
+        self.road_names = road_names
+        self.name_index = name_index
+
+
+    def __call__(self, matcher, item, route, previous):
+        lrs, n_routes, votes = matcher.lrs, len(matcher.lrs.names), matcher.votes
+        allowed = []
+        for group in np.unique(item):
+            road_name = self.road_names.get(matcher.keys[group])
+            if road_name is None:
+                continue
+            potential_routes = self.name_index.close_matches(road_name, votes.route_names(group))
+            if len(set(potential_routes)) > 1:
+                potential_routes = [rte for rte in potential_routes if rte[7:9] == 'PR']
+            allowed.extend(group * n_routes + route_id for route_id in lrs.route_ids(potential_routes))
+        return np.isin(item.astype(np.int64) * n_routes + route, np.array(allowed, dtype=np.int64))
+
+
+class PrimeDirection():
+    """ When exactly two routes are tied, keeps the prime direction route(s).
+        recount - False keeps only the tied routes that are prime direction.
+            True drops every non-prime route and recounts """
+    def __init__(self, recount=False):
+        self.recount = recount
+
+
+    def __call__(self, matcher, mask, tied, is_top):
+        applies = tied[matcher.item] == 2
+        keep = matcher.prime[matcher.route] if self.recount else matcher.prime[matcher.route] & is_top
+        return mask & ~(applies & ~keep)
+
+
+class StateRoutes():
+    """ When more than two routes are tied, drops every route that isn't a
+        state (R-VA) route and recounts """
+    def __call__(self, matcher, mask, tied, is_top):
+        applies = tied[matcher.item] > 2
+        return mask & ~(applies & ~matcher.state[matcher.route])
+
+
+NEARBY = [('nearby', nearby_routes, [])]
+
+
+class GroupMatcher():
+    def __init__(self, lrs, probes=THREE_POINTS, categories=NEARBY, distance=9, votes=None, min_votes=None, log=None):
+        """
+        inputs:
+            lrs - a CompactLRS (see lrs_model.py)
+            probes - where to probe each group, as fractions of its length
+            categories - (name, candidates, reducers), checked in order
+            distance - search distance around each probe point, in meters
+            votes / min_votes - the winning route needs exactly / at least this
+                many votes
+            log - optional logger for a per-group debug trace
+        """
+        self.lrs = lrs
+        self.probes = probes
+        self.categories = categories
+        self.distance = distance
+        self.required_votes = votes
+        self.min_votes = min_votes
+        self.log = log
+        self.prime = np.array([is_prime_direction(rte_nm) for rte_nm in lrs.names], dtype=bool)
+        self.state = np.array([is_state_route(rte_nm) for rte_nm in lrs.names], dtype=bool)
+
+
+    def top(self, mask):
+        """ Returns (most votes, number of tied routes) of each group, and
+            whether each tally is one of its group's most common routes """
+        most = np.zeros(len(self.keys), dtype=np.int64)
+        np.maximum.at(most, self.item[mask], self.count[mask])
+        is_top = mask & (self.count == most[self.item]) & (self.count > 0)
+        tied = np.bincount(self.item[is_top], minlength=len(self.keys))
+        return most, tied, is_top
+
+
+    @instrumentation.timed()
+    def match(self, store, keys=None):
+        """ Matches every group to a route
+        inputs:
+            store - a GeometryStore of the groups, see load_groups()
+            keys - optional keys of the store to match.  Keys that aren't in the
+                store are skipped
+        output:
+            {key: RTE_NM} for the groups that were matched
+        """
+        rows = np.arange(len(store)) if keys is None else np.array([store.index[key] for key in keys if key in store.index], dtype=np.int64)
+        self.keys = [store.keys[row] for row in rows]
+        self.votes = RouteVotes.from_probes(self.lrs, [store.points_at(fraction)[rows] for fraction in self.probes], self.distance)
+        tallies = self.votes.tallies
+        self.item = np.repeat(np.arange(len(self.keys)), np.diff(tallies.indptr))
+        self.route = tallies.indices.astype(np.int64)
+        self.count = tallies.data.astype(np.int64)
+
+        winners = np.full(len(self.keys), -1, dtype=np.int64)
+        winning_category = np.full(len(self.keys), -1, dtype=np.int64)
+        previous = []
+        for c, (name, candidates, reducers) in enumerate(self.categories):
+            mask = candidates(self, self.item, self.route, previous)
+            previous.append(mask)
+            for reducer in reducers:
+                most, tied, is_top = self.top(mask)
+                mask = reducer(self, mask, tied, is_top)
+
+            most, tied, is_top = self.top(mask)
+            enough = np.ones(len(self.keys), dtype=bool)
+            if self.required_votes is not None:
+                enough &= most == self.required_votes
+            if self.min_votes is not None:
+                enough &= most >= self.min_votes
+            won = is_top & (tied[self.item] == 1) & enough[self.item] & (winners[self.item] < 0)
+            winners[self.item[won]] = self.route[won]
+            winning_category[self.item[won]] = c
+
+        if self.log:
+            self.trace(winners, winning_category)
+        return {str(key): self.lrs.names[winners[i]] for i, key in enumerate(self.keys) if winners[i] >= 0}
+
+
+    def trace(self, winners, winning_category):
+        for i, key in enumerate(self.keys):
+            trace_log.set_tmc(key)
+            if trace_log.enabled(self.log):
+                self.log.debug('\n    %s\n    routes: %s\n    matched: %s (%s)\n', key, self.votes.most_common(i),
+                               self.lrs.names[winners[i]] if winners[i] >= 0 else None,
+                               self.categories[winning_category[i]][0] if winners[i] >= 0 else None)
+        trace_log.set_tmc(None)
+
+
+def load_groups(key, values=None):
+    """ Loads the TMC geometries of a stage's groups
+    inputs:
+        key - 'linearId' or 'linearTmc' to merge the positive direction TMCs
+            of each group in roadOrder, or 'tmc' for single TMCs
+        values - optional linearIds / linearTmcs to merge.  Single TMCs are
+            picked with GroupMatcher.match(store, keys)
+    output:
+        A GeometryStore keyed by group
+    """
+    if key == 'tmc':
+        return storage.get_storage().read_geometry_store('TMCs', 'tmc')
+
+    tmc_store = storage.get_storage().read_geometry_store('TMCs', 'tmc', [key, 'roadOrder'])
+    positive_tmcs = [tmc[3:4] in ('+', 'P') for tmc in tmc_store.keys]  # tmc LIKE '___+%' OR tmc LIKE '___P%'
+    return merge_groups(tmc_store, key, values=values, mask=positive_tmcs)
+
+
+def write_matches(output, key, stage, lrs, where='status IS NULL', log=None):
+    """ Locates every TMC of the matched groups on its route and writes the
+        status, rte_nm, begin_msr, and end_msr through the storage backend
+    inputs:
+        output - {group key: RTE_NM} from GroupMatcher.match
+        key - the TMCs field output is keyed by ('linearId', 'linearTmc', or 'tmc')
+        stage - the stage in the statuses, eg '10' for 'Complete (10)' / 'Error (10)'
+        lrs - the LRS feature class the measures are located on
+        where - the TMCs that may be updated.  TMCs carried forward from the last
+            run (8_carry_forward_unchanged_tmcs.py) or matched by an earlier
+            stage already have a status
+    output:
+        The number of TMCs marked Complete
+    """
+    import arcpy
+    import config
+    import lrs_tools
+    import shapely
+
+    backend = storage.get_storage()
+    tmcs = backend.read_layer('TMCs', list(dict.fromkeys(['tmc', key])), where)
+    tmcs = tmcs[tmcs[key].astype(str).isin(output)]
+
+    located = []
+    errors = []
+    for i, (tmc, group, geom) in enumerate(zip(tmcs['tmc'], tmcs[key].astype(str), tmcs.geometry)):
+        try:
+            rte_nm = output[group]
+            polyline = arcpy.FromWKB(bytearray(shapely.to_wkb(geom)), config.VIRGINIA_LAMBERT)
+            begin_msr, end_msr = lrs_tools.get_line_mp(polyline, lrs, rte_nm)
+
+            # If begin_msr and end_msr are the same, then this should be assumed to be a bad match
+            if begin_msr == end_msr:
+                located.append((tmc, None, None, None, None))
+            else:
+                located.append((tmc, f'Complete ({stage})', rte_nm, begin_msr, end_msr))
+        except Exception as e:
+            instrumentation.count('exceptions_swallowed')
+            if log:
+                log.debug('Error updating %s in TMCs table', tmc)
+                log.debug(e)
+            errors.append(tmc)
+
+        lrs_tools.print_progress_bar(i, max(len(tmcs) - 1, 1), 'Locating MPs for matched routes')
+
+    updates = pd.DataFrame(located, columns=['tmc', 'status', 'rte_nm', 'begin_msr', 'end_msr'], dtype=object).set_index('tmc')
+    if len(updates):
+        backend.update_rows('TMCs', 'tmc', updates)
+    if errors:
+        backend.update_rows('TMCs', 'tmc', pd.DataFrame({'status': f'Error ({stage})'}, index=pd.Index(errors, name='tmc')))
+    return int(updates['status'].notna().sum())
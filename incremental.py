@@ -0,0 +1,270 @@
+""" Incremental conflation.
+
+    Most of the INRIX network doesn't change between releases, so there is no
+    need to match every TMC again.  At the end of every run, 65_save_conflation_state.py
+    saves a hash of each TMC's geometry and key attributes along with its final
+    events and QC score.  On the next run, 8_carry_forward_unchanged_tmcs.py
+    compares the new TMCs to that state.  TMCs with the same hashes that were
+    matched last time get their previous status and events back.  Steps 10-55
+    only look at TMCs with a null status, so only new or changed TMCs are
+    matched again.
+
+    Carried forward results are passed to the later steps through two files:
+        data/_45_carried.csv - events for TMCs that were matched in step 45.
+            These are added to data/_45_output.csv by step 45
+        data/_carried_AutoQC.csv - previous QC results.  AutoQC reuses these
+            instead of scoring the TMC again
+    Both are removed when the state is saved at the end of the run.
+
+    The LRS is tracked the same way.  The state includes a geometry hash and M
+    range for every RTE_NM, and a single hash of the intersections layer.  When
+    the LRS is updated, TMCs whose previous events used a route that changed are
+    not carried forward.  The changed routes are written to
+    data/lrs_changes.json, so 43_create_intersection_dictionary.py only rebuilds
+    those routes' intersections.
+"""
+
+import hashlib
+import json
+import os
+
+import arcpy
+import pandas as pd
+
+import config
+
+STATE_DIR = os.path.join('data', 'conflation_state')
+TMC_STATE = os.path.join(STATE_DIR, 'tmcs.parquet')
+EVENT_STATE = os.path.join(STATE_DIR, 'events.parquet')
+LRS_STATE = os.path.join(STATE_DIR, 'lrs.parquet')
+INTERSECTION_STATE = os.path.join(STATE_DIR, 'intersections.json')
+LRS_CHANGES = os.path.join('data', 'lrs_changes.json')
+CARRIED_EVENTS = os.path.join('data', '_45_carried.csv')
+CARRIED_QC = os.path.join('data', '_carried_AutoQC.csv')
+
+KEY_FIELDS = ['linearId', 'linearTmc', 'roadNumber', 'roadName']
+QC_RESULTS = ['data/_27_AutoQC.csv', 'data/_40_AutoQC.csv', 'data/_55_AutoQC.csv'] # Later results take priority
+FINAL_EVENTS = 'data/final_output.gdb/tmc_complete'
+
+
+def hash_tmcs(feature_class=None):
+    """ Returns a DataFrame of tmc, geom_hash, attr_hash for every TMC """
+    if not feature_class:
+        feature_class = config.TMCs
+
+    records = []
+    with arcpy.da.SearchCursor(feature_class, ['tmc'] + KEY_FIELDS + ['SHAPE@WKB']) as cur:
+        for row in cur:
+            tmc, attributes, wkb = row[0], row[1:-1], row[-1]
+            records.append((
+                tmc,
+                hashlib.blake2b(bytes(wkb) if wkb else b'', digest_size=8).hexdigest(),
+                hashlib.blake2b('|'.join(map(str, attributes)).encode(), digest_size=8).hexdigest()
+            ))
+
+    return pd.DataFrame(records, columns=['tmc', 'geom_hash', 'attr_hash'])
+
+
+def hash_lrs(lrs=None):
+    """ Returns a DataFrame of rte_nm, geom_hash, m_min, m_max for every LRS route """
+    if not lrs:
+        lrs = config.OVERLAP_LRS
+
+    records = []
+    with arcpy.da.SearchCursor(lrs, ['RTE_NM', 'SHAPE@WKB', 'SHAPE@']) as cur:
+        for rte_nm, wkb, geom in cur:
+            records.append((
+                rte_nm,
+                hashlib.blake2b(bytes(wkb) if wkb else b'', digest_size=8).hexdigest(),
+                geom.extent.MMin if geom else None,
+                geom.extent.MMax if geom else None
+            ))
+
+    return pd.DataFrame(records, columns=['rte_nm', 'geom_hash', 'm_min', 'm_max'])
+
+
+def hash_intersections(intersections=None):
+    """ Returns a single hash of the intersections layer.  Step 45 refers to
+        intersections by OBJECTID, so any change means the whole intersection
+        dictionary has to be rebuilt """
+    if not intersections:
+        intersections = config.INTERSECTIONS
+
+    digest = hashlib.blake2b(digest_size=8)
+    with arcpy.da.SearchCursor(intersections, ['OID@', 'SHAPE@WKB'], sql_clause=(None, 'ORDER BY OBJECTID')) as cur:
+        for oid, wkb in cur:
+            digest.update(str(oid).encode())
+            digest.update(bytes(wkb) if wkb else b'')
+    return digest.hexdigest()
+
+
+def diff_lrs(previous, current):
+    """ Returns the RTE_NMs that were added, removed, moved, or re-measured """
+    merged = previous.merge(current, on='rte_nm', how='outer', suffixes=('_previous', ''), indicator=True)
+    changed = (
+        (merged['_merge'] != 'both') |
+        (merged['geom_hash'] != merged['geom_hash_previous']) |
+        (merged['m_min'].round(3).fillna(-1) != merged['m_min_previous'].round(3).fillna(-1)) |
+        (merged['m_max'].round(3).fillna(-1) != merged['m_max_previous'].round(3).fillna(-1))
+    )
+    return set(merged.loc[changed, 'rte_nm'])
+
+
+def find_lrs_changes(state_dir=STATE_DIR):
+    """ Compares the current LRS to the LRS of the last run and writes the
+        changes to LRS_CHANGES.  Returns (changed RTE_NMs, intersections_changed),
+        or (None, None) if there is no previous LRS state """
+    lrs_state = os.path.join(state_dir, os.path.basename(LRS_STATE))
+    intersection_state = os.path.join(state_dir, os.path.basename(INTERSECTION_STATE))
+    if not os.path.exists(lrs_state):
+        return None, None
+
+    print('  Comparing LRS to the last run')
+    changed_routes = diff_lrs(pd.read_parquet(lrs_state), hash_lrs())
+
+    intersections_changed = True
+    if os.path.exists(intersection_state):
+        with open(intersection_state) as file:
+            intersections_changed = json.load(file)['hash'] != hash_intersections()
+
+    print(f'  {len(changed_routes)} LRS routes changed.  Intersections changed: {intersections_changed}')
+    with open(LRS_CHANGES, 'w') as file:
+        json.dump({'routes': sorted(changed_routes), 'intersections_changed': intersections_changed}, file)
+
+    return changed_routes, intersections_changed
+
+
+def load_lrs_changes():
+    """ Returns the contents of LRS_CHANGES, or None if there isn't one """
+    if not os.path.exists(LRS_CHANGES):
+        return None
+    with open(LRS_CHANGES) as file:
+        return json.load(file)
+
+
+def load_qc_scores():
+    """ Returns the latest QC result for each TMC from this run's AutoQC outputs """
+    results = [pd.read_csv(path) for path in QC_RESULTS if os.path.exists(path)]
+    if not results:
+        return pd.DataFrame(columns=['tmc'])
+    return pd.concat(results).drop_duplicates('tmc', keep='last')
+
+
+def save_state(feature_class=None, events_table=FINAL_EVENTS, state_dir=STATE_DIR):
+    """ Saves the TMC hashes, statuses, QC results and final events of this run """
+    if not feature_class:
+        feature_class = config.TMCs
+
+    print('  Hashing TMCs')
+    tmcs = hash_tmcs(feature_class)
+
+    print('  Reading statuses and events')
+    status = pd.DataFrame([row for row in arcpy.da.SearchCursor(feature_class, ['tmc', 'status'])], columns=['tmc', 'status'])
+    tmcs = tmcs.merge(status, on='tmc', how='left')
+
+    qc = load_qc_scores()
+    tmcs = tmcs.merge(qc, on='tmc', how='left')
+
+    fields = ['tmc', 'rte_nm', 'begin_msr', 'end_msr']
+    events = pd.DataFrame([row for row in arcpy.da.SearchCursor(events_table, fields)], columns=fields)
+
+    print('  Hashing LRS and intersections')
+    lrs = hash_lrs()
+    intersections = hash_intersections()
+
+    os.makedirs(state_dir, exist_ok=True)
+    tmcs.to_parquet(os.path.join(state_dir, os.path.basename(TMC_STATE)), index=False)
+    events.to_parquet(os.path.join(state_dir, os.path.basename(EVENT_STATE)), index=False)
+    lrs.to_parquet(os.path.join(state_dir, os.path.basename(LRS_STATE)), index=False)
+    with open(os.path.join(state_dir, os.path.basename(INTERSECTION_STATE)), 'w') as file:
+        json.dump({'hash': intersections}, file)
+    print(f'  Saved state for {len(tmcs)} TMCs, {len(events)} events and {len(lrs)} LRS routes to {state_dir}')
+
+    # Carried results and LRS changes only apply to the run they were made for
+    for path in (CARRIED_EVENTS, CARRIED_QC, LRS_CHANGES):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def find_unchanged(current, previous):
+    """ Returns the previous state of the TMCs whose hashes haven't changed and
+        that were matched last time """
+    merged = current.merge(previous, on='tmc', suffixes=('', '_previous'))
+    unchanged = (merged['geom_hash'] == merged['geom_hash_previous']) & (merged['attr_hash'] == merged['attr_hash_previous'])
+    matched = merged['status'].fillna('').str.startswith('Complete')
+    return merged.loc[unchanged & matched]
+
+
+def carry_forward(feature_class=None, state_dir=STATE_DIR, exclude_tmcs=()):
+    """ Restores the previous results of unchanged TMCs.  TMCs in exclude_tmcs,
+        and TMCs with a previous event on an LRS route that has changed, are
+        always matched again.  Returns the number of TMCs carried forward """
+    if not feature_class:
+        feature_class = config.TMCs
+
+    tmc_state = os.path.join(state_dir, os.path.basename(TMC_STATE))
+    event_state = os.path.join(state_dir, os.path.basename(EVENT_STATE))
+    if not os.path.exists(tmc_state):
+        print('  No previous state found.  All TMCs will be matched')
+        return 0
+
+    print('  Hashing TMCs')
+    current = hash_tmcs(feature_class)
+    previous = pd.read_parquet(tmc_state)
+    events = pd.read_parquet(event_state)
+
+    exclude_tmcs = set(exclude_tmcs)
+    changed_routes, intersections_changed = find_lrs_changes(state_dir)
+    if changed_routes:
+        affected = set(events.loc[events['rte_nm'].isin(changed_routes), 'tmc'])
+        print(f'  {len(affected)} TMCs have events on changed LRS routes')
+        exclude_tmcs |= affected
+
+    unchanged = find_unchanged(current, previous)
+    unchanged = unchanged.loc[~unchanged['tmc'].isin(exclude_tmcs)]
+    print(f'  {len(unchanged)} of {len(current)} TMCs are unchanged')
+
+    # Single-route TMCs are restored on the TMC layer.  Detailed (45) TMCs may have
+    # several events, so they are passed to step 45 through CARRIED_EVENTS instead
+    carried_status = dict(zip(unchanged['tmc'], unchanged['status']))
+    detailed = {tmc for tmc, status in carried_status.items() if status.startswith('Complete (45)')}
+    single_events = {row.tmc: row for row in events.loc[events['tmc'].isin(set(carried_status) - detailed)].itertuples()}
+
+    print('  Restoring previous results')
+    with arcpy.da.UpdateCursor(feature_class, ['tmc', 'status', 'rte_nm', 'begin_msr', 'end_msr']) as cur:
+        for row in cur:
+            tmc = row[0]
+            if tmc in detailed:
+                row[1] = carried_status[tmc]
+                cur.updateRow(row)
+            elif tmc in single_events:
+                event = single_events[tmc]
+                row[1] = carried_status[tmc]
+                row[2] = event.rte_nm
+                row[3] = event.begin_msr
+                row[4] = event.end_msr
+                cur.updateRow(row)
+
+    events.loc[events['tmc'].isin(detailed)].to_csv(CARRIED_EVENTS, index=False)
+
+    qc_columns = [col for col in previous.columns if col not in ('geom_hash', 'attr_hash', 'status')]
+    qc = unchanged[qc_columns]
+    if 'confidence' in qc.columns:
+        qc.loc[qc['confidence'].notna()].to_csv(CARRIED_QC, index=False)
+
+    return len(unchanged)
+
+
+def load_carried_events():
+    """ Returns the carried forward detailed events, or None """
+    if os.path.exists(CARRIED_EVENTS):
+        return pd.read_csv(CARRIED_EVENTS)
+    return None
+
+
+def load_carried_scores():
+    """ Returns {tmc: QC record} for the carried forward TMCs """
+    if not os.path.exists(CARRIED_QC):
+        return {}
+    qc = pd.read_csv(CARRIED_QC)
+    return {record['tmc']: record for record in qc.to_dict('records')}
@@ -0,0 +1,164 @@
+""" Lightweight timers and counters for profiling pipeline runs.
+
+    Instrumentation is off unless the TMC_LRS_PROFILE environment variable is
+    set to the folder the profiles should be written to (eg logs).  When it is
+    off, timed() returns functions unchanged and count() returns immediately,
+    so the hot paths pay nothing.
+
+    When it is on, every script writes two files to that folder when it exits:
+        <script>_profile.json - timers (calls, total, mean, and max seconds) and counters
+        <script>_profile.csv - the same, one row per timer or counter
+
+    Counters used in the pipeline:
+        spatial_queries - spatial index queries and select by location calls
+        cursors - arcpy cursors opened
+        routes_located - measures found on the LRS
+        cache_hits / cache_misses - eg rte_int_dict lookups
+        exceptions_swallowed - errors caught and logged instead of raised
+
+    Set TMC_LRS_PROFILE_SAMPLE to a number of milliseconds to also run a
+    sampling profiler.  A background thread records the main thread's stack at
+    that interval and writes <script>_profile.folded, which can be turned into a
+    flame graph (eg with flamegraph.pl or speedscope).
+"""
+
+import atexit
+import csv
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+PROFILE_DIR = os.environ.get('TMC_LRS_PROFILE')
+ENABLED = bool(PROFILE_DIR)
+SAMPLE_INTERVAL = float(os.environ.get('TMC_LRS_PROFILE_SAMPLE', 0)) / 1000
+
+timers = {}  # name: [calls, total seconds, max seconds]
+counters = Counter()
+samples = Counter()  # Folded stack: number of samples
+
+
+def record(name, seconds):
+    timer = timers.get(name)
+    if timer is None:
+        timers[name] = [1, seconds, seconds]
+    else:
+        timer[0] += 1
+        timer[1] += seconds
+        if seconds > timer[2]:
+            timer[2] = seconds
+
+
+def timed(name=None):
+    """ Decorator that times every call of a function.  Does nothing unless
+        profiling is on """
+    def decorator(function):
+        if not ENABLED:
+            return function
+        label = name or f'{function.__module__}.{function.__name__}'
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(label, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timer(name):
+    """ Times a block of code """
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def count(name, n=1):
+    if ENABLED:
+        counters[name] += n
+
+
+def summary():
+    """ Returns the timers and counters as a dictionary """
+    return {
+        'timers': {
+            name: {'calls': calls, 'total': round(total, 6), 'mean': round(total / calls, 6), 'max': round(longest, 6)}
+            for name, (calls, total, longest) in sorted(timers.items(), key=lambda item: -item[1][1])
+        },
+        'counters': dict(sorted(counters.items()))
+    }
+
+
+def write_profile(output_dir=None, name=None):
+    """ Writes the JSON and CSV profiles (and folded stacks, if sampling) """
+    output_dir = output_dir or PROFILE_DIR
+    name = name or os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f'{name}_profile')
+    profile = summary()
+
+    with open(f'{path}.json', 'w') as file:
+        json.dump(profile, file, indent=2)
+
+    with open(f'{path}.csv', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['kind', 'name', 'calls', 'total', 'mean', 'max'])
+        for timer_name, stats in profile['timers'].items():
+            writer.writerow(['timer', timer_name, stats['calls'], stats['total'], stats['mean'], stats['max']])
+        for counter_name, value in profile['counters'].items():
+            writer.writerow(['counter', counter_name, value, '', '', ''])
+
+    if samples:
+        with open(f'{path}.folded', 'w') as file:
+            for stack, n in samples.most_common():
+                file.write(f'{stack} {n}\n')
+
+
+class SamplingProfiler(threading.Thread):
+    """ Records the stack of a thread every interval seconds """
+    def __init__(self, interval, thread_id=None):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.thread_id = thread_id or threading.main_thread().ident
+        self.stopped = threading.Event()
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                samples[';'.join(reversed(stack))] += 1
+
+
+    def stop(self):
+        self.stopped.set()
+
+
+if ENABLED:
+    profiler = None
+    if SAMPLE_INTERVAL > 0:
+        profiler = SamplingProfiler(SAMPLE_INTERVAL)
+        profiler.start()
+
+    def _finish():
+        if profiler:
+            profiler.stop()
+        write_profile()
+    atexit.register(_finish)
@@ -0,0 +1,231 @@
+""" A compact, read-only copy of the LRS for finding nearby routes.
+
+    Only RTE_NM and the geometry are read from the LRS shapefile.  Each
+    distinct RTE_NM is stored once in names, and features refer to it by an
+    integer code:
+
+        names[feature_codes[i]] is the RTE_NM of feature i
+
+    feature_codes are also the route ids used for voting (see route_votes.py).
+
+    Vertices of every line part are kept in one float64 array, the same way
+    geometry_store.py keeps TMC vertices:
+
+        xy[offsets[j]:offsets[j + 1]] are the vertices of part j
+        part_features[j] is the feature that part j belongs to
+
+    If the LRS is read with its M values (from_geopackage, or geometries with
+    M), m[i] is the measure of vertex i and measures_at() interpolates them.
+    Otherwise m is None.
+
+    The shapely lines and their STRtree are built from those arrays the first
+    time they are needed.  Pickling keeps only the arrays, so a CompactLRS is
+    small to cache on disk (see load_lrs) and cheap to pass to worker processes.
+"""
+
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import config
+
+
+class CompactLRS():
+    def __init__(self, names, feature_codes, part_features, xy, offsets, m=None):
+        self.names = list(names)
+        self.feature_codes = np.asarray(feature_codes, dtype=np.int32)
+        self.part_features = np.asarray(part_features, dtype=np.int32)
+        self.xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.m = np.asarray(m, dtype=np.float64) if m is not None else None
+        self.codes = {name: code for code, name in enumerate(self.names)}
+        self._lines = None
+        self._tree = None
+        self._vertex_along = None
+
+
+    @classmethod
+    def from_geometries(cls, rte_nms, geometries):
+        """ Builds the model from RTE_NMs and shapely (Multi)LineStrings.  M
+            values are kept if any geometry has them.  Z values are dropped """
+        import shapely
+
+        feature_codes, names = pd.factorize(pd.Series(rte_nms, dtype=object), use_na_sentinel=False)
+        parts, part_features = shapely.get_parts(np.asarray(geometries, dtype=object), return_index=True)
+
+        # Parts with less than two vertices can't be made into lines
+        valid = shapely.get_num_coordinates(parts) >= 2
+        parts, part_features = parts[valid], part_features[valid]
+
+        m = None
+        if shapely.has_m(parts).any():
+            xym, vertex_part = shapely.get_coordinates(parts, include_m=True, return_index=True)
+            xy, m = xym[:, :2], xym[:, 2]
+        else:
+            xy, vertex_part = shapely.get_coordinates(parts, return_index=True)
+        offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(vertex_part, minlength=len(parts)), out=offsets[1:])
+        return cls(names, feature_codes, part_features, xy, offsets, m)
+
+
+    @classmethod
+    def from_file(cls, path=None, field='RTE_NM'):
+        """ Reads only field and the geometry of the LRS shapefile (or
+            GeoPackage, see from_geopackage) """
+        import pyogrio
+
+        path = path or config.LRS_SHP
+        if path.endswith('.gpkg'):
+            return cls.from_geopackage(path, field=field)
+        lrs = pyogrio.read_dataframe(path, columns=[field])
+        return cls.from_geometries(lrs[field], lrs.geometry.values)
+
+
+    @classmethod
+    def from_geopackage(cls, path=None, layer='master_lrs', field='RTE_NM'):
+        """ Reads the LRS from the columnar storage GeoPackage (see storage.py)
+            with its M values, which GDAL drops """
+        import sqlite3
+        from storage import gpkg_geometry, quote
+
+        with sqlite3.connect(path or config.COLUMNAR_DB) as conn:
+            geometry_column = conn.execute('SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?', (layer,)).fetchone()[0]
+            rows = conn.execute(f'SELECT {quote(field)}, {quote(geometry_column)} FROM {quote(layer)}').fetchall()
+        return cls.from_geometries([row[0] for row in rows], [gpkg_geometry(row[1]) if row[1] else None for row in rows])
+
+
+    def __getstate__(self):
+        return {
+            'names': self.names,
+            'feature_codes': self.feature_codes,
+            'part_features': self.part_features,
+            'xy': self.xy,
+            'offsets': self.offsets,
+            'm': self.m
+        }
+
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+    def __len__(self):
+        return len(self.feature_codes)
+
+
+    @property
+    def lines(self):
+        """ A shapely LineString for every part """
+        if self._lines is None:
+            import shapely
+            vertex_part = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+            self._lines = shapely.linestrings(self.xy, indices=vertex_part)
+        return self._lines
+
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            import shapely
+            self._tree = shapely.STRtree(self.lines)
+        return self._tree
+
+
+    def query(self, geometry, distance=0):
+        """ Returns the features (in order) that intersect geometry, buffered by
+            distance the same way the GeoPandas search buffers its points """
+        area = geometry.buffer(distance) if distance else geometry
+        return np.unique(self.part_features[self.tree.query(area, predicate='intersects')])
+
+
+    def query_many(self, points, distance=0):
+        """ Finds the features near every point at once.  Missing points (None
+            or nan) are skipped.  distance can also be an array with a search
+            distance for every point.  Returns (point index, feature) pairs,
+            sorted by point and then feature """
+        import shapely
+
+        points = np.asarray(points, dtype=object)
+        valid = np.flatnonzero(~(shapely.is_missing(points) | shapely.is_empty(points)))
+        distance = np.broadcast_to(np.asarray(distance, dtype=np.float64), points.shape)[valid]
+        areas = np.where(distance > 0, shapely.buffer(points[valid], distance), points[valid])
+        area_index, parts = self.tree.query(areas, predicate='intersects')
+
+        pairs = np.unique(valid[area_index].astype(np.int64) * len(self) + self.part_features[parts])
+        return pairs // len(self), (pairs % len(self)).astype(np.int32)
+
+
+    @property
+    def vertex_along(self):
+        """ The distance of every vertex from the start of its part """
+        if self._vertex_along is None:
+            step = np.zeros(len(self.xy))
+            step[1:] = np.hypot(*np.diff(self.xy, axis=0).T)
+            step[self.offsets[:-1][np.diff(self.offsets) > 0]] = 0
+            along = np.cumsum(step)
+            self._vertex_along = along - np.repeat(along[self.offsets[:-1]] if len(along) else [], np.diff(self.offsets))
+        return self._vertex_along
+
+
+    def measures_at(self, parts, along):
+        """ Returns the measure at a distance along each part, interpolated from
+            the M values.  nan if the LRS has no M values """
+        measures = np.full(len(parts), np.nan)
+        if self.m is None:
+            return measures
+        for i, (part, distance) in enumerate(zip(parts, along)):
+            start, end = self.offsets[part], self.offsets[part + 1]
+            measures[i] = np.interp(distance, self.vertex_along[start:end], self.m[start:end])
+        return measures
+
+
+    def require_measures(self):
+        """ Raises ValueError if the LRS has no M values, eg when it was read
+            from the shapefile with GDAL, which drops them """
+        if self.m is None:
+            raise ValueError('The LRS has no M values, so measures can\'t be located.  Load it from the '
+                             'GeoPackage (config.COLUMNAR_DB, see CompactLRS.from_geopackage)')
+
+
+    def route_ids(self, rte_nms):
+        """ Returns the set of route ids of the RTE_NMs that are in the LRS """
+        return {self.codes[rte_nm] for rte_nm in rte_nms if rte_nm in self.codes}
+
+
+    def nearby_routes(self, geometry, distance=0):
+        """ Returns the RTE_NM of every feature near geometry """
+        return [self.names[code] for code in self.feature_codes[self.query(geometry, distance)]]
+
+
+def lrs_version(path, layer='master_lrs'):
+    """ Returns what changes when the LRS does.  For the GeoPackage that's the
+        layer's last_change, since the TMC status updates rewrite the file """
+    if path.endswith('.gpkg'):
+        import sqlite3
+        with sqlite3.connect(path) as conn:
+            row = conn.execute('SELECT last_change FROM gpkg_contents WHERE table_name = ?', (layer,)).fetchone()
+        return row[0] if row else None
+    return os.path.getmtime(path)
+
+
+def load_lrs(path=None, cache=True):
+    """ Returns the CompactLRS of the LRS shapefile (or the GeoPackage's
+        master_lrs layer).  The model is pickled next to the file and reused
+        until the LRS changes (see lrs_version) """
+    path = path or config.LRS_SHP
+    cache_path = f'{os.path.splitext(path)[0]}_compact.pickle'
+    version = lrs_version(path)
+
+    if cache and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as file:
+            cached = pickle.load(file)
+        if isinstance(cached, tuple) and cached[0] == version:
+            return cached[1]
+
+    lrs = CompactLRS.from_file(path)
+    if cache:
+        with open(cache_path, 'wb') as file:
+            pickle.dump((version, lrs), file, protocol=pickle.HIGHEST_PROTOCOL)
+    return lrs
@@ -1,13 +1,12 @@
 import arcpy
-import logging
+import trace_log
 import sys
 import geopandas as gp
 from shapely.geometry import Point
+import instrumentation
+from lrs_model import CompactLRS
 
-log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG) # Set the debug level here
-fileHandler = logging.FileHandler(f'logs\lrs_tools.log', mode='w')
-log.addHandler(fileHandler)
+log = trace_log.get_logger(__name__, 'lrs_tools')
 
 
 
@@ -21,6 +20,16 @@ def print_progress_bar(index, total, label):
     sys.stdout.flush()
 
 
+def point_geometry(xy, spatial_reference=None):
+    """ Returns an arcpy PointGeometry for an (x, y) pair, or None if the pair is
+        missing (nan) """
+    x, y = xy
+    if x != x or y != y:
+        return None
+    return arcpy.PointGeometry(arcpy.Point(x, y), spatial_reference=spatial_reference)
+
+
+@instrumentation.timed()
 def find_nearby_routes(point, lrs, segment_geometry=None, searchDistance="9 METERS", rerun=False):
     """ Given an input point, will return a list of all routes within the searchDistance """
 
@@ -33,6 +42,8 @@ def find_nearby_routes(point, lrs, segment_geometry=None, searchDistance="9 METE
 
     routes = []
     arcpy.management.SelectLayerByLocation(lrs, 'WITHIN_A_DISTANCE', point, searchDistance)
+    instrumentation.count('spatial_queries')
+    instrumentation.count('cursors')
     with arcpy.da.SearchCursor(lrs, 'RTE_NM') as cur:
         for row in cur:
             routes.append(row[0])
@@ -40,11 +51,13 @@ def find_nearby_routes(point, lrs, segment_geometry=None, searchDistance="9 METE
     return routes
 
 
+@instrumentation.timed()
 def find_nearby_routes_geopandas(point, geopandas_lrs, segment_geometry=None, searchDistance=9, rerun=False):
-    """ Given an input point, will return a list of all routes within the searchDistance """
+    """ Given an input point, will return a list of all routes within the searchDistance
 
-    # Unpack LRS GeoDataFrame and Spatial Index from geopandas_lrs
-    lrsSHP, lrsSIndex = geopandas_lrs
+        geopandas_lrs - a CompactLRS (see lrs_model.py), or a tuple of the LRS
+            GeoDataFrame and its spatial index
+    """
 
     # Short routes require a short search distance in order to find anything
     if segment_geometry and segment_geometry.getLength() < 18:
@@ -56,9 +69,17 @@ def find_nearby_routes_geopandas(point, geopandas_lrs, segment_geometry=None, se
     # Convert input point to shapely point
     point = Point(point.firstPoint.X, point.firstPoint.Y)
 
+    if isinstance(geopandas_lrs, CompactLRS):
+        instrumentation.count('spatial_queries')
+        return geopandas_lrs.nearby_routes(point, searchDistance)
+
+    # Unpack LRS GeoDataFrame and Spatial Index from geopandas_lrs
+    lrsSHP, lrsSIndex = geopandas_lrs
+
     # Locate nearby routes
     pointBuffer = point.buffer(searchDistance)
     possible_routes_index = list(lrsSIndex.query(pointBuffer))
+    instrumentation.count('spatial_queries')
     possible_routes = lrsSHP.iloc[possible_routes_index]
     routes = possible_routes[possible_routes.intersects(pointBuffer)]["RTE_NM"].tolist()
 
@@ -67,6 +88,7 @@ def find_nearby_routes_geopandas(point, geopandas_lrs, segment_geometry=None, se
     return routes
 
 
+@instrumentation.timed()
 def get_point_mp(inputPointGeometry, lrs, rte_nm, lyrIntersections):
     """ Locates the MP value of an input point along the LRS
         ** The spatial reference of the input must match the spatial reference
@@ -82,6 +104,7 @@ def get_point_mp(inputPointGeometry, lrs, rte_nm, lyrIntersections):
         # Get the geometry for the LRS route
         arcpy.management.SelectLayerByAttribute(lrs,'CLEAR_SELECTION')
 
+        instrumentation.count('cursors')
         with arcpy.da.SearchCursor(lrs, "SHAPE@", "RTE_NM = '{}'".format(rte_nm)) as cur:
             for row in cur:
                 RouteGeom = row[0]
@@ -109,29 +132,32 @@ def get_point_mp(inputPointGeometry, lrs, rte_nm, lyrIntersections):
             rtePosition = RouteGeom.positionAlongLine(rteMeasure)
 
         mp = rtePosition.firstPoint.M
+        instrumentation.count('routes_located')
         return round(mp, 3)
     
     except Exception as e:
+        instrumentation.count('exceptions_swallowed')
         print(e)
         print(rte_nm)
         return None
 
 
+@instrumentation.timed()
 def get_points_along_line(geom, d=50, rerun=False):
     """ Find points every d distance along the input polyline geometry and
         return them as a list """
     
     segLen = geom.getLength('GEODESIC','METERS')
-    log.debug(f'      segLen: {segLen}')
+    log.debug('      segLen: %s', segLen)
 
     # For short segments, reduce m to increase the number of test points
     if segLen <= 150:
         if rerun == False:
             d = segLen / 4
-            log.debug(f'      Reduced d to {d}')
+            log.debug('      Reduced d to %s', d)
         else:            
             d = segLen / 5
-            log.debug(f'      Reduced d to {d}')
+            log.debug('      Reduced d to %s', d)
     points = []
 
     m = 0
@@ -139,29 +165,33 @@ def get_points_along_line(geom, d=50, rerun=False):
         points.append(geom.positionAlongLine(m))
         m += d
 
-    for point in points:
-        log.debug(f'        {point.firstPoint.X}, {point.firstPoint.Y}')
+    if trace_log.enabled(log):
+        for point in points:
+            log.debug('        %s, %s', point.firstPoint.X, point.firstPoint.Y)
     
     return points
 
 
+@instrumentation.timed()
 def move_to_closest_int(geom, lyrIntersections, testDistance=10):
     """ Returns input testGeom moved to the nearest intersection """
-    log.debug(f"        move_to_closest_int input geom: {geom.firstPoint.X}, {geom.firstPoint.Y}")
+    log.debug('        move_to_closest_int input geom: %s, %s', geom.firstPoint.X, geom.firstPoint.Y)
 
     arcpy.SelectLayerByLocation_management(lyrIntersections, "INTERSECT", geom, testDistance)
+    instrumentation.count('spatial_queries')
+    instrumentation.count('cursors')
     intersections = [row[0] for row in arcpy.da.SearchCursor(lyrIntersections, "SHAPE@")]
     if len(intersections) == 0:
-        log.debug(f"        No intersections within {testDistance}m distance.  Returning testGeom.")
+        log.debug('        No intersections within %sm distance.  Returning testGeom.', testDistance)
         moved = False
         return geom, moved
     
     if len(intersections) == 1:
-        log.debug(f"        One intersection within {testDistance}m distance.  Returning intersection at {intersections[0].firstPoint.X}, {intersections[0].firstPoint.Y}.")
+        log.debug('        One intersection within %sm distance.  Returning intersection at %s, %s.', testDistance, intersections[0].firstPoint.X, intersections[0].firstPoint.Y)
         moved = True
         return intersections[0].firstPoint, moved
 
-    log.debug(f"        {len(intersections)} intersections found.  Returning closest intersection.")
+    log.debug('        %s intersections found.  Returning closest intersection.', len(intersections))
     closestInt = intersections[0]
     closestIntDist = testDistance
     for intersection in intersections:
@@ -170,11 +200,12 @@ def move_to_closest_int(geom, lyrIntersections, testDistance=10):
             closestInt = intersection
             closestIntDist = dist
     
-    log.debug(f"        Returning intersection at {closestInt.firstPoint.X}, {closestInt.firstPoint.Y}")
+    log.debug('        Returning intersection at %s, %s', closestInt.firstPoint.X, closestInt.firstPoint.Y)
     moved = True
     return closestInt.firstPoint, moved
 
 
+@instrumentation.timed()
 def get_most_common(c):
     """ Returns a list of the most common values found in the input counter c """
     freq_list = list(c.values())
@@ -185,6 +216,7 @@ def get_most_common(c):
     return most_commons
 
 
+@instrumentation.timed()
 def get_line_mp(inputPolyline, lrs, rte_nm, RouteGeom=None):
     """ Locates the begin and end MP values of an input line along the LRS
         ** The spatial reference of the input must match the spatial reference
@@ -199,6 +231,7 @@ def get_line_mp(inputPolyline, lrs, rte_nm, RouteGeom=None):
 
     try:
         # Get the geometry for the LRS route
+        instrumentation.count('cursors')
         with arcpy.da.SearchCursor(lrs, "SHAPE@", "RTE_NM = '{}'".format(rte_nm)) as cur:
             for row in cur:
                 RouteGeom = row[0]
@@ -235,12 +268,39 @@ def get_line_mp(inputPolyline, lrs, rte_nm, RouteGeom=None):
         endPt = inputPolyline.lastPoint
         endMP = get_mp_from_point(RouteGeom, endPt)
 
+        instrumentation.count('routes_located')
         return round(beginMP, 3), round(endMP, 3)
 
     except Exception as e:
+        instrumentation.count('exceptions_swallowed')
         return None, None
 
 
+def get_route_intersections(rte_nm, lrs, intersections, intDict=None):
+    """ Returns the OBJECTIDs of the intersections within 5 meters of a route
+        inputs:
+            intDict - a dictionary containing a list of intersection OBJECTIDs for each RTE_NM (see
+                43_create_intersection_dictionary.py).  Routes in it don't need a selection
+    """
+    if intDict and rte_nm in intDict:
+        instrumentation.count('cache_hits')
+        return intDict[rte_nm]
+    instrumentation.count('cache_misses')
+
+    # If no intDict or rte_nm not found.  This is significanly more time consuming
+    arcpy.management.SelectLayerByAttribute(lrs,'CLEAR_SELECTION')
+    arcpy.management.SelectLayerByAttribute(intersections,'CLEAR_SELECTION')
+
+    geom = [row[0] for row in arcpy.da.SearchCursor(lrs, 'SHAPE@', f"RTE_NM = '{rte_nm}'")][0]
+
+    arcpy.SelectLayerByLocation_management(intersections, 'WITHIN_A_DISTANCE', geom, '5 METERS', 'NEW_SELECTION')
+    instrumentation.count('cursors')
+    instrumentation.count('spatial_queries')
+
+    return list(intersections.getSelectionSet())
+
+
+@instrumentation.timed()
 def find_common_intersection(rteA, rteB, lrs, intersections, TMCSeg, intDict=None, commonIntsUsed=[]):
     """ Given two rte_nms, this will return the intersection objectID if the two
         routes share a single intersection 
@@ -257,23 +317,9 @@ def find_common_intersection(rteA, rteB, lrs, intersections, TMCSeg, intDict=Non
                 list, it won't be considered when finding common intersections
         """
 
-    def get_ints(rte_nm, lrs, intersections):
-        if intDict and rte_nm in intDict:
-            return intDict[rte_nm]
-
-        # If no intDict or rte_nm not found.  This is significanly more time consuming
-        arcpy.management.SelectLayerByAttribute(lrs,'CLEAR_SELECTION')
-        arcpy.management.SelectLayerByAttribute(intersections,'CLEAR_SELECTION')
-
-        geom = [row[0] for row in arcpy.da.SearchCursor(lrs, 'SHAPE@', f"RTE_NM = '{rte_nm}'")][0]
-
-        arcpy.SelectLayerByLocation_management(intersections, 'WITHIN_A_DISTANCE', geom, '5 METERS', 'NEW_SELECTION')
-
-
-        return list(intersections.getSelectionSet())
     try:
-        rteAInts = get_ints(rteA, lrs, intersections)
-        rteBInts = get_ints(rteB, lrs, intersections)
+        rteAInts = get_route_intersections(rteA, lrs, intersections, intDict)
+        rteBInts = get_route_intersections(rteB, lrs, intersections, intDict)
 
         commonInts = [rte for rte in rteAInts if rte in rteBInts]
 
@@ -282,30 +328,32 @@ def find_common_intersection(rteA, rteB, lrs, intersections, TMCSeg, intDict=Non
             commonInts = [int for int in commonInts if int not in commonIntsUsed]
 
         if len(commonInts) == 1:
-            log.debug(f'        One common intersection found: {commonInts}\n')
+            log.debug('        One common intersection found: %s\n', commonInts)
             return commonInts[0]
 
         if len(commonInts) > 1:
-            log.debug(f'        {len(commonInts)} common intersections found: {commonInts}\n')
+            log.debug('        %s common intersections found: %s\n', len(commonInts), commonInts)
             # Attempt to narrow down intersections to one
-            log.debug(f'        Selecting only nearby common intersections')
+            log.debug('        Selecting only nearby common intersections')
             arcpy.management.SelectLayerByAttribute(intersections,'CLEAR_SELECTION')
             arcpy.SelectLayerByLocation_management(intersections, "INTERSECT", TMCSeg.tmc_geom, "10 METERS")
+            instrumentation.count('spatial_queries')
             nearbyInts = intersections.getSelectionSet()
             commonInts2 = [int for int in nearbyInts if int in commonInts]
             if len(commonInts2) == 1:
-                log.debug(f'        {len(commonInts2)} nearby common intersection found.  Returning {commonInts2[0]}')
+                log.debug('        %s nearby common intersection found.  Returning %s', len(commonInts2), commonInts2[0])
                 return commonInts2[0]
 
             if len(commonInts2) == 0:
-                log.debug(f'        {len(commonInts2)} nearby common intersections found.  Returning None and hoping for the best')
+                log.debug('        %s nearby common intersections found.  Returning None and hoping for the best', len(commonInts2))
                 return None
 
-            log.debug(f'        {len(commonInts2)} nearby common intersections found.  Returning int closest to end point and hoping for the best')
+            log.debug('        %s nearby common intersections found.  Returning int closest to end point and hoping for the best', len(commonInts2))
             closestInt = commonInts[0]
             closestIntDist = None
             for intersection in commonInts:
                 intGeom = [row[0] for row in arcpy.da.SearchCursor(intersections,'SHAPE@',f'OBJECTID = {intersection}')][0]
+                instrumentation.count('cursors')
                 TMC_end_point = arcpy.PointGeometry(TMCSeg.tmc_geom.lastPoint,arcpy.SpatialReference(3969))
                 dist = TMC_end_point.distanceTo(intGeom)
                 if closestIntDist is None:
@@ -319,8 +367,9 @@ def find_common_intersection(rteA, rteB, lrs, intersections, TMCSeg, intDict=Non
             return closestInt
             
     except Exception as e:
+        instrumentation.count('exceptions_swallowed')
         log.debug('        ERROR IN find_common_intersection')
-        log.debug(f'       {e}')
+        log.debug('       %s', e)
         log.debug('        No common intersections found\n')
         return None
         
@@ -329,6 +378,8 @@ def find_common_intersection(rteA, rteB, lrs, intersections, TMCSeg, intDict=Non
     return None
 
 
+@instrumentation.timed()
 def get_int_geometry_by_oid(oid, lyrIntersections):
     sql = f'OBJECTID = {oid}'
+    instrumentation.count('cursors')
     return [row[0] for row in arcpy.da.SearchCursor(lyrIntersections, 'SHAPE@', sql)][0]
\ No newline at end of file
@@ -0,0 +1,238 @@
+""" Hidden Markov model map matching for the TMCs left for step 45.
+
+    With config.MATCHING_MODE = 'hmm', 45_identify_routes_detailed.py matches each
+    TMC with a hidden Markov model.  This replaces the first route / last route
+    counts and the intersection chaining:
+
+        observations - the TMC's sample points (every 30 m)
+        states - the LRS routes near each point, at the point's closest
+            position on the route
+        emission - how far the point is from the route (gaussian, sigma)
+        transition - staying on a route has to keep the measures continuous.  The
+            distance travelled along the route should match the distance
+            between the points (exponential, beta).  A change of route is only
+            allowed between routes that share an intersection (see
+            route_graph.py) and costs route_change_penalty
+
+    One Viterbi pass over the points gives the most likely route at each point.
+    The pass is linear in the number of points and quadratic only in the
+    handful of routes near each point.  Consecutive points on the same route
+    become one MatchedRoute, with its begin and end measures if the LRS has M
+    values (see lrs_model.CompactLRS.from_geopackage).
+"""
+
+import numpy as np
+
+import instrumentation
+from route_graph import RouteGraph
+
+
+def sample_points(xy, d=30):
+    """ Returns points every d meters along a line, and its end point, the same
+        way lrs_tools.get_points_along_line samples TMCs (but planar).  Lines of
+        150 meters or less get at least 5 points """
+    import shapely
+
+    line = shapely.LineString(np.asarray(xy, dtype=np.float64).reshape(-1, 2))
+    if line.length == 0:
+        return shapely.get_coordinates(line)[:1]
+    if line.length <= 150:
+        d = line.length / 4
+    points = shapely.get_coordinates(shapely.line_interpolate_point(line, np.arange(0, line.length + 1e-9, d)))
+    end = shapely.get_coordinates(line)[-1:]
+    return points if np.hypot(*(points[-1] - end[0])) <= 1 else np.vstack([points, end])
+
+
+class MatchedRoute():
+    def __init__(self, rte_nm, begin_xy, end_xy, begin_msr=None, end_msr=None, points=0, distance=None):
+        self.rte_nm = rte_nm
+        self.begin_xy = begin_xy
+        self.end_xy = end_xy
+        self.begin_msr = begin_msr
+        self.end_msr = end_msr
+        self.points = points  # Number of sample points matched to this route
+        self.distance = distance  # Mean distance (meters) from those points to the route
+
+
+    def __repr__(self):
+        return f'<MatchedRoute\trte_nm: {self.rte_nm}\tbegin_msr: {self.begin_msr}\tend_msr: {self.end_msr}\tpoints: {self.points}>'
+
+
+class HMMMatcher():
+    def __init__(self, lrs, route_intersections=None, search_distance=20, sigma=5, beta=10, route_change_penalty=5):
+        """
+        inputs:
+            lrs - a CompactLRS (see lrs_model.py)
+            route_intersections - optional function returning the intersection
+                OBJECTIDs of a RTE_NM.  Without it, any two routes can follow
+                each other
+            search_distance - routes further than this from a point (meters)
+                aren't states of that point
+            sigma - the expected distance (meters) between a point and its route
+            beta - the expected difference (meters) between the distance along
+                the route and the distance between points
+            route_change_penalty - the log probability cost of changing route
+        """
+        self.lrs = lrs
+        self.route_intersections = route_intersections
+        self.search_distance = search_distance
+        self.sigma = sigma
+        self.beta = beta
+        self.route_change_penalty = route_change_penalty
+
+
+    def candidates(self, xy):
+        """ Returns the states of every point as arrays sorted by point:
+            point, route, part, along (distance along the part), distance (from
+            the point), and the projected x and y """
+        import shapely
+
+        points = shapely.points(xy)
+        point_index, parts = self.lrs.tree.query(shapely.buffer(points, self.search_distance), predicate='intersects')
+        instrumentation.count('spatial_queries')
+        lines = self.lrs.lines[parts]
+        distance = shapely.distance(points[point_index], lines)
+        along = shapely.line_locate_point(lines, points[point_index])
+        projected = shapely.get_coordinates(shapely.line_interpolate_point(lines, along))
+        routes = self.lrs.feature_codes[self.lrs.part_features[parts]].astype(np.int64)
+
+        # Keep the closest part of each route at each point
+        order = np.lexsort((distance, routes, point_index))
+        keep = order[np.r_[True, (point_index[order][1:] != point_index[order][:-1]) | (routes[order][1:] != routes[order][:-1])]] if len(order) else order
+        return {
+            'point': point_index[keep],
+            'route': routes[keep],
+            'part': parts[keep],
+            'along': along[keep],
+            'distance': distance[keep],
+            'xy': projected[keep]
+        }
+
+
+    def adjacent_routes(self, routes):
+        """ Returns the set of (route id, route id) pairs that share an
+            intersection, or None if any route may follow any other """
+        if self.route_intersections is None:
+            return None
+        names = [self.lrs.names[route] for route in routes]
+        graph = RouteGraph(names, self.route_intersections)
+        return {(self.lrs.codes[route], self.lrs.codes[other]) for route in graph.routes for other in graph.neighbours[route]}
+
+
+    def transition_costs(self, states, previous, current, gap, adjacent):
+        """ Returns the (previous, current) matrix of transition costs between the
+            states of two points gap meters apart """
+        route_a, route_b = states['route'][previous][:, None], states['route'][current][None, :]
+        part_a, part_b = states['part'][previous][:, None], states['part'][current][None, :]
+        xy_a, xy_b = states['xy'][previous][:, None], states['xy'][current][None, :]
+
+        # On the same part, the distance travelled is measured along the part
+        travelled = np.hypot(*(xy_b - xy_a).transpose(2, 0, 1))
+        same_part = part_a == part_b
+        travelled = np.where(same_part, np.abs(states['along'][current][None, :] - states['along'][previous][:, None]), travelled)
+        costs = np.abs(travelled - gap) / self.beta
+
+        route_change = route_a != route_b
+        costs = costs + np.where(route_change, self.route_change_penalty, 0)
+        if adjacent is not None:
+            allowed = np.array([[(a, b) in adjacent for b in route_b[0]] for a in route_a[:, 0]], dtype=bool).reshape(costs.shape)
+            costs = np.where(route_change & ~allowed, np.inf, costs)
+        return costs
+
+
+    def confidence(self, matched):
+        """ Returns 0 to 1, how close a MatchedRoute's points were to the route """
+        return round(float(np.exp(-0.5 * (matched.distance / self.sigma) ** 2)), 3)
+
+
+    @instrumentation.timed()
+    def match(self, xy, states=None):
+        """ Matches a TMC's sample points to a sequence of routes
+        inputs:
+            xy - (n, 2) array of the sample points, in order
+            states - optional candidates(xy), if they were already searched
+        output:
+            [MatchedRoute] in order along the TMC.  [] if no route is near any point
+        """
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        if len(xy) == 0:
+            return []
+        if states is None:
+            states = self.candidates(xy)
+        if len(states['point']) == 0:
+            return []
+
+        starts = np.searchsorted(states['point'], np.arange(len(xy) + 1))
+        emission = -0.5 * (states['distance'] / self.sigma) ** 2
+        adjacent = self.adjacent_routes(np.unique(states['route']))
+
+        # Viterbi.  Points without any nearby route are skipped
+        observed = [t for t in range(len(xy)) if starts[t + 1] > starts[t]]
+        score = emission[starts[observed[0]]:starts[observed[0] + 1]]
+        back = {observed[0]: None}
+        scores = {observed[0]: score}
+        for last, t in zip(observed, observed[1:]):
+            previous, current = np.arange(starts[last], starts[last + 1]), np.arange(starts[t], starts[t + 1])
+            gap = np.hypot(*(xy[t] - xy[last]))
+            total = score[:, None] - self.transition_costs(states, previous, current, gap, adjacent)
+            best = np.argmax(total, axis=0)
+            best_score = total[best, np.arange(len(current))]
+            if not np.isfinite(best_score).any():
+                # No allowed transition.  Start over from this point
+                back[t] = None
+                score = scores[t] = emission[current]
+                continue
+            back[t] = previous[best]
+            score = scores[t] = best_score + emission[current]
+
+        # Follow the back pointers from the best final state
+        path = {observed[-1]: starts[observed[-1]] + int(np.argmax(score))}
+        for t, last in zip(observed[::-1], observed[-2::-1]):
+            if back[t] is None:
+                path[last] = starts[last] + int(np.argmax(scores[last]))
+            else:
+                path[last] = back[t][path[t] - starts[t]]
+        state_path = np.array([path[t] for t in observed])
+
+        # Consecutive points on the same route make up one matched route.  Where
+        # the route changes, both routes end at the point where they meet
+        routes = states['route'][state_path]
+        breaks = np.flatnonzero(np.r_[True, routes[1:] != routes[:-1]])
+        ends = np.r_[breaks[1:], len(state_path)] - 1
+        positions = [[states['part'][state_path[begin]], states['along'][state_path[begin]], tuple(states['xy'][state_path[begin]]),
+                      states['part'][state_path[end]], states['along'][state_path[end]], tuple(states['xy'][state_path[end]])]
+                     for begin, end in zip(breaks, ends)]
+        for i in range(len(positions) - 1):
+            meeting = self.meeting_point(positions[i][3], positions[i + 1][0], positions[i][5], positions[i + 1][2])
+            if meeting:
+                positions[i][4], positions[i][5], positions[i + 1][1], positions[i + 1][2] = meeting
+
+        matched = []
+        for (begin_part, begin_along, begin_xy, end_part, end_along, end_xy), begin, end in zip(positions, breaks, ends):
+            begin_msr, end_msr = self.lrs.measures_at([begin_part, end_part], [begin_along, end_along])
+            matched.append(MatchedRoute(
+                rte_nm=self.lrs.names[routes[begin]],
+                begin_xy=begin_xy,
+                end_xy=end_xy,
+                begin_msr=None if np.isnan(begin_msr) else round(float(begin_msr), 3),
+                end_msr=None if np.isnan(end_msr) else round(float(end_msr), 3),
+                points=int(end - begin + 1),
+                distance=float(states['distance'][state_path[begin:end + 1]].mean())
+            ))
+        return matched
+
+
+    def meeting_point(self, part_a, part_b, xy_a, xy_b):
+        """ Finds where two parts come closest between the last point on one route
+            and the first point on the next.  Returns (along, xy) on part_a and on
+            part_b, or None """
+        import shapely
+
+        area = shapely.buffer(shapely.LineString([xy_a, xy_b]), self.search_distance)
+        line_a, line_b = self.lrs.lines[part_a], self.lrs.lines[part_b]
+        near_a, near_b = shapely.intersection(line_a, area), shapely.intersection(line_b, area)
+        if near_a.is_empty or near_b.is_empty:
+            return None
+        point_a, point_b = shapely.get_coordinates(shapely.shortest_line(near_a, near_b))
+        return (shapely.line_locate_point(line_a, shapely.Point(point_a)), tuple(point_a),
+                shapely.line_locate_point(line_b, shapely.Point(point_b)), tuple(point_b))
@@ -0,0 +1,36 @@
+""" Coordinate projection for arrays of vertices.
+
+    One pyproj Transformer is built per (from, to) pair and reused, so projecting
+    a handful of new TMCs costs the same per vertex as projecting the whole
+    state.  This replaces running Project_management over whole feature classes
+    for TMC geometry.  The LRS and intersections are still projected with arcpy
+    in 0_initial_setup.py, because their M values have to be kept.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+from pyproj import Transformer
+
+import config
+
+
+@lru_cache(maxsize=None)
+def get_transformer(from_wkid=config.WGS84_WKID, to_wkid=config.VIRGINIA_LAMBERT_WKID):
+    """ Returns the cached transformer between two spatial references.  Input
+        and output coordinates are always in x, y (lon, lat) order """
+    return Transformer.from_crs(from_wkid, to_wkid, always_xy=True)
+
+
+def project_xy(xy, from_wkid=config.WGS84_WKID, to_wkid=config.VIRGINIA_LAMBERT_WKID):
+    """ Projects an (n, 2) array of x, y coordinates and returns a new array """
+    xy = np.asarray(xy, dtype=np.float64)
+    if len(xy) == 0:
+        return xy.reshape(0, 2)
+    x, y = get_transformer(from_wkid, to_wkid).transform(xy[:, 0], xy[:, 1])
+    return np.column_stack([x, y])
+
+
+def project_point(x, y, from_wkid=config.WGS84_WKID, to_wkid=config.VIRGINIA_LAMBERT_WKID):
+    """ Projects a single x, y coordinate """
+    return get_transformer(from_wkid, to_wkid).transform(x, y)
@@ -0,0 +1,117 @@
+""" Route chaining for 45_identify_routes_detailed.py.
+
+    A TMC that spans more than one LRS route is mapped to a chain of routes,
+    from the route at its first points to the route at its last points, where
+    each route meets the next at an intersection.
+
+    RouteGraph links the candidate routes of a TMC that share an intersection,
+    using the RTE_NM: [intersection OBJECTIDs] dictionary from
+    43_create_intersection_dictionary.py.  It is built through an
+    intersection: routes index, so the work grows with the number of candidate
+    routes rather than with every pair of them.  chain_routes() then finds the
+    shortest chain between the first and last route with a breadth first
+    search.
+"""
+
+from collections import deque
+
+
+class RouteGraph():
+    def __init__(self, routes, route_intersections):
+        """
+        inputs:
+            routes - candidate RTE_NMs of a TMC.  Neighbours are searched in
+                this order
+            route_intersections - function returning the intersection
+                OBJECTIDs of a route, eg from the rte_int_dict
+        """
+        self.routes = list(dict.fromkeys(routes))
+        self.neighbours = {route: {} for route in self.routes}  # RTE_NM: {RTE_NM: [shared intersections]}
+
+        routes_at = {}
+        for route in self.routes:
+            for intersection in dict.fromkeys(route_intersections(route)):
+                routes_at.setdefault(intersection, []).append(route)
+
+        for intersection, routes_here in routes_at.items():
+            for route in routes_here:
+                for other in routes_here:
+                    if other != route:
+                        self.neighbours[route].setdefault(other, []).append(intersection)
+
+        # Keep the neighbours of each route in candidate order
+        order = {route: i for i, route in enumerate(self.routes)}
+        for route in self.routes:
+            self.neighbours[route] = dict(sorted(self.neighbours[route].items(), key=lambda item: order[item[0]]))
+
+
+    def degree(self, route, among=None):
+        """ Returns the number of routes (optionally only those in among) that
+            share an intersection with route """
+        if among is None:
+            return len(self.neighbours[route])
+        return sum(1 for other in self.neighbours[route] if other in among)
+
+
+    def shared_intersections(self, route, other):
+        return self.neighbours[route].get(other, [])
+
+
+    def remove_link(self, route, other):
+        self.neighbours[route].pop(other, None)
+        self.neighbours[other].pop(route, None)
+
+
+    def shortest_path(self, start, end, allowed=None):
+        """ Returns the shortest list of routes from start to end where each
+            route shares an intersection with the next, or None.
+            allowed - optional collection of routes the path may go through """
+        if start not in self.neighbours or end not in self.neighbours:
+            return None
+        previous = {start: None}
+        queue = deque([start])
+        while queue:
+            route = queue.popleft()
+            if route == end:
+                path = []
+                while route is not None:
+                    path.append(route)
+                    route = previous[route]
+                return path[::-1]
+            for other in self.neighbours[route]:
+                if other not in previous and (allowed is None or other in allowed or other == end):
+                    previous[other] = route
+                    queue.append(other)
+        return None
+
+
+def chain_routes(graph, first_route, last_route, allowed=None, resolve=None):
+    """ Finds the chain of routes from first_route to last_route
+    inputs:
+        graph - a RouteGraph of the TMC's candidate routes
+        allowed - optional routes the chain may pass through
+        resolve - optional function (route, next route, shared intersections)
+            returning the intersection where they meet, or None if they can't
+            be joined (eg lrs_tools.find_common_intersection for routes that
+            share more than one intersection).  The link is then dropped and
+            another chain is searched
+    output:
+        [(RTE_NM, intersection OBJECTID where it begins)].  The first route
+        has no intersection.  None if the last route can't be reached, rather
+        than a chain that stops short of the end of the TMC
+    """
+    while True:
+        path = graph.shortest_path(first_route, last_route, allowed)
+        if path is None:
+            return None
+
+        chain = [(first_route, None)]
+        for route, next_route in zip(path, path[1:]):
+            shared = graph.shared_intersections(route, next_route)
+            intersection = shared[0] if len(shared) == 1 or resolve is None else resolve(route, next_route, shared)
+            if intersection is None:
+                graph.remove_link(route, next_route)
+                break
+            chain.append((next_route, intersection))
+        else:
+            return chain
@@ -0,0 +1,127 @@
+""" Indexes over the LRS route catalog that are built once and shared by the
+    matching steps.
+
+    RouteNameIndex - replaces the per-TMC difflib.get_close_matches call in
+        31_identify_routes_by_number_name.py.  Each RTE_NM is profiled once
+        (length and character counts), so the cheap difflib upper bounds can
+        be checked without building a SequenceMatcher, and the results are
+        memoized by (roadName, candidate set).  The returned matches are
+        identical to difflib.get_close_matches.
+
+    Route number index - maps each LRS route number (RTE_NBR) to a frozenset of
+        the RTE_NMs that carry it, so "is this route one of the TMC's numbered
+        routes" is a hashed lookup instead of a list scan.  It is built from
+        the whole route catalog in 30_map_route_numbers_to_lrs_routes.py and
+        pickled to config.ROUTE_NUMBER_INDEX.
+"""
+
+import heapq
+import json
+import os
+import pickle
+from collections import Counter
+from difflib import SequenceMatcher
+
+
+class RouteNameIndex():
+    def __init__(self, rte_nms=(), n=3, cutoff=0.6):
+        self.n = n
+        self.cutoff = cutoff
+        self.profiles = {}  # rte_nm: (length, character counts)
+        self.scores = {}  # (roadName, rte_nm): ratio, or None if below cutoff
+        self.memo = {}  # (roadName, frozenset of candidates): {rte_nm: ratio}
+        self.matchers = {}  # roadName: SequenceMatcher with roadName as seq2
+        self.hits = 0
+        self.misses = 0
+
+        for rte_nm in set(rte_nms):
+            self.add(rte_nm)
+
+
+    def add(self, rte_nm):
+        """ Profiles a single RTE_NM and adds it to the index """
+        if rte_nm not in self.profiles:
+            self.profiles[rte_nm] = (len(rte_nm), Counter(rte_nm))
+        return self.profiles[rte_nm]
+
+
+    def score(self, roadName, rte_nm):
+        """ Returns the difflib ratio between roadName and rte_nm, or None if
+            the pair falls below the cutoff.  The real_quick_ratio and
+            quick_ratio bounds are computed from the precomputed profiles """
+        key = (roadName, rte_nm)
+        if key in self.scores:
+            return self.scores[key]
+
+        rteLen, rteCounts = self.profiles.get(rte_nm) or self.add(rte_nm)
+        nameLen, nameCounts = self.add(roadName)
+        total = rteLen + nameLen
+
+        score = None
+        if not total:
+            score = 1.0  # Two empty strings, which difflib rates as identical
+        elif 2.0 * min(rteLen, nameLen) / total >= self.cutoff:
+            matches = sum(min(count, nameCounts[char]) for char, count in rteCounts.items())
+            if 2.0 * matches / total >= self.cutoff:
+                matcher = self.matchers.get(roadName)
+                if matcher is None:
+                    matcher = SequenceMatcher()
+                    matcher.set_seq2(roadName)
+                    self.matchers[roadName] = matcher
+                matcher.set_seq1(rte_nm)
+                ratio = matcher.ratio()
+                if ratio >= self.cutoff:
+                    score = ratio
+
+        self.scores[key] = score
+        return score
+
+
+    def close_matches(self, roadName, candidates):
+        """ Drop-in replacement for difflib.get_close_matches(roadName, candidates).
+            Duplicated candidates are kept in the output just as difflib would
+            return them, but each distinct candidate is only scored once """
+        candidates = list(candidates)
+        key = (roadName, frozenset(candidates))
+        passing = self.memo.get(key)
+        if passing is None:
+            self.misses += 1
+            passing = {}
+            for rte_nm in key[1]:
+                score = self.score(roadName, rte_nm)
+                if score is not None:
+                    passing[rte_nm] = score
+            self.memo[key] = passing
+        else:
+            self.hits += 1
+
+        result = [(passing[rte_nm], rte_nm) for rte_nm in candidates if rte_nm in passing]
+        return [rte_nm for score, rte_nm in heapq.nlargest(self.n, result)]
+
+
+def build_route_number_index(rows):
+    """ Builds the route number index from (rte_nbr, rte_nm) pairs.  Route numbers
+        are stored as strings to match the roadNumber values on the TMCs """
+    index = {}
+    for rte_nbr, rte_nm in rows:
+        if rte_nbr is None:
+            continue
+        index.setdefault(str(rte_nbr), set()).add(rte_nm)
+
+    return {rte_nbr: frozenset(rte_nms) for rte_nbr, rte_nms in index.items()}
+
+
+def save_route_number_index(index, path):
+    with open(path, 'wb') as file:
+        pickle.dump(index, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_route_number_index(path, fallback_json='route_nbr_map.json'):
+    """ Loads the pickled route number index.  If it hasn't been built yet, the
+        older route_nbr_map.json lists are loaded and converted to sets """
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+    with open(fallback_json, 'r') as file:
+        return {rte_nbr: frozenset(rte_nms) for rte_nbr, rte_nms in json.load(file).items()}
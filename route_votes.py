@@ -0,0 +1,182 @@
+""" Route votes for many TMCs (or linearIds, etc) at once.
+
+    Each TMC is probed at a few points (eg its begin, mid, and end points) and
+    every LRS feature near a probe point is a vote for its route.  Routes are
+    the integer route ids of a CompactLRS (see lrs_model.py), so votes are kept
+    as a sparse probe point by route incidence matrix instead of lists of
+    RTE_NM strings:
+
+        incidence[p, r] - the number of features of route r near point p
+        tallies[i, r] - the votes for route r over all points of item i
+
+    The tallies replace Counter + lrs_tools.get_most_common.  most_common()
+    returns the same list of tied (RTE_NM, count) pairs, in the same order, and
+    winners() finds the single most common route of every item at once.
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+class RouteVotes():
+    def __init__(self, names, point_items, hit_points, hit_routes, n_items=None):
+        """
+        inputs:
+            names - the RTE_NM of each route id
+            point_items - the item of every probe point, in probe order
+            hit_points / hit_routes - one pair for every feature found near a
+                point, sorted by point
+            n_items - defaults to the last item + 1
+        """
+        self.names = names
+        self.point_items = np.asarray(point_items, dtype=np.int64)
+        self.hit_points = np.asarray(hit_points, dtype=np.int64)
+        self.hit_routes = np.asarray(hit_routes, dtype=np.int64)
+        self.n_items = n_items if n_items is not None else (int(self.point_items.max()) + 1 if len(self.point_items) else 0)
+        n_points = len(self.point_items)
+
+        self.incidence = sparse.csr_matrix((np.ones(len(self.hit_routes), dtype=np.int32), (self.hit_points, self.hit_routes)), shape=(n_points, len(names)))
+        point_to_item = sparse.csr_matrix((np.ones(n_points, dtype=np.int32), (self.point_items, np.arange(n_points))), shape=(self.n_items, n_points))
+        self.tallies = (point_to_item @ self.incidence).tocsr()
+        self.tallies.sort_indices()
+
+        # Where each item's points and hits begin (probe points are sorted by item)
+        self.point_starts = np.searchsorted(self.point_items, np.arange(self.n_items + 1))
+        self.hit_starts = np.searchsorted(self.hit_points, self.point_starts)
+
+
+    @classmethod
+    def from_points(cls, lrs, xy, point_items, distance, n_items=None):
+        """ Finds the routes near every probe point with a single spatial index
+            query.  xy - an (n, 2) array of points, with nan for missing points """
+        import shapely
+
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        points = np.full(len(xy), None, dtype=object)
+        valid = ~np.isnan(xy).any(axis=1)
+        points[valid] = shapely.points(xy[valid])
+
+        hit_points, hit_features = lrs.query_many(points, distance)
+        return cls(lrs.names, point_items, hit_points, lrs.feature_codes[hit_features], n_items)
+
+
+    @classmethod
+    def from_probes(cls, lrs, probes, distance):
+        """ Same as from_points for items that all have the same number of probe
+            points.  probes - a list of (n_items, 2) arrays, one per probe (eg
+            first points, mid-points, last points) """
+        xy = np.stack(probes, axis=1)
+        n_items, n_probes = xy.shape[:2]
+        return cls.from_points(lrs, xy.reshape(-1, 2), np.repeat(np.arange(n_items), n_probes), distance, n_items)
+
+
+    @classmethod
+    def from_route_lists(cls, lrs, route_lists):
+        """ Votes of a single item from the RTE_NMs found at each of its points,
+            eg from lrs_tools.find_nearby_routes_geopandas """
+        hit_points = [point for point, routes in enumerate(route_lists) for _ in routes]
+        hit_routes = [lrs.codes[route] for routes in route_lists for route in routes]
+        return cls(lrs.names, np.zeros(len(route_lists), dtype=np.int64), hit_points, hit_routes, 1)
+
+
+    def __len__(self):
+        return self.n_items
+
+
+    def routes(self, item, points=None):
+        """ Returns the route ids found at the item's points, in probe order
+            (the same order find_nearby_routes_geopandas returns them).
+            points - optional boolean mask or indexes of the item's points """
+        start, end = self.hit_starts[item], self.hit_starts[item + 1]
+        routes = self.hit_routes[start:end]
+        if points is not None:
+            selected = np.zeros(self.point_starts[item + 1] - self.point_starts[item], dtype=bool)
+            selected[points] = True
+            routes = routes[selected[self.hit_points[start:end] - self.point_starts[item]]]
+        return routes
+
+
+    def route_names(self, item, points=None):
+        return [self.names[route] for route in self.routes(item, points)]
+
+
+    def tally(self, item, allowed=None, points=None):
+        """ Returns [(RTE_NM, votes)] for every route of the item, most votes
+            first.  Ties keep the order the routes were first found, the same as
+            Counter.most_common.
+            allowed - optional collection of route ids to count """
+        routes = self.routes(item, points)
+        if allowed is not None:
+            routes = routes[np.isin(routes, np.fromiter(allowed, dtype=np.int64, count=len(allowed)))]
+        if len(routes) == 0:
+            return []
+        unique, first, counts = np.unique(routes, return_index=True, return_counts=True)
+        order = np.lexsort((first, -counts))
+        return [(self.names[unique[i]], int(counts[i])) for i in order]
+
+
+    def counts(self, item, points=None):
+        """ Returns {RTE_NM: votes} with the routes in the order they were
+            first found, the same as Counter(routes) """
+        routes = self.routes(item, points)
+        unique, first, counts = np.unique(routes, return_index=True, return_counts=True)
+        order = np.argsort(first)
+        return {self.names[unique[i]]: int(counts[i]) for i in order}
+
+
+    def most_common(self, item, allowed=None, points=None):
+        """ Drop in replacement for lrs_tools.get_most_common(Counter(routes)) -
+            the routes tied for the most votes.  Returns [] if there are none """
+        tally = self.tally(item, allowed, points)
+        return [(route, count) for route, count in tally if count == tally[0][1]]
+
+
+    def top_votes(self):
+        """ Returns (most votes, number of routes with that many votes) for every
+            item """
+        indptr, counts = self.tallies.indptr, self.tallies.data
+        most = np.zeros(self.n_items, dtype=np.int64)
+        nonempty = np.diff(indptr) > 0
+        if nonempty.any():
+            most[nonempty] = np.maximum.reduceat(counts, indptr[:-1][nonempty])
+        entry_items = np.repeat(np.arange(self.n_items), np.diff(indptr))
+        tied = np.bincount(entry_items[counts == most[entry_items]], minlength=self.n_items)
+        return most, tied
+
+
+    def winners(self, votes=None, min_votes=None):
+        """ Returns the route id of every item where a single route has the most
+            votes, and -1 for the rest.
+            votes - the winner must have exactly this many votes
+            min_votes - the winner must have at least this many votes """
+        most, tied = self.top_votes()
+        indptr, counts = self.tallies.indptr, self.tallies.data
+        entry_items = np.repeat(np.arange(self.n_items), np.diff(indptr))
+
+        winners = np.full(self.n_items, -1, dtype=np.int64)
+        is_top = (counts == most[entry_items]) & (tied[entry_items] == 1)
+        winners[entry_items[is_top]] = self.tallies.indices[is_top]
+        if votes is not None:
+            winners[most != votes] = -1
+        if min_votes is not None:
+            winners[most < min_votes] = -1
+        return winners
+
+
+    def top_routes(self, points=None):
+        """ Returns the most common route id of every item, the same route as
+            most_common(item, points=...)[0], or -1 if the item has no votes.
+            points - optional boolean mask over all probe points """
+        hits = np.arange(len(self.hit_routes)) if points is None else np.flatnonzero(np.asarray(points, dtype=bool)[self.hit_points])
+        top = np.full(self.n_items, -1, dtype=np.int64)
+        if len(hits) == 0:
+            return top
+
+        # One entry per (item, route), with its votes and where it was first found
+        keys = self.point_items[self.hit_points[hits]] * len(self.names) + self.hit_routes[hits]
+        unique, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        items = unique // len(self.names)
+        order = np.lexsort((hits[first], -counts, items))
+        leaders = order[np.r_[True, items[order][1:] != items[order][:-1]]]
+        top[items[leaders]] = unique[leaders] % len(self.names)
+        return top
@@ -0,0 +1,254 @@
+""" Storage backends for the pipeline's layers.
+
+    Both backends use the same layer names (master_lrs, overlap_lrs,
+    intersections, TMCs) and the same methods:
+
+        read_table(name, fields, where=None) - attributes as a DataFrame
+        read_layer(name, fields=None, where=None) - a GeoDataFrame
+        read_geometry_store(name, key_field, fields=(), where=None) - a GeometryStore
+        iter_features(name, key_field, fields=(), where=None, batch_size=1000) - the
+            same features in DataFrames of batch_size rows, read as they're needed
+        update_rows(name, key_field, updates) - bulk attribute updates
+        write_layer(name, gdf) - create or replace a layer
+
+    ArcpyStorage reads and writes the file geodatabases in config.py with arcpy
+    cursors.  ColumnarStorage keeps every layer in a single GeoPackage
+    (config.COLUMNAR_DB).  Layers are read and written in bulk with GDAL
+    (pyogrio), and attribute queries and updates run as plain SQL in SQLite,
+    which a GeoPackage is underneath.  It doesn't need arcpy, so it runs on
+    Linux.  The where clauses used by the pipeline (eg "status IS NULL") work
+    in both backends.
+
+    get_storage() returns the backend named by config.STORAGE_BACKEND.  Run this
+    file to copy the file geodatabase layers into the GeoPackage.  GDAL's
+    read_dataframe and write_dataframe drop M values, so the copy goes through
+    read_measured and write_measured instead, and the LRS layers keep their
+    measures (see lrs_model.CompactLRS.from_geopackage).
+
+    Steps 10, 20, and 31 read and write the TMCs only through the backend.  The
+    other stages still use arcpy cursors on config.TMCs and call
+    require_arcpy_backend(), so they refuse to run on the GeoPackage rather
+    than read statuses it never received.
+"""
+
+import os
+import sqlite3
+
+import pandas as pd
+import pyogrio
+
+import config
+from geometry_store import GeometryStore
+
+
+class ArcpyStorage():
+    def __init__(self):
+        self.paths = {
+            'master_lrs': config.MASTER_LRS,
+            'overlap_lrs': config.OVERLAP_LRS,
+            'intersections': config.INTERSECTIONS,
+            'TMCs': config.TMCs
+        }
+
+
+    def path(self, name):
+        return self.paths.get(name, name)
+
+
+    def read_table(self, name, fields, where=None):
+        import arcpy
+        rows = [row for row in arcpy.da.SearchCursor(self.path(name), fields, where)]
+        return pd.DataFrame(rows, columns=fields)
+
+
+    def read_layer(self, name, fields=None, where=None):
+        # GDAL's OpenFileGDB driver reads file geodatabases without a cursor per row
+        gdb, layer = os.path.split(self.path(name))
+        return pyogrio.read_dataframe(gdb, layer=layer, columns=fields, where=where)
+
+
+    def read_geometry_store(self, name, key_field, fields=(), where=None, keep_geometry=False):
+        return GeometryStore.from_feature_class(self.path(name), key_field, fields, where, keep_geometry)
+
+
+    def iter_features(self, name, key_field, fields=(), where=None, batch_size=1000):
+        import arcpy
+        import shapely
+        columns = [key_field] + list(fields)
+        with arcpy.da.SearchCursor(self.path(name), columns + ['SHAPE@WKB'], where) as cur:
+            while True:
+                rows = [row for _, row in zip(range(batch_size), cur)]
+                if not rows:
+                    break
+                batch = pd.DataFrame([row[:-1] for row in rows], columns=columns)
+                batch['geometry'] = shapely.from_wkb([bytes(row[-1]) if row[-1] else None for row in rows])
+                yield batch
+
+
+    def update_rows(self, name, key_field, updates):
+        """ updates - a DataFrame indexed by key_field.  Its columns are the fields to set """
+        import arcpy
+        fields = list(updates.columns)
+        values = updates.to_dict('index')
+        with arcpy.da.UpdateCursor(self.path(name), [key_field] + fields) as cur:
+            for row in cur:
+                if row[0] in values:
+                    record = values[row[0]]
+                    cur.updateRow([row[0]] + [record[field] for field in fields])
+
+
+    def write_layer(self, name, gdf):
+        gdb, layer = os.path.split(self.path(name))
+        pyogrio.write_dataframe(gdf, gdb, layer=layer, driver='OpenFileGDB')
+
+
+class ColumnarStorage():
+    def __init__(self, path=None):
+        self.path = path or config.COLUMNAR_DB
+
+
+    def connect(self):
+        conn = sqlite3.connect(self.path)
+        # The GeoPackage's spatial index triggers call these on every update
+        conn.create_function('ST_IsEmpty', 1, gpkg_is_empty, deterministic=True)
+        for name, bound in (('ST_MinX', 0), ('ST_MinY', 1), ('ST_MaxX', 2), ('ST_MaxY', 3)):
+            conn.create_function(name, 1, lambda blob, bound=bound: gpkg_bounds(blob)[bound], deterministic=True)
+        return conn
+
+
+    def read_table(self, name, fields, where=None):
+        sql = f'SELECT {", ".join(quote(field) for field in fields)} FROM {quote(name)}'
+        if where:
+            sql += f' WHERE {where}'
+        with self.connect() as conn:
+            return pd.read_sql_query(sql, conn)
+
+
+    def read_layer(self, name, fields=None, where=None):
+        return pyogrio.read_dataframe(self.path, layer=name, columns=fields, where=where)
+
+
+    def read_geometry_store(self, name, key_field, fields=(), where=None, keep_geometry=False):
+        if keep_geometry:
+            raise ValueError('arcpy geometries are only available with the arcpy storage backend')
+        gdf = self.read_layer(name, [key_field] + list(fields), where)
+        return GeometryStore.from_geometries(gdf[key_field].tolist(), gdf.geometry.values, gdf[list(fields)].reset_index(drop=True))
+
+
+    def iter_features(self, name, key_field, fields=(), where=None, batch_size=1000):
+        columns = [key_field] + list(fields)
+        with self.connect() as conn:
+            geometry_column = conn.execute('SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?', (name,)).fetchone()[0]
+            sql = f'SELECT {", ".join(quote(column) for column in columns + [geometry_column])} FROM {quote(name)}'
+            if where:
+                sql += f' WHERE {where}'
+            cur = conn.execute(sql)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                batch = pd.DataFrame([row[:-1] for row in rows], columns=columns)
+                batch['geometry'] = [gpkg_geometry(row[-1]) if row[-1] else None for row in rows]
+                yield batch
+
+
+    def update_rows(self, name, key_field, updates):
+        """ updates - a DataFrame indexed by key_field.  Its columns are the fields to set """
+        fields = list(updates.columns)
+        sql = f'UPDATE {quote(name)} SET {", ".join(f"{quote(field)} = ?" for field in fields)} WHERE {quote(key_field)} = ?'
+        records = updates.astype(object).where(updates.notna(), None)
+        rows = [tuple(values) + (key,) for key, values in zip(records.index, records.itertuples(index=False))]
+        with self.connect() as conn:
+            conn.executemany(sql, rows)
+
+
+    def write_layer(self, name, gdf):
+        import shapely
+        if shapely.has_m(gdf.geometry.values).any():
+            write_measured(gdf, self.path, layer=name, driver='GPKG')
+        else:
+            pyogrio.write_dataframe(gdf, self.path, layer=name, driver='GPKG')
+
+
+def read_measured(path, layer=None, where=None):
+    """ Reads a layer into a GeoDataFrame, keeping M values.  GDAL hands the
+        geometries to Arrow as ISO WKB, which has them.  Needs pyarrow """
+    import warnings
+    import geopandas as gp
+    import shapely
+
+    with warnings.catch_warnings():
+        # Only the reported geometry type loses the M.  The WKB keeps it
+        warnings.filterwarnings('ignore', 'Measured \\(M\\) geometry types are not supported')
+        meta, table = pyogrio.read_arrow(path, layer=layer, where=where)
+    geometry_name = meta['geometry_name'] or 'wkb_geometry'
+    geometry = shapely.from_wkb(table.column(geometry_name).to_numpy(zero_copy_only=False))
+    return gp.GeoDataFrame(table.drop_columns([geometry_name]).to_pandas(), geometry=geometry, crs=meta['crs'])
+
+
+def write_measured(gdf, path, layer=None, driver='ESRI Shapefile', geometry_type='Unknown'):
+    """ Writes a layer keeping M values (GeoDataFrame.to_file drops them).
+        File geodatabases need a geometry_type, eg 'Measured MultiLineString' """
+    import shapely
+    from pyogrio.raw import write as write_raw
+
+    geometry = shapely.to_wkb(gdf.geometry.values, flavor='iso', output_dimension=4)
+    columns = [col for col in gdf.columns if col != gdf.geometry.name]
+    write_raw(path, geometry, [gdf[col].to_numpy() for col in columns], columns, layer=layer, driver=driver,
+              geometry_type=geometry_type, crs=gdf.crs.to_wkt() if gdf.crs else None)
+
+
+def gpkg_is_empty(blob):
+    if blob is None:
+        return None
+    return int(bool(blob[3] & 0x10))
+
+
+def gpkg_geometry(blob):
+    """ Returns the shapely geometry of a GeoPackage geometry blob.  Unlike
+        reading the layer with GDAL, M values are kept """
+    import shapely
+    envelope = (0, 32, 48, 48, 64)[(blob[3] >> 1) & 0x07]
+    return shapely.from_wkb(bytes(blob[8 + envelope:]))
+
+
+def gpkg_bounds(blob):
+    """ Returns (minx, miny, maxx, maxy) of a GeoPackage geometry blob """
+    return gpkg_geometry(blob).bounds
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def get_storage(backend=None):
+    """ Returns the storage backend named by config.STORAGE_BACKEND """
+    backend = backend or config.STORAGE_BACKEND
+    if backend == 'arcpy':
+        return ArcpyStorage()
+    if backend == 'columnar':
+        return ColumnarStorage()
+    raise ValueError(f'Unknown storage backend: {backend}')
+
+
+def require_arcpy_backend(stage):
+    """ Stops a stage that still reads or writes config.TMCs with arcpy cursors
+        when the TMCs live in the GeoPackage, instead of letting it work on a
+        stale file geodatabase copy """
+    if config.STORAGE_BACKEND != 'arcpy':
+        raise RuntimeError(f'{stage} still uses arcpy cursors on config.TMCs, which the {config.STORAGE_BACKEND} '
+                           'storage backend never updates.  Run it with TMC_LRS_STORAGE=arcpy')
+
+
+def export_to_columnar(layers=('master_lrs', 'overlap_lrs', 'intersections', 'TMCs')):
+    """ Copies the file geodatabase layers into the GeoPackage, with their M values """
+    source = ArcpyStorage()
+    target = ColumnarStorage()
+    for name in layers:
+        print(f'  Copying {name}')
+        target.write_layer(name, read_measured(*os.path.split(source.path(name))))
+
+
+if __name__ == '__main__':
+    print('\nCopying input data to the columnar store')
+    export_to_columnar()
@@ -0,0 +1,227 @@
+""" Streaming conflation with bounded memory.
+
+    The numbered steps read every TMC, match them all, and only then write
+    their results, so memory grows with the number of TMCs.  Here the TMCs flow
+    through a chain of generators, batch_size TMCs at a time:
+
+        read_tmcs - TMC geometries from the storage backend (see storage.py)
+        search_candidates - sample points every 30 m and the LRS routes near
+            each point
+        match_routes - the hidden Markov model route sequence (see map_matching.py)
+        measure_events - begin and end measures of each matched route
+        check_events - flags suspect events (low confidence, or a total length
+            that doesn't match the TMC).  Events are flagged, not dropped
+
+    Each batch of events is written as soon as it's checked, as JSON lines or as
+    a Parquet row group, so only the batch in flight (and the LRS) is in memory.
+    Run with:
+        python streaming.py data//_stream_events.jsonl [--format parquet] [--where "status is null"]
+
+    Every TMC gets at least one row.  TMCs without events get one with no
+    rte_nm and qc 'unmatched' (or the error).
+
+    The events are located on the routes as matched, like data/_45_output.csv
+    before 50_flip_detailed_results.py.  No direction flip (see flip_routes.py)
+    is applied, so non-prime events must be flipped before they can be compared
+    with the final output.
+
+    Measures come from the LRS M values, so the matcher's LRS has to come from
+    the GeoPackage (see lrs_model.CompactLRS.from_geopackage).  GDAL drops the M
+    values from the LRS shapefile, and stream_events refuses to run without them.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import shapely
+
+import instrumentation
+import storage
+import trace_log
+from map_matching import sample_points
+
+log = trace_log.get_logger(__name__, 'streaming')
+
+METERS_PER_MILE = 1609.344
+EVENT_FIELDS = ['tmc', 'rte_nm', 'begin_msr', 'end_msr', 'confidence', 'status', 'qc']
+
+
+def read_tmcs(store, where=None, batch_size=500):
+    """ Yields lists of {'tmc', 'geometry'} """
+    for batch in store.iter_features('TMCs', 'tmc', where=where, batch_size=batch_size):
+        yield [{'tmc': tmc, 'geometry': geometry} for tmc, geometry in zip(batch['tmc'], batch['geometry'])]
+
+
+def search_candidates(batches, matcher):
+    """ Replaces each TMC's geometry with its sample points and their candidate states """
+    for batch in batches:
+        for tmc in batch:
+            geometry = tmc.pop('geometry')
+            if geometry is None or geometry.is_empty:
+                tmc['error'] = 'No geometry'
+                continue
+            tmc['miles'] = geometry.length / METERS_PER_MILE
+            tmc['xy'] = sample_points(shapely.get_coordinates(geometry))
+            tmc['states'] = matcher.candidates(tmc['xy'])
+        yield batch
+
+
+def match_routes(batches, matcher):
+    for batch in batches:
+        for tmc in batch:
+            if 'error' in tmc:
+                continue
+            trace_log.set_tmc(tmc['tmc'])
+            try:
+                tmc['matched'] = matcher.match(tmc.pop('xy'), tmc.pop('states'))
+            except Exception as e:
+                instrumentation.count('exceptions_swallowed')
+                log.debug('Error matching %s', tmc['tmc'], exc_info=True)
+                tmc['error'] = f'{type(e).__name__}: {e}'
+        trace_log.set_tmc(None)
+        yield batch
+
+
+def measure_events(batches, matcher):
+    """ Turns the matched routes into events.  As in step 45, routes that begin
+        and end at the same measure (or have no measures) are dropped """
+    for batch in batches:
+        for tmc in batch:
+            tmc['events'] = [{
+                'tmc': tmc['tmc'],
+                'rte_nm': matched.rte_nm,
+                'begin_msr': matched.begin_msr,
+                'end_msr': matched.end_msr,
+                'confidence': matcher.confidence(matched),
+                'status': 'Complete (stream)',
+                'qc': None
+            } for matched in tmc.pop('matched', []) if matched.begin_msr is not None and matched.begin_msr != matched.end_msr]
+        yield batch
+
+
+def check_events(batches, min_confidence=0.5, length_tolerance=0.25):
+    """ Flags events with a confidence under min_confidence, and the events of
+        TMCs whose measured length is off by more than length_tolerance (as a
+        fraction of the TMC length, and at least 0.05 miles).  Yields the rows
+        to write """
+    for batch in batches:
+        rows = []
+        for tmc in batch:
+            events = tmc['events'] if 'error' not in tmc else []
+            if not events:
+                rows.append({**dict.fromkeys(EVENT_FIELDS), 'tmc': tmc['tmc'], 'qc': tmc.get('error', 'unmatched')})
+                continue
+
+            measured = sum(abs(event['end_msr'] - event['begin_msr']) for event in events)
+            wrong_length = abs(measured - tmc['miles']) > max(0.05, length_tolerance * tmc['miles'])
+            for event in events:
+                flags = [flag for flag, failed in (('low confidence', event['confidence'] < min_confidence), ('length', wrong_length)) if failed]
+                event['qc'] = ', '.join(flags) or None
+                rows.append(event)
+        yield rows
+
+
+class JsonLinesWriter():
+    def __init__(self, path):
+        self.file = open(path, 'w')
+
+
+    def write(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(row) + '\n')
+        self.file.flush()
+
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter():
+    """ Writes each batch as a row group.  Needs pyarrow """
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema([
+            ('tmc', pa.string()),
+            ('rte_nm', pa.string()),
+            ('begin_msr', pa.float64()),
+            ('end_msr', pa.float64()),
+            ('confidence', pa.float64()),
+            ('status', pa.string()),
+            ('qc', pa.string())
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+
+    def write(self, rows):
+        if rows:
+            self.writer.write_table(self.pa.Table.from_pylist(rows, schema=self.schema))
+
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'jsonl': JsonLinesWriter, 'parquet': ParquetWriter}
+
+
+@instrumentation.timed('streaming')
+def stream_events(output_path, matcher, store=None, where=None, batch_size=500, output_format=None, **qc_options):
+    """ Conflates the TMCs and writes their events as they're found
+    inputs:
+        output_path - a .jsonl or .parquet file
+        matcher - a map_matching.HMMMatcher
+        store - a storage backend with the TMCs layer.  Defaults to storage.get_storage()
+        where - optional SQL filter of the TMCs (eg 'status is null')
+        output_format - 'jsonl' or 'parquet'.  Defaults to the file extension
+        qc_options - passed to check_events
+    output:
+        (number of TMCs, number of events, number of flagged rows)
+    """
+    matcher.lrs.require_measures()  # Otherwise every TMC would be written as unmatched
+    output_format = output_format or ('parquet' if os.path.splitext(output_path)[1] == '.parquet' else 'jsonl')
+    store = store or storage.get_storage()
+
+    batches = read_tmcs(store, where, batch_size)
+    batches = search_candidates(batches, matcher)
+    batches = match_routes(batches, matcher)
+    batches = measure_events(batches, matcher)
+    batches = check_events(batches, **qc_options)
+
+    tmcs, events, flagged = 0, 0, 0
+    writer = WRITERS[output_format](output_path)
+    try:
+        for rows in batches:
+            writer.write(rows)
+            tmcs += len({row['tmc'] for row in rows})
+            events += sum(1 for row in rows if row['rte_nm'] is not None)
+            flagged += sum(1 for row in rows if row['qc'] is not None)
+            print(f'\r  {tmcs} TMCs, {events} events, {flagged} flagged', end='')
+    finally:
+        writer.close()
+    print()
+    return tmcs, events, flagged
+
+
+if __name__ == '__main__':
+    from conflation_service import load_engine
+
+    parser = argparse.ArgumentParser(description='Streaming TMC to LRS conflation')
+    parser.add_argument('output', help='.jsonl or .parquet file for the events')
+    parser.add_argument('--format', choices=sorted(WRITERS), help='defaults to the output file extension')
+    parser.add_argument('--where', help='SQL filter of the TMCs layer, eg "status is null"')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--lrs', help='LRS GeoPackage with M values.  Defaults to config.COLUMNAR_DB')
+    args = parser.parse_args()
+
+    print('\nStreaming TMCs to LRS events')
+    try:
+        engine = load_engine(args.lrs, tmcs=False)
+    except ValueError as e:
+        sys.exit(f'  {e}')
+    stream_events(args.output, engine.matcher, where=args.where, batch_size=args.batch_size, output_format=args.format)
+    print(f'  Events written to {args.output}\n')
@@ -0,0 +1,415 @@
+""" Synthetic LRS, intersections, and TMCs for benchmarking and testing without
+    the VDOT LRS or the PDA API.
+
+    generate_network builds a road network around Richmond at any scale:
+        - Primary routes (R-VA   SR00nnnNB/SB or EB/WB).  Some are divided, with a
+          separate carriageway for each direction.  Undivided primaries have a
+          non-prime route on the same geometry, measured the other way, that is
+          only in the overlap LRS (as in the real LRS)
+        - An overlap (concurrent) US route sharing part of the first primary
+        - Secondary routes (S-VAjjjPR/NP name) that change jurisdiction at the
+          county line, so some TMCs span two routes
+        - Secondary routes that are digitized backwards (see
+          LRS_RTE_ERRORS__REVERSED_MP.json)
+        - Ramps where divided primaries cross other primaries
+        - Intersections wherever master LRS routes cross or meet
+        - TMCs in the PDA API format, with linearId, linearTmc and roadOrder
+          chains, a little positional noise, and their own vertex spacing
+
+    Measures are in miles.  The expected events for every TMC (after flipping)
+    are returned as network['truth'].
+
+    write_network saves everything to a folder laid out like data/ so the
+    pipeline can be pointed at it (see benchmark_pipeline.py).  Run this file to
+    write a network to data/synthetic.
+"""
+
+import json
+import os
+import struct
+import sys
+
+import geopandas as gp
+import numpy as np
+import pandas as pd
+import shapely
+
+import config
+import projection
+from storage import write_measured
+
+ORIGIN = projection.project_point(-77.43, 37.54)  # Richmond
+METERS_PER_MILE = 1609.344
+LRS_FIELDS = ['RTE_NM', 'RTE_NBR', 'RTE_OPPOSITE_DIRECTION_RTE_NM']
+
+# (LRS jurisdiction, TMC location prefix, county name).  The county line runs
+# north-south through the middle of the network
+COUNTIES = [(134, '110', 'CHESTERFIELD'), (143, '111', 'HENRICO')]
+
+HIGHWAY_NAMES = ['JEFFERSON DAVIS HWY', 'MIDLOTHIAN TPKE', 'HULL STREET RD', 'IRON BRIDGE RD', 'BROAD ST',
+                 'PATTERSON AVE', 'STAPLES MILL RD', 'MECHANICSVILLE TPKE', 'NINE MILE RD', 'WILLIAMSBURG RD']
+STREET_NAMES = ['MAGNOLIA GREEN LOOP', 'MOATE CIR', 'CHASE POINTE CIR', 'COLLEGE DR', 'FARMINGTON RD',
+                'PATTON CIR', 'RIVANNA STATION LOOP', 'ALLEGHANY LOOP', 'COURTHOUSE RD', 'BEACH RD',
+                'WINTERPOCK RD', 'RIVER RD', 'OLD BON AIR RD', 'BUFORD RD', 'GRAVES RD', 'TREELY RD']
+
+
+def cumulative_length(xy):
+    """ Returns the distance along a line at each vertex """
+    return np.concatenate([[0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))])
+
+
+def measured_line(xy, m):
+    """ Returns a shapely LineString M built from (n, 2) vertices and n measures """
+    coords = np.column_stack([xy, m]).astype('<f8')
+    return shapely.from_wkb(struct.pack('<BII', 1, 2002, len(coords)) + coords.tobytes())
+
+
+def substring(xy, start, end):
+    """ Returns the vertices of the part of a line between two distances """
+    cum = cumulative_length(xy)
+    inside = (cum > start) & (cum < end)
+    ends = np.column_stack([np.interp([start, end], cum, xy[:, 0]), np.interp([start, end], cum, xy[:, 1])])
+    return np.vstack([ends[:1], xy[inside], ends[1:]])
+
+
+def resample(xy, rng, spacing=(30, 80)):
+    """ Returns the line with its own, irregular vertex spacing """
+    cum = cumulative_length(xy)
+    steps = rng.uniform(*spacing, size=int(cum[-1] / spacing[0]) + 2)
+    stations = np.concatenate([[0], np.cumsum(steps)])
+    stations = np.append(stations[stations < cum[-1]], cum[-1])
+    return np.column_stack([np.interp(stations, cum, xy[:, 0]), np.interp(stations, cum, xy[:, 1])])
+
+
+def corridor(start, end, rng, spacing=50, amplitude=40):
+    """ Returns the vertices of a gently winding road from start to end """
+    start, end = np.asarray(start, dtype=float), np.asarray(end, dtype=float)
+    length = np.hypot(*(end - start))
+    t = np.linspace(0, 1, max(int(length / spacing), 2) + 1)
+    normal = np.array([-(end - start)[1], (end - start)[0]]) / length
+    wave = amplitude * np.sin(2 * np.pi * t * rng.uniform(1, 3) + rng.uniform(0, 2 * np.pi)) * np.sin(np.pi * t)
+    return start + t[:, None] * (end - start) + wave[:, None] * normal
+
+
+def right_side(xy, distance):
+    """ Returns the carriageway distance to the right of a line, in its direction """
+    return np.asarray(shapely.offset_curve(shapely.LineString(xy), -distance).coords)
+
+
+def miles(xy, reverse_measures=False):
+    m = cumulative_length(xy) / METERS_PER_MILE
+    return m[-1] - m if reverse_measures else m
+
+
+def add_route(routes, rte_nm, xy, m, rte_nbr=None, opposite=None, master=True):
+    routes[rte_nm] = {
+        'RTE_NM': rte_nm,
+        'RTE_NBR': rte_nbr,
+        'RTE_OPPOSITE_DIRECTION_RTE_NM': opposite,
+        'master': master,
+        'xy': xy,
+        'm': m
+    }
+
+
+def generate_network(primaries=4, secondaries=8, size=20000, tmc_length=(400, 1600), noise=2.0, seed=0):
+    """ Builds a synthetic network
+    inputs:
+        primaries - the number of primary corridors, alternating north-south and east-west
+        secondaries - the number of secondary corridors
+        size - the width and height of the network in meters
+        tmc_length - the range of TMC lengths in meters
+        noise - the standard deviation of the TMC vertices from the LRS, in meters
+        seed - the random seed.  The same inputs always give the same network
+    output:
+        A dictionary of master_lrs, overlap_lrs, intersections (GeoDataFrames),
+        tmcs (a DataFrame like the PDA API returns), truth (the expected events)
+        and reversed_mp (routes that are digitized backwards)
+    """
+    rng = np.random.default_rng(seed)
+    origin = np.asarray(ORIGIN) - size / 2
+    routes = {}
+    roads = []  # Each road has a positive and negative carriageway made of route pieces
+    reversed_mp = []
+    numbers = rng.choice(np.arange(1, 400), size=primaries + 1, replace=False)
+
+    def position(k, n, shift=0.0):
+        """ Returns the kth of n evenly spaced positions across the network, jittered """
+        spacing = size / n
+        return spacing * (k + 0.5 + shift) + rng.uniform(-spacing / 8, spacing / 8)
+
+    # Primary routes
+    n_ns = (primaries + 1) // 2
+    for i in range(primaries):
+        north_south = i % 2 == 0
+        k, n = (i // 2, n_ns) if north_south else (i // 2, primaries - n_ns)
+        p = position(k, n)
+        start, end = ((p, 0), (p, size)) if north_south else ((0, p), (size, p))
+        center = corridor(origin + start, origin + end, rng)
+
+        nbr = int(numbers[i])
+        prime_dir, non_prime_dir = ('NB', 'SB') if north_south else ('EB', 'WB')
+        prime, non_prime = f'R-VA   SR{nbr:05d}{prime_dir}', f'R-VA   SR{nbr:05d}{non_prime_dir}'
+        divided = i % 3 == 0
+        if divided:
+            prime_xy, non_prime_xy = right_side(center, 10), right_side(center[::-1], 10)
+        else:
+            prime_xy, non_prime_xy = center, center[::-1].copy()
+        add_route(routes, prime, prime_xy, miles(prime_xy), nbr, non_prime)
+        add_route(routes, non_prime, non_prime_xy, miles(non_prime_xy), nbr, prime, master=divided)
+
+        roads.append({
+            'name': HIGHWAY_NAMES[i % len(HIGHWAY_NAMES)],
+            'roadNumber': f'VA-{nbr}',
+            'directions': (prime_dir, non_prime_dir),
+            'signs': ('+', '-'),
+            'divided': divided,
+            'north_south': north_south,
+            'carriageways': ([prime], [non_prime])
+        })
+
+    # A US route that runs concurrently with part of the first primary
+    if primaries:
+        nbr = int(numbers[-1])
+        for rte_nm in (roads[0]['carriageways'][0][0], roads[0]['carriageways'][1][0]):
+            xy = routes[rte_nm]['xy']
+            length = cumulative_length(xy)[-1]
+            shared = substring(xy, length / 3, 2 * length / 3)
+            direction = rte_nm[14:16]
+            opposite = {'NB': 'SB', 'SB': 'NB', 'EB': 'WB', 'WB': 'EB'}[direction]
+            add_route(routes, f'R-VA   US{nbr:05d}{direction}', shared, 5 + miles(shared), nbr, f'R-VA   US{nbr:05d}{opposite}', master=False)
+
+    # Secondary routes.  East-west secondaries cross the county line and change jurisdiction there
+    county_line = origin[0] + size / 2
+    n_ns = (secondaries + 1) // 2
+    for i in range(secondaries):
+        north_south = i % 2 == 1
+        k, n = (i // 2, n_ns) if north_south else (i // 2, secondaries - n_ns)
+        p = position(k, n, shift=0.25)  # Keeps secondaries off the primaries
+        start, end = ((p, 0), (p, size)) if north_south else ((0, p), (size, p))
+        center = corridor(origin + start, origin + end, rng, amplitude=25)
+        name = STREET_NAMES[i % len(STREET_NAMES)] + ('' if i < len(STREET_NAMES) else f' {i // len(STREET_NAMES) + 1}')
+
+        if north_south:
+            county = 0 if center[0, 0] < county_line else 1
+            pieces = [(COUNTIES[county][0], center)]
+        else:
+            cum = cumulative_length(center)
+            distance, length = np.interp(county_line, center[:, 0], cum), cum[-1]
+            pieces = [(COUNTIES[0][0], substring(center, 0, distance)), (COUNTIES[1][0], substring(center, distance, length))]
+
+        backwards = i % 5 == 4
+        positive, negative = [], []
+        for juris, xy in pieces:
+            prime, non_prime = f'S-VA{juris:03d}PR {name}', f'S-VA{juris:03d}NP {name}'
+            add_route(routes, prime, xy, miles(xy, backwards), None, non_prime)
+            add_route(routes, non_prime, xy[::-1].copy(), miles(xy[::-1], backwards), None, prime, master=False)
+            positive.append(prime)
+            negative.insert(0, non_prime)
+            if backwards:
+                reversed_mp.extend([prime, non_prime])
+
+        roads.append({
+            'name': name,
+            'roadNumber': None,
+            'directions': ('NB', 'SB') if north_south else ('EB', 'WB'),
+            'signs': ('P', 'N'),
+            'divided': False,
+            'north_south': north_south,
+            'carriageways': (positive, negative)
+        })
+
+    # Ramps from the prime carriageway of each divided primary onto crossing primaries
+    ramp_count = 0
+    for road in [road for road in roads if road['divided']]:
+        rte_nm = road['carriageways'][0][0]
+        line = shapely.LineString(routes[rte_nm]['xy'])
+        for other in [other for other in roads[:primaries] if other['north_south'] != road['north_south']]:
+            target = shapely.LineString(routes[other['carriageways'][0][0]]['xy'])
+            crossing = line.intersection(target)
+            if crossing.is_empty or crossing.geom_type != 'Point':
+                continue
+            begin = line.interpolate(line.project(crossing) - 120)
+            end = target.interpolate(target.project(crossing) + 120)
+            t = np.linspace(0, 1, 12)[:, None]
+            control = np.array(crossing.coords[0])
+            xy = (1 - t) ** 2 * np.array(begin.coords[0]) + 2 * (1 - t) * t * control + t ** 2 * np.array(end.coords[0])
+            ramp_count += 1
+            ramp = f'{rte_nm}      RMP{ramp_count:03d}.00A'
+            add_route(routes, ramp, xy, miles(xy), routes[rte_nm]['RTE_NBR'])
+            roads.append({
+                'name': f'{road["name"]} RAMP',
+                'roadNumber': road['roadNumber'],
+                'directions': (road['directions'][0], None),
+                'signs': ('P', None),
+                'divided': False,
+                'north_south': road['north_south'],
+                'carriageways': ([ramp], [])
+            })
+
+    master = route_frame([route for route in routes.values() if route['master']])
+    overlap = route_frame(list(routes.values()))
+    intersections = find_intersections(master)
+    tmcs, truth = build_tmcs(roads, routes, rng, county_line, tmc_length, noise)
+
+    return {
+        'master_lrs': master,
+        'overlap_lrs': overlap,
+        'intersections': intersections,
+        'tmcs': tmcs,
+        'truth': truth,
+        'reversed_mp': reversed_mp
+    }
+
+
+def route_frame(routes):
+    return gp.GeoDataFrame(
+        {field: [route[field] for route in routes] for field in LRS_FIELDS},
+        geometry=[measured_line(route['xy'], route['m']) for route in routes],
+        crs=config.VIRGINIA_LAMBERT_WKID
+    )
+
+
+def find_intersections(master, tolerance=0.5):
+    """ Returns a point wherever two master LRS routes cross or meet """
+    lines = shapely.force_2d(master.geometry.values)
+    left, right = shapely.STRtree(lines).query(lines, predicate='intersects')
+    keep = left < right
+    crossings = shapely.intersection(lines[left[keep]], lines[right[keep]])
+    points = shapely.get_coordinates(crossings)  # Shared segments (eg concurrencies) contribute their vertices
+    points = np.unique(np.round(points / tolerance) * tolerance, axis=0)
+    return gp.GeoDataFrame(
+        {'INTERSECTION_ID': np.arange(1, len(points) + 1)},
+        geometry=shapely.points(points),
+        crs=config.VIRGINIA_LAMBERT_WKID
+    )
+
+
+def build_tmcs(roads, routes, rng, county_line, tmc_length, noise):
+    """ Splits every carriageway into TMCs.  Returns (tmcs, truth) """
+    records = []
+    truth = []
+    sequence = 0
+
+    for linear_id, road in enumerate(roads, start=1):
+        for direction, sign, carriageway in zip(road['directions'], road['signs'], road['carriageways']):
+            if not carriageway:
+                continue
+            pieces = [routes[rte_nm] for rte_nm in carriageway]
+            xy = np.vstack([piece['xy'] if i == 0 else piece['xy'][1:] for i, piece in enumerate(pieces)])
+            piece_starts = np.concatenate([[0], np.cumsum([cumulative_length(piece['xy'])[-1] for piece in pieces])])
+            length = piece_starts[-1]
+
+            # Break points along the carriageway
+            breaks = [0.0]
+            while length - breaks[-1] > tmc_length[1]:
+                breaks.append(breaks[-1] + rng.uniform(*tmc_length))
+            breaks.append(length)
+
+            linear_tmc = None
+            previous_county = None
+            for order, (start, end) in enumerate(zip(breaks[:-1], breaks[1:]), start=1):
+                sequence += 1
+                line = substring(xy, start, end)
+                county = COUNTIES[0 if line[len(line) // 2, 0] < county_line else 1]
+                tmc = f'{county[1]}{sign}{sequence:05d}'
+                if county != previous_county:
+                    linear_tmc = tmc  # linearTmc chains restart at county lines
+                    previous_county = county
+
+                for piece, piece_start, piece_end in zip(pieces, piece_starts[:-1], piece_starts[1:]):
+                    if piece_end <= start or piece_start >= end:
+                        continue
+                    cum = cumulative_length(piece['xy'])
+                    begin_msr, end_msr = np.interp([max(start, piece_start) - piece_start, min(end, piece_end) - piece_start], cum, piece['m'])
+                    truth.append({'tmc': tmc, 'rte_nm': piece['RTE_NM'], 'begin_msr': round(begin_msr, 3), 'end_msr': round(end_msr, 3)})
+
+                tmc_xy = resample(line, rng)
+                tmc_xy[1:-1] += rng.normal(0, noise, size=(len(tmc_xy) - 2, 2))
+                lonlat = projection.project_xy(tmc_xy, config.VIRGINIA_LAMBERT_WKID, config.WGS84_WKID)
+                records.append({
+                    'tmc': tmc,
+                    'type': 'P1.11',
+                    'roadNumber': road['roadNumber'],
+                    'roadName': road['name'],
+                    'firstName': None,
+                    'funcClass': 'FC3' if road['roadNumber'] else 'FC5',
+                    'county': county[2],
+                    'state': 'VIRGINIA',
+                    'zip': '23225',
+                    'direction': {'NB': 'NORTHBOUND', 'SB': 'SOUTHBOUND', 'EB': 'EASTBOUND', 'WB': 'WESTBOUND'}[direction],
+                    'roadClass': 'Primary' if road['roadNumber'] else 'Secondary',
+                    'nhsFClass': None,
+                    'startLatitude': lonlat[0, 1],
+                    'startLongitude': lonlat[0, 0],
+                    'endLatitude': lonlat[-1, 1],
+                    'endLongitude': lonlat[-1, 0],
+                    'length': round((end - start) / METERS_PER_MILE, 6),
+                    'linearTmc': linear_tmc,
+                    'linearId': str(linear_id),
+                    'roadOrder': order,
+                    'timezoneName': 'America/New_York',
+                    'coordinates': [','.join(f'{x:.7f} {y:.7f}' for x, y in lonlat)]
+                })
+
+    return pd.DataFrame(records), pd.DataFrame(truth, columns=['tmc', 'rte_nm', 'begin_msr', 'end_msr'])
+
+
+def write_network(network, output_dir=os.path.join('data', 'synthetic')):
+    """ Writes a network to output_dir, laid out like data/:
+            lrs.shp - the master LRS for GeoPandas
+            conflation.gpkg - the master LRS, overlap LRS, and intersections, for
+                the columnar storage backend.  These also stand in for the SDE
+                layers in config.py
+            tmcs.json - the TMCs as the PDA API returns them
+            truth.csv - the expected events
+            LRS_RTE_ERRORS__REVERSED_MP.json - routes that are digitized backwards
+        If arcpy is available, the layers are also loaded into input_data.gdb the
+        same way 0_initial_setup.py loads the real data
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    gpkg = os.path.join(output_dir, 'conflation.gpkg')
+    if os.path.exists(gpkg):
+        os.remove(gpkg)
+
+    print('  Writing LRS and intersections')
+    write_measured(network['master_lrs'], os.path.join(output_dir, 'lrs.shp'))
+    for name in ['master_lrs', 'overlap_lrs', 'intersections']:
+        write_measured(network[name], gpkg, layer=name, driver='GPKG')
+
+    print('  Writing TMCs')
+    with open(os.path.join(output_dir, 'tmcs.json'), 'w') as file:
+        json.dump(network['tmcs'].to_dict('records'), file)
+    network['truth'].to_csv(os.path.join(output_dir, 'truth.csv'), index=False)
+    with open(os.path.join(output_dir, 'LRS_RTE_ERRORS__REVERSED_MP.json'), 'w') as file:
+        json.dump(network['reversed_mp'], file)
+
+    if config.arcpy:
+        load_into_gdb(output_dir)
+
+
+def load_into_gdb(output_dir):
+    """ Copies the GeoPackage layers into output_dir/input_data.gdb, and creates
+        the other geodatabases the pipeline expects """
+    arcpy = config.arcpy
+    arcpy.env.overwriteOutput = True
+    for gdb in ['input_data.gdb', 'scrap.gdb', 'intermediate.gdb']:
+        if not os.path.exists(os.path.join(output_dir, gdb)):
+            arcpy.CreateFileGDB_management(output_dir, gdb)
+    for name in ['master_lrs', 'overlap_lrs', 'intersections']:
+        arcpy.FeatureClassToFeatureClass_conversion(os.path.join(output_dir, 'conflation.gpkg', f'main.{name}'), os.path.join(output_dir, 'input_data.gdb'), name)
+
+
+def load_tmcs(path):
+    """ Returns the TMCs written by write_network as a DataFrame """
+    with open(path) as file:
+        return pd.DataFrame(json.load(file))
+
+
+if __name__ == '__main__':
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    print(f'\nGenerating synthetic network (scale {scale})')
+    network = generate_network(primaries=4 * scale, secondaries=8 * scale, size=20000 * scale ** 0.5, seed=scale)
+    print(f'  {len(network["master_lrs"])} master routes, {len(network["overlap_lrs"])} overlap routes, '
+          f'{len(network["intersections"])} intersections, {len(network["tmcs"])} TMCs')
+    write_network(network)
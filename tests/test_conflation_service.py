@@ -0,0 +1,126 @@
+""" Tests conflation_service.py offline, on a small synthetic network (see
+    synthetic_data.py).  Run from the repo folder with:
+        python -m pytest tests
+"""
+
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+import shapely
+
+import synthetic_data
+import tmc_geometry
+from conflation_service import ConflationEngine, ConflationService
+from lrs_model import CompactLRS
+
+
+class TestConflationService(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        network = synthetic_data.generate_network(primaries=2, secondaries=3, size=8000, seed=0)
+        cls.master_lrs = network['master_lrs']
+        cls.lrs = CompactLRS.from_geometries(cls.master_lrs['RTE_NM'], cls.master_lrs.geometry.values)
+        cls.tmcs = network['tmcs']
+        xy, offsets = tmc_geometry.parse_coordinates(cls.tmcs['coordinates'])
+        cls.coordinates = [xy[start:end].tolist() for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+    def setUp(self):
+        self.engine = ConflationEngine(self.lrs)
+        self.server = ConflationService(self.engine, ('127.0.0.1', 0), workers=1, queue_size=1)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def request(self, path, body=None):
+        """ Returns (status, JSON answer) """
+        data = None if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode('utf-8'))
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url + path, data)) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+
+
+    def tmc_request(self, i):
+        return {'id': self.tmcs['tmc'].iloc[i], 'coordinates': self.coordinates[i], 'wgs84': True}
+
+
+    def test_health(self):
+        status, answer = self.request('/health')
+        self.assertEqual(status, 200)
+        self.assertEqual(answer['status'], 'ok')
+        self.assertEqual(answer['routes'], len(self.lrs.names))
+
+
+    def test_single_match(self):
+        status, answer = self.request('/match', self.tmc_request(0))
+        self.assertEqual(status, 200)
+        self.assertEqual(answer['id'], self.tmcs['tmc'].iloc[0])
+        self.assertTrue(answer['events'])
+        for event in answer['events']:
+            self.assertIn(event['rte_nm'], self.lrs.names)
+            self.assertIsNotNone(event['begin_msr'])
+            self.assertIsNotNone(event['end_msr'])
+            self.assertTrue(0 < event['confidence'] <= 1)
+
+
+    def test_batch(self):
+        status, answer = self.request('/match', {'tmcs': [self.tmc_request(i) for i in range(10)] + [{'tmc': 'unknown'}]})
+        self.assertEqual(status, 200)
+        self.assertEqual([result['id'] for result in answer['tmcs']], self.tmcs['tmc'].iloc[:10].tolist() + ['unknown'])
+        self.assertTrue(all(result.get('events') for result in answer['tmcs'][:10]))
+        self.assertIn('error', answer['tmcs'][-1])
+
+
+    def test_bad_input(self):
+        self.assertEqual(self.request('/match', b'not json')[0], 400)
+        self.assertEqual(self.request('/match', {'tmcs': 3})[0], 400)
+        self.assertEqual(self.request('/unknown')[0], 404)
+
+
+    def test_overflow(self):
+        # Hold the only worker on the first job, so the second fills the queue
+        started, release = threading.Event(), threading.Event()
+        match_many = self.engine.match_many
+        def blocking_match_many(requests):
+            started.set()
+            release.wait(10)
+            return match_many(requests)
+        self.engine.match_many = blocking_match_many
+
+        statuses = []
+        def post():
+            statuses.append(self.request('/match', self.tmc_request(0))[0])
+
+        first = threading.Thread(target=post)
+        first.start()
+        self.assertTrue(started.wait(10))
+        second = threading.Thread(target=post)
+        second.start()
+        while self.server.jobs.qsize() == 0:
+            second.join(0.01)
+
+        self.assertEqual(self.request('/match', self.tmc_request(1))[0], 503)
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(statuses, [200, 200])
+
+
+    def test_lrs_without_measures(self):
+        lrs = CompactLRS.from_geometries(self.master_lrs['RTE_NM'], shapely.force_2d(self.master_lrs.geometry.values))
+        with self.assertRaises(ValueError):
+            ConflationEngine(lrs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+""" Tests geometry_store.py against shapely, and merge_groups against joining
+    the TMCs in roadOrder by hand, on the TMCs of a small synthetic network
+    (see synthetic_data.py).  Run from the repo folder with:
+        python -m pytest tests
+"""
+
+import unittest
+
+import numpy as np
+import shapely
+
+import projection
+import synthetic_data
+import tmc_geometry
+from geometry_store import GeometryStore, merge_groups
+
+
+def tmc_lines(tmcs):
+    xy, offsets = tmc_geometry.parse_coordinates(tmcs['coordinates'])
+    return tmc_geometry.build_lines(projection.project_xy(xy), offsets)
+
+
+class TestGeometryStore(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        network = synthetic_data.generate_network(primaries=2, secondaries=3, size=8000, seed=0)
+        cls.tmcs = network['tmcs'].reset_index(drop=True)
+        cls.lines = tmc_lines(cls.tmcs)
+        cls.store = GeometryStore.from_geometries(cls.tmcs['tmc'], cls.lines, cls.tmcs[['linearId', 'linearTmc', 'roadOrder']])
+
+
+    def test_lengths(self):
+        np.testing.assert_allclose(self.store.lengths, shapely.length(self.lines))
+
+
+    def test_points_at(self):
+        for fraction in (0, 0.25, 0.5, 0.75, 1):
+            expected = shapely.get_coordinates(shapely.line_interpolate_point(self.lines, fraction, normalized=True))
+            np.testing.assert_allclose(self.store.points_at(fraction), expected, atol=1e-6)
+        self.assertIs(self.store.mid_points(), self.store.points_at(0.5))
+
+
+    def test_lookup(self):
+        row = self.store.index[self.tmcs['tmc'].iloc[3]]
+        np.testing.assert_allclose(self.store.vertices(row), shapely.get_coordinates(self.lines[3]))
+        linear_tmc = self.tmcs['linearTmc'].iloc[0]
+        self.assertEqual(sorted(self.store.rows_for('linearTmc', linear_tmc)), self.tmcs.index[self.tmcs['linearTmc'] == linear_tmc].tolist())
+        self.assertEqual(len(self.store.rows_for('linearTmc', 'missing')), 0)
+
+
+    def test_multipart_gap_isnt_measured(self):
+        first, second = shapely.get_coordinates(self.lines[0]), shapely.get_coordinates(self.lines[2])
+        multipart = shapely.multilinestrings([shapely.linestrings(first), shapely.linestrings(second)])
+        store = GeometryStore.from_geometries(['a'], [multipart])
+        self.assertAlmostEqual(store.lengths[0], multipart.length)
+        self.assertAlmostEqual(store.lengths[0], self.store.lengths[0] + self.store.lengths[2])
+        np.testing.assert_allclose(store.last_points()[0], second[-1])
+
+
+class TestMergeGroups(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        network = synthetic_data.generate_network(primaries=2, secondaries=3, size=8000, seed=0)
+        # Shuffled, so the merge has to put the TMCs back in roadOrder
+        cls.tmcs = network['tmcs'].sample(frac=1, random_state=0).reset_index(drop=True)
+        cls.lines = tmc_lines(cls.tmcs)
+        cls.store = GeometryStore.from_geometries(cls.tmcs['tmc'], cls.lines, cls.tmcs[['linearTmc', 'roadOrder']])
+
+
+    def expected_vertices(self, linear_tmc, keep=None):
+        group = self.tmcs.loc[self.tmcs['linearTmc'] == linear_tmc].sort_values('roadOrder')
+        if keep is not None:
+            group = group.loc[keep[group.index]]
+        return np.vstack([shapely.get_coordinates(self.lines[i]) for i in group.index])
+
+
+    def test_merge_in_road_order(self):
+        merged = merge_groups(self.store, 'linearTmc')
+        self.assertEqual(sorted(merged.keys), sorted(self.tmcs['linearTmc'].unique()))
+        for linear_tmc in merged.keys:
+            row = merged.index[linear_tmc]
+            np.testing.assert_array_equal(merged.vertices(row), self.expected_vertices(linear_tmc))
+            self.assertEqual(merged.attributes['tmc_count'].iloc[row], (self.tmcs['linearTmc'] == linear_tmc).sum())
+
+        # The synthetic TMCs of a group meet end to end, so there are no gaps
+        # and the merged line is as long as its TMCs
+        self.assertEqual(merged.attributes['gaps'].sum(), 0)
+        group_lengths = self.tmcs.assign(length=shapely.length(self.lines)).groupby('linearTmc')['length'].sum()
+        np.testing.assert_allclose(merged.lengths, group_lengths[merged.keys].to_numpy(), atol=len(self.tmcs) * 1e-6)
+
+
+    def test_gap(self):
+        # Leave out a TMC in the middle of the longest group
+        counts = self.tmcs['linearTmc'].value_counts()
+        linear_tmc = counts.index[0]
+        group = self.tmcs.loc[self.tmcs['linearTmc'] == linear_tmc].sort_values('roadOrder')
+        mask = np.ones(len(self.tmcs), dtype=bool)
+        mask[group.index[len(group) // 2]] = False
+
+        merged = merge_groups(self.store, 'linearTmc', values=[linear_tmc], mask=mask)
+        self.assertEqual(merged.keys, [linear_tmc])
+        self.assertEqual(merged.attributes['gaps'].tolist(), [1])
+        self.assertEqual(merged.attributes['tmc_count'].tolist(), [len(group) - 1])
+        np.testing.assert_array_equal(merged.vertices(0), self.expected_vertices(linear_tmc, mask))
+
+        # The gap isn't measured
+        kept = group.index[mask[group.index]]
+        self.assertAlmostEqual(merged.lengths[0], shapely.length(self.lines[kept]).sum(), places=3)
+        self.assertEqual(merged.part_starts[merged.offsets[0]:merged.offsets[1]].sum(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
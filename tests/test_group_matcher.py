@@ -0,0 +1,151 @@
+""" Tests group_matcher.py against the per-TMC choices step 31 made before it
+    used the GroupMatcher, on a small synthetic network (see synthetic_data.py).
+    Run from the repo folder with:
+        python -m pytest tests
+"""
+
+import unittest
+
+import pandas as pd
+import shapely
+
+import projection
+import route_index
+import synthetic_data
+import tmc_geometry
+from geometry_store import GeometryStore
+from group_matcher import (FIVE_POINTS, THREE_POINTS, GroupMatcher, PrimeDirection, RouteNames, RouteNumbers,
+                           StateRoutes, other_routes)
+from lrs_model import CompactLRS
+from route_index import RouteNameIndex
+from route_votes import RouteVotes
+
+DISTANCES = (9, 30)  # Step 31's search distance, and one wide enough to find both carriageways
+
+
+def is_prime(rte_nm):
+    return rte_nm[7:9] == 'PR' or rte_nm[14:16] in ('NB', 'EB')
+
+
+def old_step_31_choice(votes, item, lrs, potential_by_number, roadName, name_index):
+    """ The route step 31 chose for one TMC before the GroupMatcher (with the
+        name tie reduced by its own routes rather than routesByNumber) """
+    potential_by_name = []
+    if roadName is not None:
+        potential_by_name = name_index.close_matches(roadName, votes.route_names(item))
+        if len(set(potential_by_name)) > 1:
+            potential_by_name = [rte for rte in potential_by_name if rte[7:9] == 'PR']
+
+    number_ids = lrs.route_ids(potential_by_number) if potential_by_number else set()
+    name_ids = lrs.route_ids(potential_by_name) if potential_by_name else set()
+
+    routes_by_number = votes.most_common(item, number_ids)
+    if len(routes_by_number) == 2:
+        routes_by_number = [route for route in routes_by_number if is_prime(route[0])]
+
+    routes_by_name = votes.most_common(item, name_ids)
+    if len(routes_by_name) == 2:
+        routes_by_name = [route for route in routes_by_name if is_prime(route[0])]
+
+    other_ids = set(votes.routes(item).tolist()) - number_ids - name_ids
+    routes_other = votes.most_common(item, other_ids)
+    if len(routes_other) > 2:
+        other_ids = {route for route in other_ids if votes.names[route].startswith('R-VA')}
+        routes_other = votes.most_common(item, other_ids)
+    if len(routes_other) == 2:
+        other_ids = {route for route in other_ids if is_prime(votes.names[route])}
+        routes_other = votes.most_common(item, other_ids)
+
+    for routes in (routes_by_number, routes_by_name, routes_other):
+        if len(routes) == 1 and routes[0][1] >= 3:
+            return routes[0][0]
+    return None
+
+
+class TestGroupMatcher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        network = synthetic_data.generate_network(primaries=2, secondaries=3, size=8000, seed=0)
+        master_lrs = network['master_lrs']
+        cls.lrs = CompactLRS.from_geometries(master_lrs['RTE_NM'], master_lrs.geometry.values)
+        overlap_lrs = network['overlap_lrs'].dropna(subset=['RTE_NBR'])
+        cls.number_index = route_index.build_route_number_index(zip(overlap_lrs['RTE_NBR'].astype(int), overlap_lrs['RTE_NM']))
+
+        tmcs = network['tmcs']
+        xy, offsets = tmc_geometry.parse_coordinates(tmcs['coordinates'])
+        cls.store = GeometryStore.from_geometries(tmcs['tmc'], tmc_geometry.build_lines(projection.project_xy(xy), offsets))
+        # As step 31 reads them
+        cls.road_numbers = {tmc: number.split('-')[1] for tmc, number in zip(tmcs['tmc'], tmcs['roadNumber']) if not pd.isna(number)}
+        cls.road_names = {tmc: name for tmc, name in zip(tmcs['tmc'], tmcs['roadName']) if not pd.isna(name)}
+
+
+    def step_31_matcher(self, name_index, distance, road_numbers, road_names):
+        return GroupMatcher(self.lrs, FIVE_POINTS, distance=distance, min_votes=3, categories=[
+            ('number', RouteNumbers(road_numbers, self.number_index), [PrimeDirection()]),
+            ('name', RouteNames(road_names, name_index), [PrimeDirection()]),
+            ('other', other_routes, [StateRoutes(), PrimeDirection(recount=True)])
+        ])
+
+
+    def test_step_31_categories(self):
+        # Without road numbers and names every TMC falls through to the other routes
+        for distance in DISTANCES:
+            for road_numbers, road_names in ((self.road_numbers, self.road_names), ({}, {})):
+                name_index = RouteNameIndex(self.lrs.names)
+                output = self.step_31_matcher(name_index, distance, road_numbers, road_names).match(self.store)
+
+                votes = RouteVotes.from_probes(self.lrs, [self.store.points_at(fraction) for fraction in FIVE_POINTS], distance)
+                expected = {}
+                for item, tmc in enumerate(self.store.keys):
+                    rte_nm = old_step_31_choice(votes, item, self.lrs, self.number_index.get(road_numbers.get(tmc)),
+                                                road_names.get(tmc), name_index)
+                    if rte_nm is not None:
+                        expected[tmc] = rte_nm
+
+                self.assertEqual(output, expected, f'{distance} m search, {len(road_names)} road names')
+                self.assertGreater(len(output), len(self.store) // 2)
+
+
+    def test_some_keys(self):
+        matcher = self.step_31_matcher(RouteNameIndex(self.lrs.names), 9, self.road_numbers, self.road_names)
+        everything = matcher.match(self.store)
+        keys = self.store.keys[::3] + ['missing']
+        self.assertEqual(matcher.match(self.store, keys), {key: rte_nm for key, rte_nm in everything.items() if key in keys})
+
+
+    def test_exact_votes(self):
+        # Steps 10 and 20: a single most common route found at all three points
+        output = GroupMatcher(self.lrs, THREE_POINTS, votes=3).match(self.store)
+        votes = RouteVotes.from_probes(self.lrs, [self.store.points_at(fraction) for fraction in THREE_POINTS], 9)
+        expected = {}
+        for item, tmc in enumerate(self.store.keys):
+            routes = votes.most_common(item)
+            if len(routes) == 1 and routes[0][1] == 3:
+                expected[tmc] = routes[0][0]
+        self.assertEqual(output, expected)
+
+
+    def test_ties(self):
+        # Routes drawn on the same line tie.  The reducers keep the state route
+        # in its prime direction
+        line = shapely.LineString([(0, 0), (500, 0)])
+        ties = [['R-VA   SR00001NB', 'R-VA   SR00001SB'],
+                ['R-VA   SR00001NB', 'R-VA   SR00001SB', 'S-VA001PR OLD RD'],
+                ['R-VA   SR00001SB', 'S-VA001NP OLD RD']]
+        for rte_nms in ties:
+            lrs = CompactLRS.from_geometries(rte_nms, [line] * len(rte_nms))
+            store = GeometryStore.from_geometries(['tmc'], [line])
+            road_names = {'tmc': 'OLD RD'}
+            for names in (road_names, {}):
+                name_index = RouteNameIndex(lrs.names)
+                matcher = GroupMatcher(lrs, FIVE_POINTS, min_votes=3, categories=[
+                    ('name', RouteNames(names, name_index), [PrimeDirection()]),
+                    ('other', other_routes, [StateRoutes(), PrimeDirection(recount=True)])
+                ])
+                votes = RouteVotes.from_probes(lrs, [store.points_at(fraction) for fraction in FIVE_POINTS], 9)
+                expected = old_step_31_choice(votes, 0, lrs, None, names.get('tmc'), name_index)
+                self.assertEqual(matcher.match(store).get('tmc'), expected, rte_nms)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+""" Tests map_matching.py against the expected events of a small synthetic network
+    (see synthetic_data.py).  Run from the repo folder with:
+        python -m pytest tests
+"""
+
+import unittest
+
+import numpy as np
+import shapely
+
+import projection
+import synthetic_data
+import tmc_geometry
+from lrs_model import CompactLRS
+from map_matching import HMMMatcher, sample_points
+
+
+def unflipped(events, lrs, route_lengths):
+    """ The truth events as the matcher finds them: events on a non-prime route
+        missing from the LRS are on its prime route with decreasing measures """
+    expected = []
+    for rte_nm, begin_msr, end_msr in events:
+        if rte_nm not in lrs.codes:
+            rte_nm = rte_nm[:7] + 'PR' + rte_nm[9:] if rte_nm[7:9] == 'NP' else rte_nm[:14] + {'WB': 'EB', 'SB': 'NB'}[rte_nm[14:16]]
+            begin_msr, end_msr = route_lengths[rte_nm] - begin_msr, route_lengths[rte_nm] - end_msr
+        if abs(end_msr - begin_msr) > 0.01:  # Slivers of a route at a TMC's end aren't matched
+            expected.append((rte_nm, begin_msr, end_msr))
+    return expected
+
+
+class TestHMMMatcher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        network = synthetic_data.generate_network(primaries=2, secondaries=3, size=8000, seed=0)
+        master_lrs, intersections = network['master_lrs'], network['intersections']
+        cls.master_lrs = master_lrs
+        cls.lrs = CompactLRS.from_geometries(master_lrs['RTE_NM'], master_lrs.geometry.values)
+        cls.route_lengths = {rte_nm: shapely.get_coordinates(geometry, include_m=True)[:, 2].max()
+                             for rte_nm, geometry in zip(master_lrs['RTE_NM'], master_lrs.geometry.values)}
+        cls.rte_int_dict = {rte_nm: intersections['INTERSECTION_ID'][shapely.dwithin(intersections.geometry.values, geometry, 1)].tolist()
+                            for rte_nm, geometry in zip(master_lrs['RTE_NM'], master_lrs.geometry.values)}
+
+        tmcs = network['tmcs']
+        xy, offsets = tmc_geometry.parse_coordinates(tmcs['coordinates'])
+        cls.lines = tmc_geometry.build_lines(projection.project_xy(xy), offsets)
+        cls.tmcs = tmcs['tmc'].tolist()
+        cls.truth = {tmc: list(zip(events['rte_nm'], events['begin_msr'], events['end_msr'])) for tmc, events in network['truth'].groupby('tmc')}
+
+
+    def sample(self, line):
+        return sample_points(shapely.get_coordinates(line))
+
+
+    def assert_matches_truth(self, matcher):
+        changes = 0
+        for tmc, line in zip(self.tmcs, self.lines):
+            matched = matcher.match(self.sample(line))
+            expected = unflipped(self.truth[tmc], self.lrs, self.route_lengths)
+            self.assertEqual([route.rte_nm for route in matched], [rte_nm for rte_nm, _, _ in expected], tmc)
+            for route, (_, begin_msr, end_msr) in zip(matched, expected):
+                self.assertAlmostEqual(route.begin_msr, begin_msr, delta=0.01, msg=tmc)
+                self.assertAlmostEqual(route.end_msr, end_msr, delta=0.01, msg=tmc)
+                self.assertGreater(route.points, 0)
+                self.assertTrue(0 < matcher.confidence(route) <= 1)
+            changes += len(matched) > 1
+        self.assertGreater(changes, 0)
+
+
+    def test_match(self):
+        self.assert_matches_truth(HMMMatcher(self.lrs))
+
+
+    def test_match_through_intersections(self):
+        self.assert_matches_truth(HMMMatcher(self.lrs, lambda rte_nm: self.rte_int_dict.get(rte_nm, [])))
+
+
+    def test_candidates(self):
+        matcher = HMMMatcher(self.lrs)
+        xy = self.sample(self.lines[0])
+        states = matcher.candidates(xy)
+        self.assertTrue((np.diff(states['point']) >= 0).all())
+        self.assertTrue((states['distance'] <= matcher.search_distance).all())
+        for point in range(len(xy)):
+            routes = states['route'][states['point'] == point]
+            self.assertEqual(len(routes), len(set(routes)))
+            self.assertEqual(sorted(self.lrs.names[route] for route in routes),
+                             sorted(set(self.lrs.nearby_routes(shapely.Point(xy[point]), matcher.search_distance))))
+        self.assertEqual([vars(route) for route in matcher.match(xy, states)], [vars(route) for route in matcher.match(xy)])
+
+
+    def test_nothing_nearby(self):
+        matcher = HMMMatcher(self.lrs)
+        self.assertEqual(matcher.match(np.empty((0, 2))), [])
+        self.assertEqual(matcher.match(self.sample(self.lines[0]) + 10000), [])
+
+
+    def test_lrs_without_measures(self):
+        lrs = CompactLRS.from_geometries(self.master_lrs['RTE_NM'], shapely.force_2d(self.master_lrs.geometry.values))
+        matched = HMMMatcher(lrs).match(self.sample(self.lines[0]))
+        self.assertEqual([route.rte_nm for route in matched], [self.truth[self.tmcs[0]][0][0]])
+        self.assertIsNone(matched[0].begin_msr)
+        self.assertIsNone(matched[0].end_msr)
+
+
+class TestSamplePoints(unittest.TestCase):
+    def test_every_30_meters(self):
+        xy = [(0, 0), (100, 0), (100, 95)]
+        points = sample_points(xy)
+        self.assertEqual(len(points), 8)
+        along = shapely.line_locate_point(shapely.LineString(xy), shapely.points(points))
+        np.testing.assert_allclose(np.diff(along[:-1]), 30)
+        np.testing.assert_allclose(points[-1], xy[-1])
+
+
+    def test_end_point_isnt_repeated(self):
+        points = sample_points([(0, 0), (180.5, 0)])
+        np.testing.assert_allclose(points[:, 0], [0, 30, 60, 90, 120, 150, 180])
+
+
+    def test_short_lines(self):
+        np.testing.assert_allclose(sample_points([(0, 0), (0, 100)])[:, 1], [0, 25, 50, 75, 100])
+        np.testing.assert_allclose(sample_points([(5, 5), (5, 5)]), [(5, 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+""" Tests route_graph.py on the routes and intersections of a small synthetic
+    network (see synthetic_data.py).  Run from the repo folder with:
+        python -m pytest tests
+"""
+
+import unittest
+
+import shapely
+
+import synthetic_data
+from route_graph import RouteGraph, chain_routes
+
+NB, SB, EB = 'R-VA   SR00254NB', 'R-VA   SR00254SB', 'R-VA   SR00204EB'
+RAMP = 'R-VA   SR00254NB      RMP001.00A'
+LOOP, LOOP_NP = 'S-VA134PR MAGNOLIA GREEN LOOP', 'S-VA143PR MAGNOLIA GREEN LOOP'
+CIRCLE = 'S-VA134PR MOATE CIR'
+POINTE = 'S-VA143PR CHASE POINTE CIR'  # Only meets the other CHASE POINTE CIR
+
+
+class TestRouteGraph(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        network = synthetic_data.generate_network(primaries=2, secondaries=3, size=8000, seed=0)
+        master_lrs, intersections = network['master_lrs'], network['intersections']
+        # As 43_create_intersection_dictionary.py builds the rte_int_dict
+        cls.rte_int_dict = {rte_nm: intersections['INTERSECTION_ID'][shapely.dwithin(intersections.geometry.values, geometry, 1)].tolist()
+                            for rte_nm, geometry in zip(master_lrs['RTE_NM'], master_lrs.geometry.values)}
+        cls.routes = list(cls.rte_int_dict)
+
+
+    def graph(self, rte_int_dict=None):
+        rte_int_dict = rte_int_dict or self.rte_int_dict
+        return RouteGraph(self.routes, lambda rte_nm: rte_int_dict.get(rte_nm, []))
+
+
+    def test_neighbours(self):
+        graph = self.graph()
+        for route in self.routes:
+            expected = [other for other in self.routes
+                        if other != route and set(self.rte_int_dict[route]) & set(self.rte_int_dict[other])]
+            self.assertEqual(list(graph.neighbours[route]), expected)
+            self.assertEqual(graph.degree(route), len(expected))
+        self.assertEqual(graph.degree(NB, [EB, LOOP, SB]), 2)
+        self.assertEqual(graph.shared_intersections(SB, LOOP), sorted(set(self.rte_int_dict[SB]) & set(self.rte_int_dict[LOOP])))
+        self.assertEqual(graph.shared_intersections(NB, SB), [])
+
+
+    def test_chain(self):
+        chain = chain_routes(self.graph(), RAMP, LOOP_NP)
+        self.assertEqual([rte_nm for rte_nm, intersection in chain], [RAMP, NB, LOOP, LOOP_NP])
+        self.assertIsNone(chain[0][1])
+        for (route, _), (next_route, intersection) in zip(chain, chain[1:]):
+            self.assertIn(intersection, self.rte_int_dict[route])
+            self.assertIn(intersection, self.rte_int_dict[next_route])
+
+        self.assertEqual(chain_routes(self.graph(), SB, SB), [(SB, None)])
+
+
+    def test_allowed(self):
+        # SB reaches the circle through either EB or the loop, and the chain
+        # may only pass through the allowed routes
+        self.assertEqual([rte_nm for rte_nm, _ in chain_routes(self.graph(), SB, CIRCLE)], [SB, EB, CIRCLE])
+        self.assertEqual([rte_nm for rte_nm, _ in chain_routes(self.graph(), SB, CIRCLE, {LOOP})], [SB, LOOP, CIRCLE])
+        self.assertEqual([rte_nm for rte_nm, _ in chain_routes(self.graph(), SB, EB, set())], [SB, EB])
+
+
+    def test_unreachable(self):
+        # Rather than a chain that stops short of the end of the TMC
+        self.assertIsNone(chain_routes(self.graph(), NB, POINTE))
+        self.assertIsNone(chain_routes(self.graph(), SB, CIRCLE, set()))
+        self.assertIsNone(chain_routes(self.graph(), SB, 'missing'))
+
+
+    def test_resolve(self):
+        # NB also meets the loop where SB does, so the link has two shared
+        # intersections to resolve
+        rte_int_dict = dict(self.rte_int_dict)
+        rte_int_dict[NB] = rte_int_dict[NB] + [intersection for intersection in rte_int_dict[SB] if intersection in rte_int_dict[LOOP]]
+        calls = []
+
+        def resolve(route, next_route, shared):
+            calls.append((route, next_route, shared))
+            return max(shared)
+
+        graph = self.graph(rte_int_dict)
+        chain = chain_routes(graph, RAMP, LOOP_NP, resolve=resolve)
+        self.assertEqual([rte_nm for rte_nm, _ in chain], [RAMP, NB, LOOP, LOOP_NP])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][:2], (NB, LOOP))
+        self.assertEqual(chain[2][1], max(calls[0][2]))
+
+        # A link that can't be joined is dropped and another chain is searched
+        graph = self.graph(rte_int_dict)
+        chain = chain_routes(graph, RAMP, LOOP_NP, resolve=lambda route, next_route, shared: None)
+        self.assertEqual([rte_nm for rte_nm, _ in chain], [RAMP, NB, SB, LOOP, LOOP_NP])
+        self.assertEqual(graph.shared_intersections(NB, LOOP), [])
+
+        graph = self.graph(rte_int_dict)
+        self.assertIsNone(chain_routes(graph, RAMP, LOOP_NP, {NB, LOOP}, lambda route, next_route, shared: None))
+
+
+if __name__ == '__main__':
+    unittest.main()
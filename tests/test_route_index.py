@@ -0,0 +1,49 @@
+""" Tests route_index.py against difflib, with the route names of a small
+    synthetic network (see synthetic_data.py).  Run from the repo folder with:
+        python -m pytest tests
+"""
+
+import difflib
+import random
+import unittest
+
+import route_index
+import synthetic_data
+
+
+class TestRouteNameIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        network = synthetic_data.generate_network(primaries=2, secondaries=3, size=8000, seed=0)
+        cls.rte_nms = sorted(set(network['master_lrs']['RTE_NM']) | set(network['overlap_lrs']['RTE_NM']))
+        cls.road_names = sorted(set(network['tmcs']['roadName'].map(str)))
+
+
+    def test_matches_difflib(self):
+        rng = random.Random(0)
+        index = route_index.RouteNameIndex(self.rte_nms)
+        for roadName in self.road_names + ['', 'None']:
+            for _ in range(5):
+                candidates = rng.sample(self.rte_nms, min(8, len(self.rte_nms)))
+                candidates += candidates[:2]  # Duplicates are kept, as in difflib
+                self.assertEqual(index.close_matches(roadName, candidates), difflib.get_close_matches(roadName, candidates))
+        self.assertGreater(index.misses, 0)
+
+
+    def test_empty_strings(self):
+        index = route_index.RouteNameIndex()
+        for roadName, candidates in (('', ['', 'x']), ('', ['x']), ('x', ['', 'x'])):
+            self.assertEqual(index.close_matches(roadName, candidates), difflib.get_close_matches(roadName, candidates))
+        self.assertEqual(index.close_matches('', ['', 'x']), [''])
+
+
+    def test_memo(self):
+        index = route_index.RouteNameIndex(self.rte_nms)
+        candidates = self.rte_nms[:5]
+        first = index.close_matches(self.road_names[0], candidates)
+        self.assertEqual(index.close_matches(self.road_names[0], list(reversed(candidates))), first)
+        self.assertEqual((index.misses, index.hits), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
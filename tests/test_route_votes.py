@@ -0,0 +1,153 @@
+""" Tests route_votes.py against the Counter of the routes found one probe point
+    at a time, as the steps did before, on a small synthetic network (see
+    synthetic_data.py).  TestSamplePointSearch checks the one-query search of
+    step 45's sample points the same way.  Run from the repo folder with:
+        python -m pytest tests
+"""
+
+import unittest
+from collections import Counter
+
+import numpy as np
+import shapely
+
+import projection
+import synthetic_data
+import tmc_geometry
+from geometry_store import GeometryStore
+from lrs_model import CompactLRS
+from map_matching import sample_points
+from route_votes import RouteVotes
+
+PROBES = (0, 0.25, 0.5, 0.75, 1)
+DISTANCES = (9, 30)  # The steps' search distance, and one wide enough to find both carriageways
+
+
+def get_most_common(c):
+    """ lrs_tools.get_most_common, which can't be imported without arcpy """
+    freq_list = list(c.values())
+    max_cnt = max(freq_list)
+    total = freq_list.count(max_cnt)
+    return c.most_common(total)
+
+
+class TestRouteVotes(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        network = synthetic_data.generate_network(primaries=2, secondaries=3, size=8000, seed=0)
+        master_lrs = network['master_lrs']
+        cls.lrs = CompactLRS.from_geometries(master_lrs['RTE_NM'], master_lrs.geometry.values)
+
+        tmcs = network['tmcs']
+        xy, offsets = tmc_geometry.parse_coordinates(tmcs['coordinates'])
+        store = GeometryStore.from_geometries(tmcs['tmc'], tmc_geometry.build_lines(projection.project_xy(xy), offsets))
+        probes = [store.points_at(fraction) for fraction in PROBES]
+        cls.cases = []
+        for distance in DISTANCES:
+            votes = RouteVotes.from_probes(cls.lrs, probes, distance)
+            # The old path: the routes near each probe point, one query at a time
+            route_lists = [[cls.lrs.nearby_routes(shapely.Point(probe[item]), distance) for probe in probes] for item in range(len(store))]
+            cls.cases.append((distance, votes, route_lists))
+
+
+    def test_counts(self):
+        for distance, votes, route_lists in self.cases:
+            for item, item_routes in enumerate(route_lists):
+                routes = [route for routes in item_routes for route in routes]
+                self.assertEqual(votes.route_names(item), routes)
+                self.assertEqual(list(votes.counts(item).items()), list(Counter(routes).items()))
+
+
+    def test_most_common(self):
+        ties = 0
+        for distance, votes, route_lists in self.cases:
+            for item, item_routes in enumerate(route_lists):
+                counter = Counter(route for routes in item_routes for route in routes)
+                expected = get_most_common(counter) if counter else []
+                self.assertEqual(votes.most_common(item), expected)
+                ties += len(expected) > 1
+
+                # Limited to some of the routes, as steps 31 and 45 do
+                allowed = [route for route in counter if route.startswith('R-VA')]
+                allowed_counter = Counter({route: counter[route] for route in allowed})
+                expected = get_most_common(allowed_counter) if allowed_counter else []
+                self.assertEqual(votes.most_common(item, self.lrs.route_ids(allowed)), expected)
+        self.assertGreater(ties, 0)
+
+
+    def test_most_common_of_some_points(self):
+        first_points = np.zeros(len(PROBES), dtype=bool)
+        first_points[:2] = True
+        for distance, votes, route_lists in self.cases:
+            for item, item_routes in enumerate(route_lists):
+                counter = Counter(route for routes in item_routes[:2] for route in routes)
+                self.assertEqual(votes.most_common(item, points=first_points), get_most_common(counter) if counter else [])
+
+
+    def test_winners(self):
+        for distance, votes, route_lists in self.cases:
+            winners = votes.winners(votes=len(PROBES))
+            for item, item_routes in enumerate(route_lists):
+                counter = Counter(route for routes in item_routes for route in routes)
+                most_common = get_most_common(counter) if counter else []
+                expected = most_common[0][0] if len(most_common) == 1 and most_common[0][1] == len(PROBES) else None
+                self.assertEqual(self.lrs.names[winners[item]] if winners[item] >= 0 else None, expected)
+
+
+    def test_from_route_lists(self):
+        for distance, votes, route_lists in self.cases:
+            for item in range(0, len(route_lists), 10):
+                self.assertEqual(RouteVotes.from_route_lists(self.lrs, route_lists[item]).most_common(0), votes.most_common(item))
+
+
+class TestSamplePointSearch(unittest.TestCase):
+    """ Step 45's find_nearby_routes: every sample point of a chunk of TMCs in one
+        query, with a shorter search distance for TMCs under 18 m """
+    @classmethod
+    def setUpClass(cls):
+        network = synthetic_data.generate_network(primaries=2, secondaries=3, size=8000, seed=0)
+        master_lrs = network['master_lrs']
+        cls.lrs = CompactLRS.from_geometries(master_lrs['RTE_NM'], master_lrs.geometry.values)
+
+        tmcs = network['tmcs']
+        xy, offsets = tmc_geometry.parse_coordinates(tmcs['coordinates'])
+        lines = list(tmc_geometry.build_lines(projection.project_xy(xy), offsets))
+        lines.append(shapely.line_interpolate_point(lines[0], [0, 5, 12]))  # A short TMC
+        lines[-1] = shapely.LineString(shapely.get_coordinates(lines[-1]))
+        cls.lengths = shapely.length(lines)
+        cls.xy = [sample_points(shapely.get_coordinates(line)) for line in lines]
+        cls.distances = [length / 4 if length < 18 else 9 for length in cls.lengths]
+
+
+    def test_chunk_search(self):
+        self.assertLess(self.lengths[-1], 18)
+        point_items = np.repeat(np.arange(len(self.xy)), [len(xy) for xy in self.xy])
+        votes = RouteVotes.from_points(self.lrs, np.concatenate(self.xy), point_items,
+                                       np.repeat(self.distances, [len(xy) for xy in self.xy]), len(self.xy))
+
+        pt = np.arange(len(point_items)) - votes.point_starts[point_items]
+        n_points = np.diff(votes.point_starts)[point_items]
+        first_routes = votes.top_routes(pt < 3)
+        last_routes = votes.top_routes(pt > n_points - 3)
+
+        for item, (xy, distance) in enumerate(zip(self.xy, self.distances)):
+            # The old path: one query per sample point
+            route_lists = [self.lrs.nearby_routes(shapely.Point(point), distance) for point in xy]
+            self.assertEqual(votes.route_names(item), [route for routes in route_lists for route in routes])
+
+            for top, points in ((first_routes, route_lists[:3]), (last_routes, route_lists[-2:])):
+                counter = Counter(route for routes in points for route in routes)
+                expected = get_most_common(counter)[0][0] if counter else None
+                self.assertEqual(self.lrs.names[top[item]] if top[item] >= 0 else None, expected)
+
+
+    def test_missing_points(self):
+        # A TMC point that couldn't be projected finds no routes
+        xy = np.concatenate([self.xy[0], [[np.nan, np.nan]]])
+        votes = RouteVotes.from_points(self.lrs, xy, np.zeros(len(xy), dtype=np.int64), 9, 1)
+        route_lists = [self.lrs.nearby_routes(shapely.Point(point), 9) for point in self.xy[0]]
+        self.assertEqual(votes.route_names(0), [route for routes in route_lists for route in routes])
+
+
+if __name__ == '__main__':
+    unittest.main()
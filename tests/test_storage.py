@@ -0,0 +1,95 @@
+""" Tests that the copy into the columnar storage GeoPackage (storage.py) keeps
+    the LRS M values, and that the compact LRS cached from it (lrs_model.py)
+    outlives TMC updates, on a small synthetic network (see synthetic_data.py).
+    Run from the repo folder with:
+        python -m pytest tests
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import geopandas as gp
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+
+import config
+import storage
+import synthetic_data
+import tmc_geometry
+from conflation_service import load_engine
+from lrs_model import CompactLRS, load_lrs
+
+
+class TestExportToColumnar(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        network = synthetic_data.generate_network(primaries=2, secondaries=3, size=8000, seed=0)
+        cls.master_lrs = network['master_lrs']
+        cls.tmcs = network['tmcs']
+
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.gdb = os.path.join(self.folder.name, 'input_data.gdb')
+        self.gpkg = os.path.join(self.folder.name, 'conflation.gpkg')
+        storage.write_measured(self.master_lrs, self.gdb, layer='master_lrs', driver='OpenFileGDB',
+                               geometry_type='Measured MultiLineString')
+        with mock.patch.multiple(config, MASTER_LRS=os.path.join(self.gdb, 'master_lrs'), COLUMNAR_DB=self.gpkg):
+            storage.export_to_columnar(layers=('master_lrs',))
+
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+
+    def test_read_dataframe_drops_m(self):
+        # Why the export can't use read_dataframe and write_dataframe
+        with self.assertWarns(UserWarning):
+            lrs = pyogrio.read_dataframe(self.gdb, layer='master_lrs')
+        self.assertFalse(shapely.has_m(lrs.geometry.values).any())
+        self.assertTrue(shapely.has_m(storage.read_measured(self.gdb, 'master_lrs').geometry.values).all())
+
+
+    def test_export_keeps_m(self):
+        expected = CompactLRS.from_geometries(self.master_lrs['RTE_NM'], self.master_lrs.geometry.values)
+        lrs = CompactLRS.from_geopackage(self.gpkg)
+        self.assertIsNotNone(lrs.m)
+        self.assertEqual(lrs.names, expected.names)
+        np.testing.assert_allclose(lrs.xy, expected.xy)
+        np.testing.assert_allclose(lrs.m, expected.m, atol=1e-4)  # The file geodatabase's M resolution
+
+
+    def test_load_engine_from_export(self):
+        engine = load_engine(self.gpkg, rte_int_dict_path=os.path.join(self.folder.name, 'missing.json'), tmcs=False)
+        xy, offsets = tmc_geometry.parse_coordinates(self.tmcs['coordinates'].iloc[:1])
+        answer = engine.match({'id': self.tmcs['tmc'].iloc[0], 'coordinates': xy.tolist(), 'wgs84': True})
+        self.assertTrue(answer['events'])
+        for event in answer['events']:
+            self.assertIsNotNone(event['begin_msr'])
+            self.assertIsNotNone(event['end_msr'])
+
+
+    def test_lrs_cache_survives_tmc_updates(self):
+        cache_path = os.path.join(self.folder.name, 'conflation_compact.pickle')
+        load_lrs(self.gpkg)
+        cached = os.path.getmtime(cache_path)
+
+        # Status updates rewrite the GeoPackage but not the LRS
+        target = storage.ColumnarStorage(self.gpkg)
+        target.write_layer('TMCs', gp.GeoDataFrame({'tmc': ['a'], 'status': [None]}, geometry=[shapely.LineString([(0, 0), (1, 1)])],
+                                                   crs=config.VIRGINIA_LAMBERT_WKID))
+        target.update_rows('TMCs', 'tmc', pd.DataFrame({'status': ['Complete (10)']}, index=['a']))
+        self.assertIsNotNone(load_lrs(self.gpkg).m)
+        self.assertEqual(os.path.getmtime(cache_path), cached)
+
+        # A new LRS is read again
+        target.write_layer('master_lrs', self.master_lrs.iloc[:3])
+        self.assertEqual(len(load_lrs(self.gpkg)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
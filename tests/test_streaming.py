@@ -0,0 +1,114 @@
+""" Tests streaming.py on a small synthetic network (see synthetic_data.py), with
+    the TMCs in a columnar storage GeoPackage.  Run from the repo folder with:
+        python -m pytest tests
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+import geopandas as gp
+import pandas as pd
+import pyarrow.parquet as pq
+import shapely
+
+import config
+import projection
+import storage
+import streaming
+import synthetic_data
+import tmc_geometry
+from lrs_model import CompactLRS
+from map_matching import HMMMatcher
+
+
+class TestStreamEvents(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        network = synthetic_data.generate_network(primaries=2, secondaries=3, size=8000, seed=0)
+        cls.master_lrs = network['master_lrs']
+        cls.tmcs = network['tmcs']
+        cls.truth = network['truth']
+
+        # The matcher's LRS comes from the GeoPackage, as in streaming.py's CLI
+        with tempfile.TemporaryDirectory() as folder:
+            gpkg = os.path.join(folder, 'conflation.gpkg')
+            storage.ColumnarStorage(gpkg).write_layer('master_lrs', cls.master_lrs)
+            cls.matcher = HMMMatcher(CompactLRS.from_geopackage(gpkg))
+
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        xy, offsets = tmc_geometry.parse_coordinates(self.tmcs['coordinates'])
+        status = pd.Series([None] * len(self.tmcs), dtype=object)
+        status.iloc[:10] = 'Complete (10)'
+        tmcs = gp.GeoDataFrame({'tmc': self.tmcs['tmc'].to_numpy(dtype=object), 'status': status},
+                               geometry=tmc_geometry.build_lines(projection.project_xy(xy), offsets),
+                               crs=config.VIRGINIA_LAMBERT_WKID)
+        self.store = storage.ColumnarStorage(os.path.join(self.folder.name, 'conflation.gpkg'))
+        self.store.write_layer('TMCs', tmcs)
+
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+
+    def output(self, name):
+        return os.path.join(self.folder.name, name)
+
+
+    def read_jsonl(self, path):
+        return pd.DataFrame(self.read_rows(path))
+
+
+    def read_rows(self, path):
+        with open(path) as file:
+            return [json.loads(line) for line in file]
+
+
+    def test_jsonl_events(self):
+        path = self.output('events.jsonl')
+        counts = streaming.stream_events(path, self.matcher, self.store, batch_size=20)
+        events = self.read_jsonl(path)
+
+        self.assertEqual(list(events.columns), streaming.EVENT_FIELDS)
+        self.assertEqual(sorted(events['tmc'].unique()), sorted(self.tmcs['tmc']))
+        self.assertEqual(counts, (len(self.tmcs), events['rte_nm'].notna().sum(), events['qc'].notna().sum()))
+        self.assertTrue(events['rte_nm'].notna().all())
+        self.assertTrue(((events['confidence'] > 0) & (events['confidence'] <= 1)).all())
+
+        # Events on the expected route have the expected measures.  The rest
+        # are on the prime route, not yet flipped, so their measures decrease
+        compared = events.merge(self.truth, on=['tmc', 'rte_nm'], how='left', suffixes=('', '_truth'))
+        expected = compared['begin_msr_truth'].notna()
+        self.assertTrue(expected.any())
+        self.assertLess((compared.loc[expected, 'begin_msr'] - compared.loc[expected, 'begin_msr_truth']).abs().max(), 0.01)
+        self.assertLess((compared.loc[expected, 'end_msr'] - compared.loc[expected, 'end_msr_truth']).abs().max(), 0.01)
+        unflipped = compared[~expected]
+        self.assertTrue((unflipped['begin_msr'] > unflipped['end_msr']).all())
+
+
+    def test_parquet_matches_jsonl(self):
+        streaming.stream_events(self.output('events.jsonl'), self.matcher, self.store, batch_size=20)
+        streaming.stream_events(self.output('events.parquet'), self.matcher, self.store, batch_size=20)
+        self.assertEqual(pq.read_table(self.output('events.parquet')).to_pylist(), self.read_rows(self.output('events.jsonl')))
+
+
+    def test_where(self):
+        path = self.output('events.jsonl')
+        tmcs, _, _ = streaming.stream_events(path, self.matcher, self.store, where='status IS NULL', batch_size=20)
+        self.assertEqual(tmcs, len(self.tmcs) - 10)
+        self.assertEqual(sorted(self.read_jsonl(path)['tmc'].unique()), sorted(self.tmcs['tmc'].iloc[10:]))
+
+
+    def test_lrs_without_measures(self):
+        lrs = CompactLRS.from_geometries(self.master_lrs['RTE_NM'], shapely.force_2d(self.master_lrs.geometry.values))
+        path = self.output('events.jsonl')
+        with self.assertRaises(ValueError):
+            streaming.stream_events(path, HMMMatcher(lrs), self.store)
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+""" Tests tmc_download.py against a local stand-in for the PDA API that serves
+    the recorded payload in data/pda_tmcs.json.  Run from the repo folder with:
+        python -m pytest tests
+"""
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas
+
+import tmc_download
+
+PAYLOAD = os.path.join(os.path.dirname(__file__), 'data', 'pda_tmcs.json')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Answers a search with the recorded TMCs in the requested counties,
+        a few bytes at a time.  Partitions in server.fail are answered with a
+        500 the first time they're requested """
+    protocol_version = 'HTTP/1.0'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        name = tmc_download.partition_name({'county': body['county']} if 'county' in body else {})
+        self.server.requests.append(name)
+
+        if name in self.server.fail:
+            self.server.fail.remove(name)
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        records = [record for record in self.server.records if 'county' not in body or record['county'] in body['county']]
+        data = json.dumps(records).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        for i in range(0, len(data), 100):
+            self.wfile.write(data[i:i + 100])
+            self.wfile.flush()
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestTmcDownload(unittest.TestCase):
+    def setUp(self):
+        with open(PAYLOAD) as file:
+            self.records = json.load(file)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.records = self.records
+        self.server.requests = []
+        self.server.fail = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/tmc/search'
+        self.folder = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.folder.name, 'cache')
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.folder.cleanup()
+
+
+    def download(self, partitions=None, **options):
+        return tmc_download.download_tmcs(partitions, params={'key': 'test'}, url=self.url, cache_dir=self.cache_dir, backoff=0, **options)
+
+
+    def test_iter_json_array_parses_any_chunking(self):
+        data = json.dumps(self.records)
+        for size in (1, 7, 100, len(data)):
+            chunks = [data[i:i + size].encode('utf-8') for i in range(0, len(data), size)]
+            self.assertEqual(list(tmc_download.iter_json_array(chunks)), self.records)
+        with self.assertRaises(ValueError):
+            list(tmc_download.iter_json_array([data[:-10]]))
+
+
+    def test_unpartitioned_download(self):
+        df = self.download()
+        self.assertEqual(sorted(df['tmc']), sorted(record['tmc'] for record in self.records))
+        self.assertEqual(self.server.requests, ['all'])
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
+    def test_retry_after_500(self):
+        self.server.fail = {'county-HENRICO'}
+        df = self.download([{'county': ['HENRICO']}], )
+        self.assertEqual(sorted(df['tmc']), ['110+00002', '110+00003'])
+        self.assertEqual(self.server.requests, ['county-HENRICO', 'county-HENRICO'])
+
+
+    def test_resume_from_cached_partition(self):
+        # A finished partition from an earlier, interrupted run
+        os.makedirs(self.cache_dir)
+        cached = dict(self.records[0], roadName='FROM CACHE')
+        with open(os.path.join(self.cache_dir, 'county-CHESTERFIELD.jsonl'), 'w') as file:
+            file.write(json.dumps(cached) + '\n')
+
+        df = self.download([{'county': ['CHESTERFIELD']}, {'county': ['HENRICO']}], )
+        self.assertNotIn('county-CHESTERFIELD', self.server.requests)
+        self.assertEqual(sorted(df['tmc']), ['110+00001', '110+00002', '110+00003'])
+        self.assertEqual(df.set_index('tmc').loc['110+00001', 'roadName'], 'FROM CACHE')
+
+
+    def test_catch_all_keeps_tmcs_outside_the_partitions(self):
+        previous_csv = os.path.join(self.folder.name, 'TMCs.csv')
+        pandas.DataFrame({'county': ['CHESTERFIELD', 'HENRICO', None]}).to_csv(previous_csv, index=False)
+        partitions = tmc_download.county_partitions(previous_csv)
+        self.assertEqual(partitions, [{'county': ['CHESTERFIELD']}, {'county': ['HENRICO']}])
+
+        # Off by default: NEW KENT and the TMC without a county are missed
+        df = self.download(partitions)
+        self.assertEqual(sorted(df['tmc']), ['110+00001', '110+00002', '110+00003', '110+00004'])
+        self.assertNotIn('all', self.server.requests)
+
+        df = self.download(partitions, catch_all=True)
+        self.assertEqual(sorted(df['tmc']), sorted(record['tmc'] for record in self.records))
+        self.assertIn('all', self.server.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+""" Streaming, resumable download of TMCs from the PDA API.
+
+    The statewide request is split into partitions (for example one per county).
+    Each partition is a dictionary of extra search fields that are added to the
+    request body.  Partitions are fetched concurrently, retried with exponential
+    backoff, and parsed record by record as the response streams in.  Every
+    record is written straight to a JSON lines file in the cache folder, so a
+    partition's full payload is never held in memory as text.
+
+    Finished partitions stay in the cache folder until the whole download
+    succeeds, so rerunning after a failure only fetches the partitions that
+    are still missing.
+
+    The partitions come from the last download, so TMCs without a county, or in
+    a new county, aren't in any partition.  catch_all=True also makes the whole
+    request once and keeps the TMCs no partition returned.  It's off by default
+    because it downloads the whole state a second time, as one request that
+    can't be resumed.
+
+    The url is a parameter, so the downloader can be pointed at a local
+    stand-in server that serves recorded payloads.
+"""
+
+import codecs
+import json
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas
+import requests
+
+PDA_URL = 'http://pda-api.ritis.org:8080/tmc/search'
+CACHE_DIR = os.path.join('data', 'tmc_download')
+CHUNK_SIZE = 64 * 1024
+
+
+def load_api_key(key_file='key.json'):
+    """ Returns the request params containing the PDA API key """
+    try:
+        with open(key_file) as key:
+            return json.load(key) # {"key": "key-value"}
+    except FileNotFoundError:
+        key = input(f'{key_file} not found.  Please enter PDA API key: ')
+        return {"key": key}
+
+
+def iter_json_array(chunks):
+    """ Yields the items of a top-level JSON array as they are parsed from an
+        iterable of str or bytes chunks """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    started = False
+
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk)
+        buffer += chunk
+
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError(f'Expected a JSON array, got {buffer[pos:pos + 50]!r}')
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break # Incomplete item.  Wait for the next chunk
+
+            # Numbers and literals can't be known to be complete until something follows them
+            if end == len(buffer) and not isinstance(item, (dict, list, str)):
+                break
+
+            yield item
+            pos = end
+
+        buffer = buffer[pos:]
+
+    raise ValueError('Response ended before the JSON array was closed')
+
+
+def partition_name(partition):
+    """ Returns a file-safe name for a partition dictionary """
+    if not partition:
+        return 'all'
+    name = '_'.join(f"{key}-{'-'.join(map(str, value)) if isinstance(value, (list, tuple)) else value}" for key, value in sorted(partition.items()))
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+
+
+def fetch_partition(partition, body, params, url, cache_dir, retries=5, backoff=2.0, timeout=300):
+    """ Downloads one partition to <cache_dir>/<partition_name>.jsonl and returns
+        the path.  The file only appears once the partition is complete """
+    path = os.path.join(cache_dir, f'{partition_name(partition)}.jsonl')
+    if os.path.exists(path):
+        return path
+
+    request_body = dict(body)
+    request_body.update(partition)
+
+    for attempt in range(retries):
+        try:
+            with requests.post(url, json=request_body, params=params, stream=True, timeout=timeout) as r:
+                r.raise_for_status()
+                with open(path + '.tmp', 'w') as file:
+                    for record in iter_json_array(r.iter_content(chunk_size=CHUNK_SIZE)):
+                        file.write(json.dumps(record))
+                        file.write('\n')
+
+            os.replace(path + '.tmp', path)
+            return path
+
+        except (requests.RequestException, ValueError) as e:
+            if attempt == retries - 1:
+                raise
+            wait = backoff * 2 ** attempt
+            print(f'\n  {partition_name(partition)} failed ({e}).  Retrying in {wait}s')
+            time.sleep(wait)
+
+
+def read_partition(path):
+    """ Yields the records of a downloaded partition """
+    with open(path) as file:
+        for line in file:
+            yield json.loads(line)
+
+
+def download_tmcs(partitions=None, body=None, params=None, url=PDA_URL, cache_dir=CACHE_DIR, workers=4, retries=5, backoff=2.0, keep_cache=False, catch_all=False):
+    """ Downloads all partitions and returns the TMCs as a DataFrame
+    inputs:
+        partitions - a list of dictionaries of extra search fields, eg [{'county': ['ARLINGTON']}, ...].
+            If None, the whole request is made as a single partition
+        body - the base request body.  Defaults to all Virginia inrix TMCs
+        params - the request params.  If None, the API key is loaded from key.json
+        url - the search endpoint
+        cache_dir - where partial downloads are kept until the download is complete
+        workers - the number of partitions to fetch at once
+        keep_cache - keep the partition files after a successful download
+        catch_all - when partitioned, also make the whole request once and keep
+            the TMCs no partition returned (eg TMCs without a county, or in a
+            county that wasn't in the last download).  This downloads the whole
+            state again, so it's off by default
+    """
+    if body is None:
+        body = {
+            'dataSourceId': 'inrix_tmc',
+            'state': [
+                'VA'
+            ]
+        }
+    if params is None:
+        params = load_api_key()
+    if not partitions:
+        partitions = [{}]
+    partitions = list({partition_name(partition): partition for partition in partitions}.values())
+    if catch_all and {} not in partitions:
+        partitions.append({})
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    paths = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_partition, partition, body, params, url, cache_dir, retries, backoff) for partition in partitions]
+        for i, future in enumerate(as_completed(futures)):
+            paths.append(future.result())
+            print(f'\r  Downloaded {i + 1} of {len(partitions)} partitions', end='')
+    print()
+
+    records = {}
+    catch_all_path = os.path.join(cache_dir, f'{partition_name({})}.jsonl')
+    for path in sorted(paths):
+        if path == catch_all_path and len(paths) > 1:
+            continue
+        for record in read_partition(path):
+            records[record['tmc']] = record # Partitions may overlap
+
+    if catch_all_path in paths and len(paths) > 1:
+        missed = 0
+        for record in read_partition(catch_all_path):
+            if record['tmc'] not in records:
+                records[record['tmc']] = record
+                missed += 1
+        print(f'  {missed} TMCs were only returned by the unpartitioned request')
+    df = pandas.DataFrame(list(records.values()))
+
+    if not keep_cache:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    return df
+
+
+def county_partitions(previous_csv):
+    """ Returns one partition per county found in a previous download, or None
+        if there is no previous download to take the county list from.  TMCs
+        without a county, or in a new county, are only picked up with
+        download_tmcs' catch_all request """
+    if not os.path.exists(previous_csv):
+        return None
+    county = pandas.read_csv(previous_csv, usecols=['county'])['county']
+    if county.isna().any():
+        print(f'  {county.isna().sum()} TMCs in {previous_csv} have no county and are only downloaded with catch_all=True')
+    counties = county.dropna().unique()
+    return [{'county': [county]} for county in sorted(counties)]
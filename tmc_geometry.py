@@ -0,0 +1,55 @@
+""" Bulk geometry tools for TMCs downloaded from the PDA API.
+
+    TMC coordinates come from the API as strings of "x y" pairs separated by
+    commas.  Rather than splitting each pair in Python, the whole coordinates
+    column is parsed into one float array with an offsets array marking where
+    each TMC's vertices begin and end:
+
+        xy[offsets[i]:offsets[i + 1]] are the vertices of TMC i
+"""
+
+import numpy as np
+import shapely
+
+
+def coordinate_strings(coordinates):
+    """ Returns the "x y,x y,..." string for each record of the API's coordinates
+        column.  The API returns a list per record and only the first item is used """
+    return coordinates.map(lambda value: value[0] if isinstance(value, (list, tuple, np.ndarray)) else value)
+
+
+def parse_coordinates(coordinates):
+    """ Parses a coordinates column into (xy, offsets)
+    inputs:
+        coordinates - a pandas Series from the API's coordinates column
+    outputs:
+        xy - float64 array of shape (total vertices, 2)
+        offsets - int64 array of length len(coordinates) + 1
+    """
+    strings = coordinate_strings(coordinates)
+    counts = strings.str.count(',').to_numpy(dtype=np.int64) + 1
+
+    text = ' '.join(strings).replace(',', ' ')
+    values = np.array(text.split(), dtype=np.float64)
+    if len(values) != counts.sum() * 2:
+        raise ValueError(f'Expected {counts.sum() * 2} coordinate values, parsed {len(values)}')
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return values.reshape(-1, 2), offsets
+
+
+def build_lines(xy, offsets):
+    """ Builds a shapely LineString for each TMC in one call.  TMCs with a single
+        vertex become zero-length lines """
+    counts = np.diff(offsets)
+    single = np.flatnonzero(counts == 1)
+    if len(single):
+        # LineStrings need at least two vertices.  Repeat the lone vertex
+        xy = np.insert(xy, offsets[single], xy[offsets[single]], axis=0)
+        counts = counts.copy()
+        counts[single] = 2
+
+    indices = np.repeat(np.arange(len(counts)), counts)
+    return shapely.linestrings(xy, indices=indices)
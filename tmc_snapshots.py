@@ -0,0 +1,129 @@
+""" Versioned snapshots of the TMC downloads.
+
+    Every download is saved as a compressed parquet file named by download date
+    and content hash (eg data/tmc_snapshots/2026-10-19_3f2a9c1b04de.parquet).
+    If a download is identical to the latest snapshot, no new file is written.
+
+    diff_snapshots compares two downloads TMC by TMC and flags each TMC as
+    added, removed, geometry changed, and/or attributes changed, so later steps
+    know exactly which TMCs need to be matched again.
+"""
+
+import glob
+import hashlib
+import os
+from datetime import date
+
+import pandas as pd
+
+import tmc_geometry
+
+SNAPSHOT_DIR = os.path.join('data', 'tmc_snapshots')
+
+
+def prepare(tmc_df):
+    """ Returns a copy of the download with coordinates stored as plain strings
+        and all other attributes as text, so snapshots compare the same way
+        no matter how they were loaded """
+    df = tmc_df.copy()
+    df['coordinates'] = tmc_geometry.coordinate_strings(df['coordinates'])
+    for col in df.columns:
+        df[col] = df[col].map(str)
+    return df.sort_values('tmc').reset_index(drop=True)
+
+
+def row_hashes(df, columns):
+    """ Returns a uint64 hash of the given columns for each row """
+    if len(columns) == 0:
+        return pd.Series(0, index=df.index, dtype='uint64')
+    return pd.util.hash_pandas_object(df[columns], index=False)
+
+
+def content_hash(df):
+    """ Returns a short hash of the whole (prepared) download """
+    hashes = row_hashes(df, sorted(df.columns))
+    return hashlib.sha256(hashes.to_numpy().tobytes()).hexdigest()[:12]
+
+
+def list_snapshots(snapshot_dir=SNAPSHOT_DIR):
+    """ Returns the snapshot paths from oldest to newest """
+    paths = glob.glob(os.path.join(snapshot_dir, '*.parquet'))
+    return sorted(paths, key=lambda path: (os.path.basename(path)[:10], os.path.getmtime(path)))
+
+
+def load_snapshot(path):
+    return pd.read_parquet(path)
+
+
+def save_snapshot(tmc_df, snapshot_dir=SNAPSHOT_DIR, download_date=None):
+    """ Saves the download as a snapshot and returns its path.  If it matches
+        the latest snapshot, the latest snapshot's path is returned instead """
+    df = prepare(tmc_df)
+    digest = content_hash(df)
+
+    snapshots = list_snapshots(snapshot_dir)
+    if snapshots and snapshots[-1].endswith(f'_{digest}.parquet'):
+        print(f'  TMCs unchanged since {os.path.basename(snapshots[-1])}')
+        return snapshots[-1]
+
+    os.makedirs(snapshot_dir, exist_ok=True)
+    download_date = download_date or date.today()
+    path = os.path.join(snapshot_dir, f'{download_date:%Y-%m-%d}_{digest}.parquet')
+    df.to_parquet(path, compression='zstd', index=False)
+    print(f'  Saved snapshot {path}')
+    return path
+
+
+def diff_snapshots(old_df, new_df):
+    """ Compares two downloads and returns a DataFrame with one row per TMC that
+        changed:
+            tmc, added, removed, geometry_changed, attributes_changed
+    """
+    old_df = prepare(old_df)
+    new_df = prepare(new_df)
+    attributes = sorted((set(old_df.columns) & set(new_df.columns)) - {'tmc', 'coordinates'})
+
+    old = pd.DataFrame({
+        'tmc': old_df['tmc'],
+        'geom': row_hashes(old_df, ['coordinates']),
+        'attrs': row_hashes(old_df, attributes)
+    })
+    new = pd.DataFrame({
+        'tmc': new_df['tmc'],
+        'geom': row_hashes(new_df, ['coordinates']),
+        'attrs': row_hashes(new_df, attributes)
+    })
+
+    merged = old.merge(new, on='tmc', how='outer', suffixes=('_old', '_new'), indicator=True)
+    both = merged['_merge'] == 'both'
+    diff = pd.DataFrame({
+        'tmc': merged['tmc'],
+        'added': merged['_merge'] == 'right_only',
+        'removed': merged['_merge'] == 'left_only',
+        'geometry_changed': both & (merged['geom_old'] != merged['geom_new']),
+        'attributes_changed': both & (merged['attrs_old'] != merged['attrs_new'])
+    })
+
+    changed = diff[['added', 'removed', 'geometry_changed', 'attributes_changed']].any(axis=1)
+    return diff.loc[changed].reset_index(drop=True)
+
+
+def snapshot_and_diff(tmc_df, output_csv=None, snapshot_dir=SNAPSHOT_DIR):
+    """ Saves the download as a snapshot and diffs it against the previous
+        snapshot.  Returns the diff, or None if there is no previous snapshot """
+    previous = list_snapshots(snapshot_dir)
+    path = save_snapshot(tmc_df, snapshot_dir)
+    if path in previous:
+        previous = [path] # Unchanged download.  Compare to itself to get an empty diff
+    if not previous:
+        print('  No previous snapshot to compare to')
+        return None
+
+    diff = diff_snapshots(load_snapshot(previous[-1]), load_snapshot(path))
+    print(f'  Changes since {os.path.basename(previous[-1])}:')
+    for col in ['added', 'removed', 'geometry_changed', 'attributes_changed']:
+        print(f'    {col}: {diff[col].sum()}')
+
+    if output_csv:
+        diff.to_csv(output_csv, index=False)
+    return diff
@@ -0,0 +1,307 @@
+""" Background logging for the per-TMC debug logs.
+
+    get_logger() returns a logger whose records are put on a queue and written
+    to logs/<filename>.log by a single background thread, so the stages don't
+    wait on log file I/O.  Use %-style arguments (log.debug('routes: %s', routes))
+    rather than f-strings.  The message is then only built if the record is
+    actually written, and usually in the background thread.
+
+    Which records are written is set in config.py:
+        LOG_LEVEL / LOG_LEVELS - the level of every log, or of single logs
+        LOG_SAMPLE - the fraction of TMCs whose DEBUG records are written.  Call
+            set_tmc() when starting on a TMC.  The same TMCs are picked every run
+        LOG_TMCS - TMCs that are always traced
+
+    With LOG_FORMAT = 'binary', records are written to logs/<filename>.trace
+    instead.  The message templates, logger names, and short string arguments
+    are stored once and referred to by number, so the trace is much smaller than
+    the text log and nothing is formatted during the run.  Expand it with:
+        python trace_log.py expand logs/45_identify_routes_detailed.trace [--tmc 110+04506] [--output 45.log]
+"""
+
+import argparse
+import atexit
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+import zlib
+from logging.handlers import QueueHandler, QueueListener
+
+import config
+
+TRACE_HEADER = b'TMCTRACE1\n'
+PRIMITIVES = (str, int, float, bool, type(None))
+MAX_INTERNED_LENGTH = 64
+
+_state = threading.local()
+_routes = {}  # filename: handler
+_listener = None
+_queue = None
+_lock = threading.Lock()
+
+
+def tmc_traced(tmc):
+    """ Returns True if the DEBUG records of tmc should be written """
+    if tmc is None or config.LOG_SAMPLE >= 1 or tmc in config.LOG_TMCS:
+        return True
+    return zlib.crc32(str(tmc).encode()) < config.LOG_SAMPLE * 2 ** 32
+
+
+def set_tmc(tmc):
+    """ Marks the TMC (or linearId, etc) the current thread is working on.
+        Records are tagged with it, and DEBUG records are dropped if it isn't
+        sampled.  Call set_tmc(None) when done """
+    _state.tmc = tmc
+    _state.traced = tmc_traced(tmc)
+
+
+def current_tmc():
+    return getattr(_state, 'tmc', None)
+
+
+def enabled(log):
+    """ Returns True if a DEBUG record from log would be written.  Use it to skip
+        building expensive log arguments """
+    return log.isEnabledFor(logging.DEBUG) and getattr(_state, 'traced', True)
+
+
+class TMCSampler(logging.Filter):
+    """ Drops DEBUG records of TMCs that aren't sampled """
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or getattr(_state, 'traced', True)
+
+
+class LazyQueueHandler(QueueHandler):
+    """ Puts records on the queue without formatting them.  Arguments that
+        could change before the background thread formats them (anything but
+        strings, numbers, and None) are formatted right away """
+    def __init__(self, record_queue, filename):
+        super().__init__(record_queue)
+        self.filename = filename
+
+
+    def prepare(self, record):
+        args = record.args
+        if isinstance(args, dict):
+            args = tuple(args.values())
+        if not isinstance(record.msg, str) or (args and not all(isinstance(arg, PRIMITIVES) for arg in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.trace_file = self.filename
+        record.tmc = current_tmc()
+        return record
+
+
+    def emit(self, record):
+        # The record is shared by every handler on the logger, so it is copied
+        # before prepare() changes it
+        try:
+            self.enqueue(self.prepare(logging.makeLogRecord(record.__dict__)))
+        except Exception:
+            self.handleError(record)
+
+
+class BinaryTraceHandler(logging.Handler):
+    """ Writes records in the compact binary trace format (see expand_trace) """
+    def __init__(self, path):
+        super().__init__()
+        self.file = open(path, 'wb')
+        self.file.write(TRACE_HEADER)
+        self.strings = {}
+
+
+    def string_id(self, value):
+        string_id = self.strings.get(value)
+        if string_id is None:
+            string_id = self.strings[value] = len(self.strings)
+            data = value.encode('utf-8')
+            self.file.write(b'S' + struct.pack('<II', string_id, len(data)) + data)
+        return string_id
+
+
+    def encode(self, value):
+        if value is None:
+            return b'n'
+        if value is True:
+            return b't'
+        if value is False:
+            return b'F'
+        if isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+            return b'i' + struct.pack('<q', value)
+        if isinstance(value, float):
+            return b'f' + struct.pack('<d', value)
+        value = str(value)
+        if len(value) <= MAX_INTERNED_LENGTH:
+            return b'r' + struct.pack('<I', self.string_id(value))
+        data = value.encode('utf-8')
+        return b's' + struct.pack('<I', len(data)) + data
+
+
+    def emit(self, record):
+        try:
+            args = record.args or ()
+            if isinstance(args, dict):
+                args = (args,)
+            msg = record.msg
+            if record.exc_text:
+                msg, args = record.getMessage() + '\n' + record.exc_text, ()
+            values = [self.encode(value) for value in (record.tmc, *args)]
+            # Templates with arguments are always interned.  Long messages without them are probably unique
+            template = b'r' + struct.pack('<I', self.string_id(msg)) if args else self.encode(msg)
+            self.file.write(b'R' + struct.pack('<dBIB', record.created, record.levelno, self.string_id(record.name), len(args)) + template + b''.join(values))
+        except Exception:
+            self.handleError(record)
+
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+class Router(logging.Handler):
+    """ Passes each record to the handler of its log file """
+    def handle(self, record):
+        handler = _routes.get(record.trace_file)
+        if handler:
+            handler.handle(record)
+        return True
+
+
+def _start_listener():
+    global _listener, _queue
+    _queue = queue.SimpleQueue()
+    _listener = QueueListener(_queue, Router())
+    _listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    """ Writes any queued records and closes the log files """
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+    for handler in _routes.values():
+        handler.close()
+    _routes.clear()
+
+
+def get_logger(name, filename, log_dir='logs'):
+    """ Returns the logger called name, writing to log_dir/filename.log (or
+        .trace).  Calling it again with another filename adds another log file """
+    log = logging.getLogger(name)
+    level = config.LOG_LEVELS.get(filename, config.LOG_LEVEL)
+    log.setLevel(level)
+    log.propagate = False
+
+    with _lock:
+        if _listener is None:
+            _start_listener()
+        if filename not in _routes:
+            os.makedirs(log_dir, exist_ok=True)
+            if config.LOG_FORMAT == 'binary':
+                _routes[filename] = BinaryTraceHandler(os.path.join(log_dir, f'{filename}.trace'))
+            else:
+                _routes[filename] = logging.FileHandler(os.path.join(log_dir, f'{filename}.log'), mode='w')
+
+    if not any(isinstance(handler, LazyQueueHandler) and handler.filename == filename for handler in log.handlers):
+        handler = LazyQueueHandler(_queue, filename)
+        if config.LOG_SAMPLE < 1:
+            handler.addFilter(TMCSampler())
+        log.addHandler(handler)
+    return log
+
+
+def read_trace(path):
+    """ Yields (created, levelno, logger name, tmc, message) for every record in
+        a binary trace """
+    unpack_record = struct.Struct('<dBIB')
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(TRACE_HEADER):
+        raise ValueError(f'{path} is not a trace file')
+
+    strings = {}
+    position = len(TRACE_HEADER)
+
+    def value():
+        nonlocal position
+        tag = data[position:position + 1]
+        position += 1
+        if tag == b'n':
+            return None
+        if tag == b't':
+            return True
+        if tag == b'F':
+            return False
+        if tag == b'i':
+            position += 8
+            return struct.unpack_from('<q', data, position - 8)[0]
+        if tag == b'f':
+            position += 8
+            return struct.unpack_from('<d', data, position - 8)[0]
+        if tag == b'r':
+            position += 4
+            return strings[struct.unpack_from('<I', data, position - 4)[0]]
+        if tag == b's':
+            length = struct.unpack_from('<I', data, position)[0]
+            position += 4 + length
+            return data[position - length:position].decode('utf-8')
+        raise ValueError(f'Unknown value type {tag} at byte {position - 1}')
+
+    while position < len(data):
+        kind = data[position:position + 1]
+        position += 1
+        if kind == b'S':
+            string_id, length = struct.unpack_from('<II', data, position)
+            position += 8
+            strings[string_id] = data[position:position + length].decode('utf-8')
+            position += length
+        elif kind == b'R':
+            created, levelno, name_id, arg_count = unpack_record.unpack_from(data, position)
+            position += unpack_record.size
+            template = value()
+            tmc = value()
+            args = tuple(value() for _ in range(arg_count))
+            if len(args) == 1 and isinstance(args[0], dict):
+                args = args[0]
+            try:
+                message = template % args if args else template
+            except (TypeError, ValueError):
+                message = f'{template} {args}'
+            yield created, levelno, strings[name_id], tmc, message
+        else:
+            raise ValueError(f'Unknown record type {kind} at byte {position - 1}')
+
+
+def expand_trace(path, output, tmc=None, timestamps=False):
+    """ Writes a binary trace as a text log.  tmc - only that TMC's records """
+    for created, levelno, name, record_tmc, message in read_trace(path):
+        if tmc and record_tmc != tmc:
+            continue
+        if timestamps:
+            output.write(f'{created:.6f} {logging.getLevelName(levelno)} {name} {record_tmc or ""}: ')
+        output.write(f'{message}\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Binary trace tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    expand = subparsers.add_parser('expand', help='write a binary trace as a text log')
+    expand.add_argument('trace')
+    expand.add_argument('--tmc', help='only the records of this TMC')
+    expand.add_argument('--timestamps', action='store_true', help='add the time, level, logger, and TMC to each line')
+    expand.add_argument('--output', help='text file.  Defaults to stdout')
+    args = parser.parse_args()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            expand_trace(args.trace, file, args.tmc, args.timestamps)
+    else:
+        expand_trace(args.trace, sys.stdout, args.tmc, args.timestamps)